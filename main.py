@@ -5,22 +5,48 @@ Generates temporary, internet-accessible URLs to trigger Home Assistant scripts
 """
 
 import asyncio
+import base64
+import codecs
+import contextlib
+import contextvars
+import cProfile
+import gzip
+import hashlib
+import heapq
+import hmac
+import itertools
 import json
 import logging
+import math
+import mimetypes
 import os
+import pstats
+import random
+import re
 import secrets
+import sys
 import time
+import zlib
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
 from urllib.parse import urljoin
 
 import aiohttp
 from fastapi import FastAPI, HTTPException, Request, Response
-from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
+from jinja2 import pass_context
 from pydantic import BaseModel
 
+import qr_encoder
+
+try:
+    import brotli
+except ImportError:  # Brotli is optional, gzip is always available
+    brotli = None
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -31,50 +57,547 @@ logger = logging.getLogger(__name__)
 # Initialize FastAPI app
 app = FastAPI(title="Script URL Generator", version="1.0.0")
 
-# Templates and static files
+# Templates
 templates = Jinja2Templates(directory="templates")
-app.mount("/static", StaticFiles(directory="static"), name="static")
 
 # Configuration
 SUPERVISOR_TOKEN = os.environ.get("SUPERVISOR_TOKEN")
 HASS_URL = os.environ.get("HASS_URL", "http://supervisor/core")
 TOKEN_EXPIRY_MINUTES = int(os.environ.get("TOKEN_EXPIRY_MINUTES", "10"))
 MAX_TOKENS_PER_SCRIPT = int(os.environ.get("MAX_TOKENS_PER_SCRIPT", "5"))
+MAX_USES_PER_TOKEN = int(os.environ.get("MAX_USES_PER_TOKEN", "100"))
+MAX_TOKENS_TOTAL = int(os.environ.get("MAX_TOKENS_TOTAL", "10000"))
+MAX_TOKEN_STORE_KB = int(os.environ.get("MAX_TOKEN_STORE_KB", "4096"))
 ENABLE_LOGGING = os.environ.get("ENABLE_LOGGING", "true").lower() == "true"
+MAX_CONCURRENT_TRIGGERS = int(os.environ.get("MAX_CONCURRENT_TRIGGERS", "10"))
+MAX_CONCURRENT_PER_SCRIPT = int(os.environ.get("MAX_CONCURRENT_PER_SCRIPT", "2"))
+ADAPTIVE_CONCURRENCY = os.environ.get("ADAPTIVE_CONCURRENCY", "false").lower() == "true"
+USE_WEBSOCKET = os.environ.get("USE_WEBSOCKET", "false").lower() == "true"
+HASS_BACKENDS = os.environ.get("HASS_BACKENDS", "")
+AUDIT_LOG_PATH = os.environ.get("AUDIT_LOG_PATH", "/data/audit.ndjson")
+AUDIT_LOG_MAX_MB = int(os.environ.get("AUDIT_LOG_MAX_MB", "5"))
+AUDIT_LOG_BACKUPS = int(os.environ.get("AUDIT_LOG_BACKUPS", "3"))
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+LOOP_LAG_THRESHOLD_MS = int(os.environ.get("LOOP_LAG_THRESHOLD_MS", "100"))
+SNAPSHOT_PATH = os.environ.get("SNAPSHOT_PATH", "/data/tokens.ndjson.gz")
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0.01"))
+TRACE_EXPORT_PATH = os.environ.get("TRACE_EXPORT_PATH", "")
+OPTIONS_PATH = os.environ.get("OPTIONS_PATH", "/data/options.json")
+TRACK_SCRIPT_RUNS = os.environ.get("TRACK_SCRIPT_RUNS", "false").lower() == "true"
+TOKEN_SWEEP_INTERVAL_SECONDS = 15
+SSE_KEEPALIVE_SECONDS = 20
+IDEMPOTENCY_CACHE_SIZE = 1000
+IDEMPOTENCY_RETRY_SECONDS = 60
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+TOKEN_SELECTOR_SIZE = 16
+TOKEN_EVICTION_GRACE_SECONDS = 60
+TOKEN_ENTRY_OVERHEAD_BYTES = 200  # store dict slot, index set slot and boxed floats
+MAX_EXTEND_MINUTES = 1440
+HASS_REQUEST_TIMEOUT_SECONDS = 30
+MAX_SCHEDULE_DELAY_SECONDS = 7 * 24 * 60 * 60
+MAX_RUN_LATENESS_SECONDS = 15 * 60  # restored runs overdue by more than this are dropped
+ADAPTIVE_LATENCY_TARGET_SECONDS = 2.0
+QUEUE_WAIT_SAMPLES = 1000
+WEBSOCKET_MAX_BACKOFF_SECONDS = 60
+CATALOG_TTL_SECONDS = 30
+CATALOG_RETRY_SECONDS = 5
+BACKEND_NAME_PATTERN = re.compile(r"[a-z0-9_]+")
+AUDIT_FLUSH_INTERVAL_SECONDS = 1.0
+AUDIT_BATCH_SIZE = 500
+AUDIT_QUEUE_SIZE = 10000
+AUDIT_QUERY_MAX_LIMIT = 10000
+HASS_INGRESS_ADDRESS = "172.30.32.2"
+INSTRUMENTED_PATHS = ("/api/generate", "/trigger/")  # requests the profiler and tracer sample
+STREAMING_PATHS = ("/api/tokens/events",)  # long-lived streams, left out of loop stall reports
+PROFILE_TOP_FUNCTIONS = 25
+LOOP_LAG_INTERVAL_SECONDS = 0.25
+LOOP_STALL_HISTORY = 50
+SHUTDOWN_GRACE_SECONDS = 10  # uvicorn waits this long for open requests, then cancels them
+SHUTDOWN_DRAIN_SECONDS = 10  # then scheduled runs' upstream calls get this long to finish
+SNAPSHOT_VERSION = 1
+QR_DEFAULT_SCALE = 8
+QR_MAX_SCALE = 32
+QR_MEDIA_TYPES = {"svg": "image/svg+xml", "png": "image/png"}
+MAX_BATCH_SIZE = 50
+TRACE_BUFFER_SIZE = 2000
+TRACE_EXPORT_MAX_BYTES = 5 * 1024 * 1024
+TRACE_SERVICE_NAME = "script_url_generator"
+OPTIONS_POLL_SECONDS = 2
+BACKEND_CLOSE_DELAY_SECONDS = HASS_REQUEST_TIMEOUT_SECONDS
+RUN_HISTORY_SIZE = 1000
+RUN_START_TIMEOUT_SECONDS = 60
+RUN_WAIT_MAX_SECONDS = 60
+RUN_TRACKER_RETRY_SECONDS = 5
+RUN_WATCH_TIMEOUT_SECONDS = 2
+RUN_WATCH_DEBOUNCE_SECONDS = 0.02
+EXPORT_BATCH_LINES = 500
+IMPORT_BLOCK_BYTES = 64 * 1024
+IMPORT_MAX_LINE_BYTES = 64 * 1024
+GZIP_MAGIC = b"\x1f\x8b"
+
+class TokenRecord:
+    """Compact in-memory form of a stored token.
+
+    Only a digest of the token is kept: the first half selects the record
+    in the store, the second half is verified in constant time. Nothing
+    kept here can be redeemed.
+    """
+
+    __slots__ = (
+        "verifier", "script_id", "created_at", "expires_at",
+        "max_uses", "uses", "min_interval_seconds", "last_used_at", "delay_seconds"
+    )
+
+    def __init__(self, verifier: bytes, script_id: str, created_at: float, expires_at: float,
+                 max_uses: int = 1, uses: int = 0, min_interval_seconds: float = 0,
+                 last_used_at: Optional[float] = None, delay_seconds: float = 0):
+        self.verifier = verifier
+        self.script_id = sys.intern(script_id)
+        self.created_at = created_at
+        self.expires_at = expires_at
+        self.max_uses = max_uses
+        self.uses = uses
+        self.min_interval_seconds = min_interval_seconds
+        self.last_used_at = last_used_at
+        self.delay_seconds = delay_seconds
+
+    @property
+    def used(self) -> bool:
+        return self.uses >= self.max_uses
+
+    def to_token_data(self) -> "TokenData":
+        return TokenData(
+            script_id=self.script_id,
+            created_at=self.created_at,
+            expires_at=self.expires_at,
+            used=self.used,
+            max_uses=self.max_uses,
+            uses=self.uses,
+            min_interval_seconds=self.min_interval_seconds,
+            last_used_at=self.last_used_at,
+            delay_seconds=self.delay_seconds
+        )
+
+# In-memory token store keyed by token selector (in production, consider using Redis or database)
+tokens: Dict[bytes, TokenRecord] = {}
+
+# Selectors of every stored token per script, so per-script work skips other scripts
+script_index: Dict[str, Set[bytes]] = {}
+
+# Estimated bytes held by the store, kept up to date by store_token/remove_token
+token_store_bytes = 0
+
+# (expires_at, selector) heap over the store, so expiry and eviction never scan it.
+# Entries of removed or extended tokens go stale and are skipped when they surface.
+expiry_heap: List[Tuple[float, bytes]] = []
+
+# Selectors of fully used tokens in the order they were used up, evicted first
+used_tokens: Dict[bytes, None] = {}
+
+def record_bytes(selector: bytes, record: TokenRecord) -> int:
+    """Estimated memory cost of one stored token.
 
-# In-memory token store (in production, consider using Redis or database)
-tokens: Dict[str, Dict] = {}
+    Only depends on fixed-size parts, so the same value is subtracted on
+    removal as was added on insert.
+    """
+    return (sys.getsizeof(selector) + sys.getsizeof(record) + sys.getsizeof(record.verifier)
+            + TOKEN_ENTRY_OVERHEAD_BYTES)
+
+NEW_TOKEN_BYTES = record_bytes(bytes(TOKEN_SELECTOR_SIZE), TokenRecord(bytes(TOKEN_SELECTOR_SIZE), "", 0.0, 0.0))
 
 class TokenData(BaseModel):
     script_id: str
     created_at: float
     expires_at: float
     used: bool = False
+    max_uses: int = 1
+    uses: int = 0
+    min_interval_seconds: float = 0
+    last_used_at: Optional[float] = None
+    delay_seconds: float = 0
+
+    @property
+    def remaining_uses(self) -> int:
+        return max(self.max_uses - self.uses, 0)
 
 class ScriptInfo(BaseModel):
     entity_id: str
     name: str
     friendly_name: str
+    backend: str = ""
 
-async def get_hass_headers() -> Dict[str, str]:
-    """Get headers for Home Assistant API requests"""
-    return {
-        "Authorization": f"Bearer {SUPERVISOR_TOKEN}",
-        "Content-Type": "application/json",
-    }
+class StaticAsset(BaseModel):
+    path: str
+    media_type: str
+    etag: str
+    body: bytes
+    gzip_body: Optional[bytes] = None
+    brotli_body: Optional[bytes] = None
 
-async def get_scripts() -> List[ScriptInfo]:
-    """Fetch all available scripts from Home Assistant"""
-    try:
-        async with aiohttp.ClientSession() as session:
-            headers = await get_hass_headers()
-            async with session.get(
-                f"{HASS_URL}/api/states",
-                headers=headers
+# Static assets are fingerprinted once at startup and served from memory
+STATIC_DIR = Path("static")
+STATIC_CACHE_CONTROL = "public, max-age=31536000, immutable"
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+def build_static_assets(directory: Path = STATIC_DIR) -> Tuple[Dict[str, str], Dict[str, StaticAsset]]:
+    """Fingerprint and precompress every file below the static directory.
+
+    Returns the manifest mapping logical paths (``css/style.css``) to their
+    fingerprinted names (``css/style.<hash>.css``), and the assets keyed by
+    both names so unhashed URLs keep working.
+    """
+    manifest: Dict[str, str] = {}
+    assets: Dict[str, StaticAsset] = {}
+    if not directory.is_dir():
+        return manifest, assets
+
+    for file_path in sorted(p for p in directory.rglob("*") if p.is_file()):
+        logical_path = file_path.relative_to(directory).as_posix()
+        body = file_path.read_bytes()
+        digest = hashlib.sha256(body).hexdigest()[:12]
+        hashed_path = file_path.with_name(f"{file_path.stem}.{digest}{file_path.suffix}")
+        hashed_path = hashed_path.relative_to(directory).as_posix()
+        media_type = mimetypes.guess_type(logical_path)[0] or "application/octet-stream"
+
+        asset = StaticAsset(
+            path=hashed_path,
+            media_type=media_type,
+            etag=f'W/"{digest}"',
+            body=body
+        )
+        if media_type.startswith(COMPRESSIBLE_TYPES):
+            compressed = gzip.compress(body, compresslevel=9, mtime=0)
+            if len(compressed) < len(body):
+                asset.gzip_body = compressed
+            if brotli is not None:
+                compressed = brotli.compress(body, quality=11)
+                if len(compressed) < len(body):
+                    asset.brotli_body = compressed
+
+        manifest[logical_path] = hashed_path
+        assets[logical_path] = asset
+        assets[hashed_path] = asset
+
+    return manifest, assets
+
+def accepted_encodings(header: str) -> List[str]:
+    """Parse an Accept-Encoding header, dropping codings refused with q=0"""
+    encodings = []
+    for part in header.split(","):
+        name, _, params = part.partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        params = params.replace(" ", "")
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        encodings.append(name)
+    return encodings
+
+def select_asset_body(asset: StaticAsset, accept_encoding: str) -> Tuple[bytes, Optional[str]]:
+    """Pick the smallest representation the client accepts"""
+    encodings = accepted_encodings(accept_encoding)
+    if asset.brotli_body is not None and "br" in encodings:
+        return asset.brotli_body, "br"
+    if asset.gzip_body is not None and ("gzip" in encodings or "*" in encodings):
+        return asset.gzip_body, "gzip"
+    return asset.body, None
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match check: a list of tags or "*", compared weakly"""
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag.removeprefix("W/") in (tag.removeprefix("W/") for tag in tags)
+
+asset_manifest, static_assets = build_static_assets()
+
+INGRESS_PATH_PATTERN = re.compile(r"(/[A-Za-z0-9_.~-]+)+")
+
+def static_prefix(request: Request) -> str:
+    """Path the static routes are reachable under from the browser.
+
+    Home Assistant ingress proxies the add-on below a per-session path it
+    passes in X-Ingress-Path; the request itself only sees the inner path,
+    so absolute URLs built from it would point past the proxy.
+    """
+    ingress_path = request.headers.get("x-ingress-path", "").rstrip("/")
+    if not INGRESS_PATH_PATTERN.fullmatch(ingress_path):
+        ingress_path = ""
+    return f"{ingress_path}{request.scope.get('root_path', '')}/static/"
+
+@pass_context
+def static_url(context, path: str) -> str:
+    """Template helper resolving a static path to its fingerprinted URL"""
+    return static_prefix(context["request"]) + asset_manifest.get(path, path)
+
+templates.env.globals["static_url"] = static_url
+
+class HassWebSocketUnavailable(ConnectionError):
+    """The WebSocket channel is down and the command was never sent"""
+
+def hass_websocket_url(hass_url: str) -> str:
+    """WebSocket API URL for a Home Assistant base URL"""
+    if hass_url.rstrip("/").endswith("/core"):
+        # The Supervisor proxy exposes the API as /core/websocket
+        return f"{hass_url.rstrip('/')}/websocket"
+    return f"{hass_url.rstrip('/')}/api/websocket"
+
+class HassWebSocket:
+    """One authenticated, multiplexed Home Assistant WebSocket connection.
+
+    Commands share the connection and are matched to their results by
+    message id; event messages go to the handler of the subscription that
+    asked for them. After a failure the connection is re-established on the
+    next command, with exponential backoff between attempts. Subscriptions
+    end with the connection and have to be renewed by their owner.
+    """
+
+    def __init__(self, backend: "HassBackend"):
+        self.backend = backend
+        self.ws: Optional[aiohttp.ClientWebSocketResponse] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.connect_lock: Optional[asyncio.Lock] = None
+        self.reader: Optional[asyncio.Task] = None
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.subscriptions: Dict[int, Callable[[Dict], None]] = {}
+        self.next_id = 1
+        self.backoff = 1.0
+        self.retry_at = 0.0
+
+    @property
+    def connected(self) -> bool:
+        return self.ws is not None and not self.ws.closed
+
+    async def ensure_connected(self):
+        """Connect and authenticate unless already connected"""
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.ws, self.reader, self.pending, self.subscriptions = None, None, {}, {}
+            self.connect_lock = asyncio.Lock()
+            self.loop = loop
+        
+        if self.connected:
+            return
+        async with self.connect_lock:
+            if self.connected:
+                return
+            if time.monotonic() < self.retry_at:
+                raise HassWebSocketUnavailable("Home Assistant WebSocket is reconnecting")
+            try:
+                await self.connect()
+            except Exception as e:
+                self.retry_at = time.monotonic() + self.backoff
+                self.backoff = min(self.backoff * 2, WEBSOCKET_MAX_BACKOFF_SECONDS)
+                raise HassWebSocketUnavailable(f"Home Assistant WebSocket connection failed: {e}") from e
+            self.backoff = 1.0
+
+    async def connect(self):
+        ws = await self.backend.session().ws_connect(hass_websocket_url(self.backend.url), heartbeat=30)
+        try:
+            message = await ws.receive_json(timeout=10)
+            if message.get("type") == "auth_required":
+                await ws.send_json({"type": "auth", "access_token": self.backend.token})
+                message = await ws.receive_json(timeout=10)
+            if message.get("type") != "auth_ok":
+                raise ConnectionError(f"authentication failed: {message.get('type')}")
+        except BaseException:
+            await ws.close()
+            raise
+        
+        self.ws = ws
+        self.reader = asyncio.create_task(self.read_loop(ws))
+        if ENABLE_LOGGING:
+            logger.info(f"Connected to Home Assistant WebSocket API of {self.backend.label}")
+
+    async def read_loop(self, ws: aiohttp.ClientWebSocketResponse):
+        """Route results to the commands waiting for them and events to their subscriptions.
+
+        A malformed message or a failing handler only costs that message;
+        a failed read ends the connection, so later commands reconnect or
+        fall back to REST instead of waiting for results that never come.
+        """
+        try:
+            async for message in ws:
+                if message.type == aiohttp.WSMsgType.ERROR:
+                    raise ws.exception() or ConnectionError("WebSocket error")
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                try:
+                    data = json.loads(message.data)
+                except ValueError as e:
+                    logger.warning(f"Ignoring malformed Home Assistant WebSocket message: {e}")
+                    continue
+                # Home Assistant may coalesce several messages into one array
+                for item in data if isinstance(data, list) else [data]:
+                    try:
+                        self.dispatch(item)
+                    except Exception as e:
+                        logger.error(f"Error handling Home Assistant WebSocket message: {e!r}")
+        except Exception as e:
+            logger.warning(f"Home Assistant WebSocket read failed: {e}")
+        finally:
+            if self.ws is ws:
+                self.ws = None
+                self.subscriptions = {}
+            pending, self.pending = self.pending, {}
+            for waiter in pending.values():
+                if not waiter.done():
+                    waiter.set_exception(ConnectionError("Home Assistant WebSocket closed"))
+            if not ws.closed:
+                with contextlib.suppress(Exception):
+                    await ws.close()
+
+    def dispatch(self, item: Dict):
+        """Hand one message to its subscription handler or waiting command"""
+        if item.get("type") == "event":
+            handler = self.subscriptions.get(item.get("id"))
+            if handler is not None:
+                handler(item.get("event") or {})
+            return
+        waiter = self.pending.pop(item.get("id"), None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(item)
+
+    async def command(self, payload: Dict, timeout: float = HASS_REQUEST_TIMEOUT_SECONDS,
+                      handler: Optional[Callable[[Dict], None]] = None) -> Dict:
+        """Send a command and wait for its result message.
+
+        A handler receives the events sent under the command's id. It is
+        registered before sending, since events can follow the result in the
+        same frame, and dropped again unless the command succeeds.
+        """
+        await self.ensure_connected()
+        message_id = self.next_id
+        self.next_id += 1
+        waiter = asyncio.get_running_loop().create_future()
+        self.pending[message_id] = waiter
+        if handler is not None:
+            self.subscriptions[message_id] = handler
+        result: Dict = {}
+        try:
+            try:
+                await self.ws.send_json({"id": message_id, **payload})
+            except Exception as e:
+                raise HassWebSocketUnavailable(f"Home Assistant WebSocket send failed: {e}") from e
+            result = await asyncio.wait_for(waiter, timeout)
+            return result
+        finally:
+            self.pending.pop(message_id, None)
+            if handler is not None and not result.get("success"):
+                self.subscriptions.pop(message_id, None)
+
+    async def subscribe_trigger(self, trigger: Dict, handler: Callable[[Dict], None]) -> int:
+        """Subscribe to a Home Assistant trigger for the life of the connection"""
+        result = await self.command({"type": "subscribe_trigger", "trigger": trigger}, handler=handler)
+        if not result.get("success"):
+            raise ConnectionError(f"subscribing to {trigger.get('platform')} trigger failed: {result.get('error')}")
+        return result["id"]
+
+    async def unsubscribe(self, subscription: int):
+        """End a subscription; its handler stops receiving events right away"""
+        self.subscriptions.pop(subscription, None)
+        await self.command({"type": "unsubscribe_events", "subscription": subscription})
+
+    async def wait_closed(self):
+        """Wait until the current connection drops"""
+        if self.reader is not None:
+            await asyncio.wait({self.reader})
+
+    async def call_service(self, domain: str, service: str, service_data: Dict) -> bool:
+        """Call a Home Assistant service over the WebSocket channel"""
+        result = await self.command({
+            "type": "call_service",
+            "domain": domain,
+            "service": service,
+            "service_data": service_data,
+        })
+        if not result.get("success"):
+            logger.error(f"Service {domain}.{service} failed: {result.get('error')}")
+        return bool(result.get("success"))
+
+    async def close(self):
+        if self.ws is not None and self.loop is asyncio.get_running_loop():
+            await self.ws.close()
+        self.ws = None
+
+class HassBackend:
+    """One Home Assistant instance with its own connection pool, script catalog cache and health.
+
+    Script ids of the default backend (named "") are plain entity ids; other
+    backends namespace theirs as ``<backend>:<entity_id>``.
+    """
+
+    def __init__(self, name: str, url: str, token: Optional[str]):
+        self.name = name
+        self.url = url.rstrip("/")
+        self.token = token
+        self.http: Optional[aiohttp.ClientSession] = None
+        self.http_loop: Optional[asyncio.AbstractEventLoop] = None
+        self.websocket = HassWebSocket(self)
+        self.catalog: List[ScriptInfo] = []
+        self.catalog_fetched_at = 0.0
+        self.catalog_refresh: Optional[asyncio.Task] = None
+        self.healthy = True
+        self.last_error: Optional[str] = None
+        self.last_success_at: Optional[float] = None
+
+    @property
+    def label(self) -> str:
+        return self.name or "default"
+
+    def script_id(self, entity_id: str) -> str:
+        """Namespaced script id for one of this backend's entities"""
+        return f"{self.name}:{entity_id}" if self.name else entity_id
+
+    def session(self) -> aiohttp.ClientSession:
+        """Get the pooled HTTP client, creating it on first use in the running loop"""
+        loop = asyncio.get_running_loop()
+        if self.http is None or self.http.closed or self.http_loop is not loop:
+            self.http = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=HASS_REQUEST_TIMEOUT_SECONDS)
+            )
+            self.http_loop = loop
+        return self.http
+
+    def headers(self) -> Dict[str, str]:
+        """Get headers for Home Assistant API requests"""
+        return {
+            "Authorization": f"Bearer {self.token}",
+            "Content-Type": "application/json",
+        }
+
+    def record_success(self):
+        self.healthy = True
+        self.last_error = None
+        self.last_success_at = time.time()
+
+    def record_failure(self, error: str):
+        self.healthy = False
+        self.last_error = error
+
+    def health(self) -> Dict:
+        return {
+            "healthy": self.healthy,
+            "last_error": self.last_error,
+            "last_success_at": datetime.fromtimestamp(self.last_success_at).isoformat() if self.last_success_at else None,
+            "scripts": len(self.catalog),
+            "websocket_connected": self.websocket.connected,
+        }
+
+    async def fetch_scripts(self) -> Optional[List[ScriptInfo]]:
+        """Fetch all available scripts from Home Assistant"""
+        try:
+            async with self.session().get(
+                f"{self.url}/api/states",
+                headers=self.headers()
             ) as response:
                 if response.status != 200:
-                    logger.error(f"Failed to fetch states: {response.status}")
-                    return []
+                    logger.error(f"Failed to fetch states from {self.label}: {response.status}")
+                    self.record_failure(f"HTTP {response.status}")
+                    return None
                 
                 states = await response.json()
                 scripts = []
@@ -82,189 +605,2363 @@ async def get_scripts() -> List[ScriptInfo]:
                 for state in states:
                     if state["entity_id"].startswith("script."):
                         scripts.append(ScriptInfo(
-                            entity_id=state["entity_id"],
+                            entity_id=self.script_id(state["entity_id"]),
                             name=state["entity_id"],
-                            friendly_name=state["attributes"].get("friendly_name", state["entity_id"])
+                            friendly_name=state["attributes"].get("friendly_name", state["entity_id"]),
+                            backend=self.name
                         ))
                 
+                self.record_success()
                 return sorted(scripts, key=lambda x: x.friendly_name.lower())
-    except Exception as e:
-        logger.error(f"Error fetching scripts: {e}")
-        return []
+        except Exception as e:
+            logger.error(f"Error fetching scripts from {self.label}: {e}")
+            self.record_failure(str(e))
+            return None
+
+    async def refresh_catalog(self):
+        scripts = await self.fetch_scripts()
+        if scripts is not None:
+            self.catalog = scripts
+            self.catalog_fetched_at = time.monotonic()
+        else:
+            # Keep serving the last known catalog and retry shortly
+            self.catalog_fetched_at = time.monotonic() - CATALOG_TTL_SECONDS + CATALOG_RETRY_SECONDS
+
+    async def get_scripts(self) -> List[ScriptInfo]:
+        """Cached script catalog; concurrent callers share one refresh"""
+        if self.catalog_fetched_at and time.monotonic() - self.catalog_fetched_at < CATALOG_TTL_SECONDS:
+            return self.catalog
+        
+        refresh = self.catalog_refresh
+        if refresh is None or refresh.done() or refresh.get_loop() is not asyncio.get_running_loop():
+            refresh = self.catalog_refresh = asyncio.ensure_future(self.refresh_catalog())
+        await asyncio.shield(refresh)
+        return self.catalog
+
+    async def trigger(self, entity_id: str) -> bool:
+        """Call script/turn_on, over the WebSocket channel when enabled"""
+        if USE_WEBSOCKET:
+            try:
+                success = await self.websocket.call_service("script", "turn_on", {"entity_id": entity_id})
+                if ENABLE_LOGGING:
+                    logger.info(f"Script {entity_id} on {self.label} triggered via WebSocket: {'SUCCESS' if success else 'FAILED'}")
+                if success:
+                    self.record_success()
+                return success
+            except HassWebSocketUnavailable as e:
+                # The command never reached Home Assistant, so REST can't run it twice
+                logger.warning(f"{e}; falling back to REST")
+            except Exception as e:
+                logger.error(f"Error triggering script {entity_id} on {self.label} via WebSocket: {e}")
+                self.record_failure(str(e))
+                return False
+        
+        try:
+            payload = {"entity_id": entity_id}
+            
+            async with self.session().post(
+                f"{self.url}/api/services/script/turn_on",
+                headers=self.headers(),
+                json=payload
+            ) as response:
+                success = response.status == 200
+                if ENABLE_LOGGING:
+                    logger.info(f"Script {entity_id} on {self.label} triggered: {'SUCCESS' if success else 'FAILED'}")
+                if success:
+                    self.record_success()
+                elif response.status >= 500:
+                    self.record_failure(f"HTTP {response.status}")
+                return success
+        except Exception as e:
+            logger.error(f"Error triggering script {entity_id} on {self.label}: {e}")
+            self.record_failure(str(e))
+            return False
+
+    async def close(self):
+        """Close the WebSocket channel and the pooled HTTP client"""
+        await self.websocket.close()
+        if self.http is not None and not self.http.closed and self.http_loop is asyncio.get_running_loop():
+            await self.http.close()
+        self.http = None
+
+def parse_backends(raw: str) -> List[Dict[str, str]]:
+    """Parse the HASS_BACKENDS JSON list of additional Home Assistant instances"""
+    entries = json.loads(raw) if raw.strip() else []
+    if not isinstance(entries, list):
+        raise ValueError("HASS_BACKENDS must be a JSON list")
+    
+    names = set()
+    for entry in entries:
+        name = entry.get("name", "") if isinstance(entry, dict) else ""
+        if not BACKEND_NAME_PATTERN.fullmatch(name) or name in names:
+            raise ValueError(f"Invalid or duplicate backend name: {name!r}")
+        if not entry.get("url"):
+            raise ValueError(f"Backend {name} needs a url")
+        names.add(name)
+    return entries
+
+def build_backends(extra: List[Dict[str, str]]) -> Dict[str, HassBackend]:
+    """The default Supervisor-provided backend plus any configured extras"""
+    configured = {"": HassBackend("", HASS_URL, SUPERVISOR_TOKEN)}
+    for entry in extra:
+        configured[entry["name"]] = HassBackend(entry["name"], entry["url"], entry.get("token"))
+    return configured
+
+backends: Dict[str, HassBackend] = build_backends(parse_backends(HASS_BACKENDS))
+
+def split_script_id(script_id: str) -> Tuple[Optional[HassBackend], str]:
+    """Route a (possibly namespaced) script id to its backend and entity id"""
+    name, separator, entity_id = script_id.partition(":")
+    if separator and name in backends:
+        return backends[name], entity_id
+    return backends.get(""), script_id
+
+async def get_scripts() -> List[ScriptInfo]:
+    """Fetch all available scripts from every Home Assistant backend"""
+    catalogs = await asyncio.gather(*(backend.get_scripts() for backend in backends.values()))
+    scripts = [script for catalog in catalogs for script in catalog]
+    return sorted(scripts, key=lambda x: (x.backend, x.friendly_name.lower()))
+
+async def find_script(script_id: str) -> Optional[ScriptInfo]:
+    """Look a script up in its own backend's catalog only"""
+    backend, _ = split_script_id(script_id)
+    if backend is None:
+        return None
+    scripts = await backend.get_scripts()
+    return next((s for s in scripts if s.entity_id == script_id), None)
+
+# Token lifecycle events pushed to the UI over Server-Sent Events
+TOKEN_EVENT_CREATED = "created"
+TOKEN_EVENT_CONSUMED = "consumed"
+TOKEN_EVENT_EXPIRED = "expired"
+TOKEN_EVENT_REVOKED = "revoked"
+TOKEN_EVENT_EXTENDED = "extended"
+TOKEN_EVENT_EVICTED = "evicted"
+TOKEN_EVENT_RUN = "run"
+
+class TokenEventBroadcaster:
+    """In-process fan-out of token lifecycle events to SSE subscribers.
+
+    Each event is serialized once and handed to every matching subscriber
+    queue; a subscriber that falls behind loses events instead of slowing
+    down the request that published them.
+    """
+
+    def __init__(self, queue_size: int = 100):
+        self.queue_size = queue_size
+        self.subscribers: Dict[asyncio.Queue, Optional[str]] = {}
+
+    def subscribe(self, script_id: Optional[str] = None) -> asyncio.Queue:
+        """Register a subscriber, optionally filtered to one script"""
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        self.subscribers[queue] = script_id
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        """Remove a subscriber"""
+        self.subscribers.pop(queue, None)
+
+    def publish(self, event_type: str, script_id: str, **fields):
+        """Send an event to every subscriber interested in the script"""
+        if not self.subscribers:
+            return
+
+        event = {"type": event_type, "script_id": script_id, "timestamp": time.time(), **fields}
+        frame = f"data: {json.dumps(event)}\n\n"
+        for queue, script_filter in self.subscribers.items():
+            if script_filter and script_filter != script_id:
+                continue
+            try:
+                queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                pass
+
+event_broadcaster = TokenEventBroadcaster()
+
+# Audit events
+AUDIT_TOKEN_CREATED = "token_created"
+AUDIT_TOKEN_REDEEMED = "token_redeemed"
+AUDIT_TOKEN_REJECTED = "token_rejected"
+AUDIT_TOKENS_REVOKED = "tokens_revoked"
+AUDIT_TOKENS_EXPORTED = "tokens_exported"
+AUDIT_TOKENS_IMPORTED = "tokens_imported"
+AUDIT_TRIGGER_RESULT = "trigger_result"
+
+class NDJSONFile:
+    """Append-only NDJSON file, batched to disk by a background writer.
+
+    append() only puts a line on an in-memory queue. The writer flushes
+    every AUDIT_FLUSH_INTERVAL_SECONDS, or sooner when a batch fills up,
+    in a worker thread. The file is rotated to ``.1`` ... ``.N`` at
+    max_bytes. Flushes are serialized, so only one thread ever writes or
+    rotates the file.
+    """
+
+    def __init__(self, path: str, max_bytes: int, backups: int):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue: Deque[str] = deque(maxlen=AUDIT_QUEUE_SIZE)
+        self.wakeup: Optional[asyncio.Event] = None
+        self.lock: Optional[asyncio.Lock] = None
+        self.lock_loop: Optional[asyncio.AbstractEventLoop] = None
+        self.dropped = 0
+        self.written = 0
+
+    def append(self, entry: Dict):
+        """Queue one record"""
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append(json.dumps(entry, separators=(",", ":")) + "\n")
+        if self.wakeup is not None and len(self.queue) >= AUDIT_BATCH_SIZE:
+            self.wakeup.set()
+
+    async def run_forever(self):
+        """Background writer loop"""
+        self.wakeup = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), AUDIT_FLUSH_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """Write every queued record to disk"""
+        loop = asyncio.get_running_loop()
+        if self.lock_loop is not loop:
+            self.lock, self.lock_loop = asyncio.Lock(), loop
+        async with self.lock:
+            if not self.queue:
+                return
+            lines = list(self.queue)
+            self.queue.clear()
+            write = asyncio.ensure_future(asyncio.to_thread(self.write_batch, lines))
+            try:
+                await asyncio.shield(write)
+            except asyncio.CancelledError:
+                # The thread can't be stopped; hold the lock until its batch is on disk
+                await asyncio.wait({write})
+                raise
+            except OSError as e:
+                logger.error(f"Error writing {self.path}: {e}")
+
+    def write_batch(self, lines: List[str]):
+        data = "".join(lines).encode()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            size = self.path.stat().st_size
+        except FileNotFoundError:
+            size = 0
+        if size and size + len(data) > self.max_bytes:
+            self.rotate()
+        with open(self.path, "ab") as f:
+            f.write(data)
+        self.written += len(lines)
+
+    def rotate(self):
+        """Shift audit.ndjson -> .1 -> .2 ..., dropping the oldest"""
+        if self.backups == 0:
+            self.path.unlink(missing_ok=True)
+            return
+        self.backup(self.backups).unlink(missing_ok=True)
+        for index in range(self.backups - 1, 0, -1):
+            if self.backup(index).exists():
+                self.backup(index).replace(self.backup(index + 1))
+        self.path.replace(self.backup(1))
+
+    def backup(self, index: int) -> Path:
+        return self.path.with_name(f"{self.path.name}.{index}")
+
+    def files(self) -> List[Path]:
+        """Log files from oldest to newest"""
+        rotated = [self.backup(index) for index in range(self.backups, 0, -1)]
+        return [path for path in rotated + [self.path] if path.exists()]
+
+    def stats(self) -> Dict:
+        return {"queued": len(self.queue), "written": self.written, "dropped": self.dropped}
+
+class AuditLog(NDJSONFile):
+    """Audit trail of token and trigger events, kept while ENABLE_LOGGING is on"""
+
+    def record(self, event: str, **fields):
+        """Queue one audit record"""
+        if not ENABLE_LOGGING:
+            return
+        entry = {"ts": round(time.time(), 3), "event": event}
+        entry.update((key, value) for key, value in fields.items() if value is not None)
+        self.append(entry)
+
+    async def query(self, event: Optional[str] = None, script_id: Optional[str] = None,
+                    since: Optional[float] = None, limit: int = 1000) -> AsyncIterator[bytes]:
+        """Stream matching records oldest first, one chunk of lines per file.
+
+        Each file is read and filtered in a single worker thread call.
+        """
+        for path in self.files():
+            lines = await asyncio.to_thread(self.matching_lines, path, event, script_id, since, limit)
+            if lines:
+                yield b"".join(lines)
+            limit -= len(lines)
+            if limit <= 0:
+                return
+
+    def matching_lines(self, path: Path, event: Optional[str], script_id: Optional[str],
+                       since: Optional[float], limit: int) -> List[bytes]:
+        """Up to limit matching lines of one log file"""
+        matched: List[bytes] = []
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return matched  # rotated away while we were reading
+        with f:
+            for line in f:
+                # Cheap substring checks before paying for a JSON parse
+                if event and f'"event":"{event}"'.encode() not in line:
+                    continue
+                if script_id and script_id.encode() not in line:
+                    continue
+                if since is not None or script_id:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if since is not None and entry.get("ts", 0) < since:
+                        continue
+                    if script_id and entry.get("script_id") != script_id:
+                        continue
+                matched.append(line)
+                if len(matched) >= limit:
+                    break
+        return matched
+
+audit_log = AuditLog(AUDIT_LOG_PATH, AUDIT_LOG_MAX_MB * 1024 * 1024, AUDIT_LOG_BACKUPS)
+
+# Span of the sampled request being handled in this context, if any
+current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+
+class Span:
+    """One timed phase of a sampled request; use as a context manager"""
+
+    __slots__ = ("tracer", "trace_id", "span_id", "parent_id", "name", "kind",
+                 "started_at", "started", "duration", "tags", "context_token")
+
+    def __init__(self, tracer: "Tracer", name: str, trace_id: str, parent_id: Optional[str] = None,
+                 kind: Optional[str] = None, tags: Optional[Dict] = None):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.tags = tags or {}
+        self.duration = 0.0
+
+    def __enter__(self) -> "Span":
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.context_token = current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.started
+        current_span.reset(self.context_token)
+        if exc_type is not None:
+            self.tags["error"] = exc_type.__name__
+        self.tracer.finish(self)
+        return False
+
+    def to_zipkin(self) -> Dict:
+        """Zipkin v2 JSON form"""
+        span = {
+            "traceId": self.trace_id,
+            "id": self.span_id,
+            "name": self.name,
+            "timestamp": int(self.started_at * 1_000_000),
+            "duration": max(1, int(self.duration * 1_000_000)),
+            "localEndpoint": {"serviceName": TRACE_SERVICE_NAME},
+            "tags": {key: str(value) for key, value in self.tags.items()},
+        }
+        if self.parent_id:
+            span["parentId"] = self.parent_id
+        if self.kind:
+            span["kind"] = self.kind
+        return span
+
+class Tracer:
+    """Sampled request tracing into a ring buffer, optionally exported as Zipkin v2 NDJSON.
+
+    Only requests picked by sample_rate get a root span; span() anywhere
+    below it records a child, and is a shared no-op context otherwise.
+    """
+
+    def __init__(self, sample_rate: float, export_path: str = "", buffer_size: int = TRACE_BUFFER_SIZE):
+        self.sample_rate = sample_rate
+        self.spans: Deque[Span] = deque(maxlen=buffer_size)
+        self.exporter: Optional[NDJSONFile] = None
+        self.set_export_path(export_path)
+
+    def set_export_path(self, export_path: str):
+        """Export to a file from now on; call before the exporter's writer task starts"""
+        self.exporter = NDJSONFile(export_path, TRACE_EXPORT_MAX_BYTES, 1) if export_path else None
+
+    def start_trace(self, name: str, **tags) -> Optional[Span]:
+        """Root span for a new request, or None when it isn't sampled"""
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        return Span(self, name, secrets.token_hex(16), kind="SERVER", tags=tags)
+
+    def span(self, name: str, **tags):
+        """Child span of the current one, if this request is being traced"""
+        parent = current_span.get()
+        if parent is None:
+            return contextlib.nullcontext()
+        return Span(self, name, parent.trace_id, parent.span_id, tags=tags)
+
+    def record(self, name: str, parent: Span, started_at: float, duration: float, **tags):
+        """Add a span measured outside a with-block"""
+        span = Span(self, name, parent.trace_id, parent.span_id, tags=tags)
+        span.started_at = started_at
+        span.duration = duration
+        self.finish(span)
+
+    def finish(self, span: Span):
+        self.spans.append(span)
+        if self.exporter is not None:
+            self.exporter.append(span.to_zipkin())
+
+    def traces(self, limit: int = 20) -> List[Dict]:
+        """Most recent traces first, each with its spans in start order"""
+        grouped: Dict[str, List[Span]] = {}
+        for span in reversed(self.spans):
+            if span.trace_id not in grouped and len(grouped) >= limit:
+                continue
+            grouped.setdefault(span.trace_id, []).append(span)
+        return [
+            {
+                "trace_id": trace_id,
+                "spans": [span.to_zipkin() for span in sorted(spans, key=lambda span: span.started_at)],
+            }
+            for trace_id, spans in grouped.items()
+        ]
+
+tracer = Tracer(TRACE_SAMPLE_RATE, TRACE_EXPORT_PATH)
+
+class IdempotencyEntry(NamedTuple):
+    fingerprint: bytes
+    response: asyncio.Future
+    expires_at: float
+    token_ids: List[str]
+
+class IdempotencyCache:
+    """Bounded, TTL-evicting map of Idempotency-Key to /api/generate response.
+
+    Responses carry redeemable URLs, so they are only kept for a short retry
+    window, and dropped as soon as a token they minted is used or removed.
+    A retry that arrives while the first request is still running waits for
+    it instead of minting a second token.
+    """
+
+    def __init__(self, max_entries: int = IDEMPOTENCY_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, IdempotencyEntry]" = OrderedDict()
+        self.keys_by_token: Dict[str, str] = {}
+
+    def evict(self):
+        """Drop expired entries and trim the cache to its size limit"""
+        now = time.time()
+        while self.entries:
+            key, entry = next(iter(self.entries.items()))
+            if entry.expires_at >= now and len(self.entries) <= self.max_entries:
+                break
+            self.drop(key)
+
+    def drop(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for minted in entry.token_ids:
+            if self.keys_by_token.get(minted) == key:
+                del self.keys_by_token[minted]
+
+    def forget_token(self, minted: str):
+        """Drop the response that minted a token once the token is used or gone"""
+        key = self.keys_by_token.pop(minted, None)
+        if key is not None:
+            self.drop(key)
+
+    async def run(self, key: str, payload: Any, factory: Callable[[], Awaitable[Dict]]) -> Dict:
+        """Return the cached response for key, or compute and cache it"""
+        fingerprint = hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).digest()
+        
+        while True:
+            self.evict()
+            entry = self.entries.get(key)
+            if entry is None or entry.expires_at < time.time():
+                break
+            if entry.fingerprint != fingerprint:
+                raise HTTPException(
+                    status_code=422,
+                    detail="Idempotency-Key was already used with a different request"
+                )
+            response = await asyncio.shield(entry.response)
+            if response is not None:
+                return response
+            # The original request failed and released the key; try again ourselves
+        
+        entry = IdempotencyEntry(
+            fingerprint=fingerprint,
+            response=asyncio.get_running_loop().create_future(),
+            expires_at=time.time() + IDEMPOTENCY_RETRY_SECONDS,
+            token_ids=[]
+        )
+        self.entries[key] = entry
+        self.evict()
+        try:
+            response = await factory()
+        except BaseException:
+            # Failed requests are not cached, so the client can retry them
+            if self.entries.get(key) is entry:
+                self.drop(key)
+            entry.response.set_result(None)
+            raise
+        
+        entry.response.set_result(response)
+        if self.entries.get(key) is entry:
+            # Batch responses list their tokens under "results"
+            for item in response.get("results", [response]):
+                if "token_id" in item:
+                    entry.token_ids.append(item["token_id"])
+                    self.keys_by_token[item["token_id"]] = key
+        return response
+
+idempotency_cache = IdempotencyCache()
+
+def mask_token(token: str) -> str:
+    """Shorten a token for logs"""
+    return token[:8] + "..."
+
+def hash_token(token: str) -> Tuple[bytes, bytes]:
+    """Split a token's digest into its store selector and verifier"""
+    digest = hashlib.sha256(token.encode()).digest()
+    return digest[:TOKEN_SELECTOR_SIZE], digest[TOKEN_SELECTOR_SIZE:]
+
+def token_id(selector: bytes) -> str:
+    """Public, non-redeemable identifier of a stored token"""
+    return selector.hex()
 
 def generate_token() -> str:
     """Generate a cryptographically secure token"""
     return secrets.token_urlsafe(32)
 
-def create_token(script_id: str) -> Tuple[str, TokenData]:
+def create_token(script_id: str, max_uses: int = 1, min_interval_seconds: float = 0,
+                 delay_seconds: float = 0) -> Tuple[str, TokenData]:
     """Create a new token for a script"""
     token = generate_token()
+    selector, verifier = hash_token(token)
+    while selector in tokens:
+        token = generate_token()
+        selector, verifier = hash_token(token)
+    
     now = time.time()
     expires_at = now + (TOKEN_EXPIRY_MINUTES * 60)
     
-    token_data = TokenData(
+    record = TokenRecord(
+        verifier=verifier,
         script_id=script_id,
         created_at=now,
-        expires_at=expires_at
+        expires_at=expires_at,
+        max_uses=max_uses,
+        min_interval_seconds=min_interval_seconds,
+        delay_seconds=delay_seconds
     )
     
-    tokens[token] = token_data.dict()
-    
-    # Clean up expired tokens
-    cleanup_expired_tokens()
+    store_token(selector, record)
+    event_broadcaster.publish(
+        TOKEN_EVENT_CREATED,
+        script_id,
+        token_id=token_id(selector),
+        expires_at=expires_at
+    )
+    audit_log.record(
+        AUDIT_TOKEN_CREATED,
+        script_id=script_id,
+        token_id=token_id(selector),
+        expires_at=round(expires_at, 3),
+        max_uses=max_uses,
+        delay_seconds=delay_seconds or None
+    )
     
-    return token, token_data
+    return token, record.to_token_data()
+
+def store_token(selector: bytes, record: TokenRecord):
+    """Insert a record into the store and the per-script index"""
+    global token_store_bytes
+    previous = tokens.get(selector)
+    if previous is not None:
+        token_store_bytes -= record_bytes(selector, previous)
+    tokens[selector] = record
+    token_store_bytes += record_bytes(selector, record)
+    script_index.setdefault(record.script_id, set()).add(selector)
+    index_expiry(selector, record)
+    if record.used:
+        used_tokens[selector] = None
+
+def index_expiry(selector: bytes, record: TokenRecord):
+    """(Re)index a token under its current expiry"""
+    global expiry_heap
+    heapq.heappush(expiry_heap, (record.expires_at, selector))
+    if len(expiry_heap) > 2 * len(tokens) + 64:
+        expiry_heap = [(record.expires_at, selector) for selector, record in tokens.items()]
+        heapq.heapify(expiry_heap)
+
+def next_expiring(deadline: float) -> Optional[bytes]:
+    """The token expiring soonest, if it expires by deadline"""
+    while expiry_heap:
+        expires_at, selector = expiry_heap[0]
+        record = tokens.get(selector)
+        if record is None or record.expires_at != expires_at:
+            heapq.heappop(expiry_heap)
+            continue
+        return selector if expires_at <= deadline else None
+    return None
+
+def remove_token(selector: bytes) -> Optional[TokenRecord]:
+    """Remove a record from the store and the per-script index"""
+    global token_store_bytes
+    record = tokens.pop(selector, None)
+    if record is not None:
+        token_store_bytes -= record_bytes(selector, record)
+        used_tokens.pop(selector, None)
+        idempotency_cache.forget_token(token_id(selector))
+        selectors = script_index.get(record.script_id)
+        if selectors is not None:
+            selectors.discard(selector)
+            if not selectors:
+                del script_index[record.script_id]
+    return record
+
+def count_script_tokens(script_id: str) -> int:
+    """Count unexpired tokens of one script using the per-script index"""
+    now = time.time()
+    return sum(1 for selector in script_index.get(script_id, ()) if tokens[selector].expires_at > now)
 
 def cleanup_expired_tokens():
-    """Remove expired tokens from memory"""
+    """Remove expired tokens from memory, soonest expired first via the expiry index"""
     now = time.time()
-    expired_tokens = [
-        token for token, data in tokens.items()
-        if data["expires_at"] < now
-    ]
-    for token in expired_tokens:
-        del tokens[token]
+    while True:
+        selector = next_expiring(now)
+        if selector is None:
+            break
+        record = remove_token(selector)
+        event_broadcaster.publish(TOKEN_EVENT_EXPIRED, record.script_id, token_id=token_id(selector))
+
+def token_store_full(extra_bytes: int = 0) -> bool:
+    """Whether one more token would exceed the global count or memory cap"""
+    return (len(tokens) >= MAX_TOKENS_TOTAL
+            or token_store_bytes + extra_bytes > MAX_TOKEN_STORE_KB * 1024)
+
+def make_room_for_token() -> bool:
+    """Evict tokens until one more fits under the global caps.
+
+    Fully used tokens go first, then expired ones, then tokens that expire
+    within TOKEN_EVICTION_GRACE_SECONDS, soonest first. Tokens with a
+    comfortable amount of time left are never evicted; returns False when
+    the store is still full.
+    """
+    extra_bytes = NEW_TOKEN_BYTES
+    if not token_store_full(extra_bytes):
+        return True
+    
+    while used_tokens and token_store_full(extra_bytes):
+        selector = next(iter(used_tokens))
+        record = remove_token(selector)
+        event_broadcaster.publish(TOKEN_EVENT_EVICTED, record.script_id, token_id=token_id(selector))
+    if not token_store_full(extra_bytes):
+        return True
+    
+    cleanup_expired_tokens()
+    deadline = time.time() + TOKEN_EVICTION_GRACE_SECONDS
+    while token_store_full(extra_bytes):
+        selector = next_expiring(deadline)
+        if selector is None:
+            break
+        record = remove_token(selector)
+        event_broadcaster.publish(TOKEN_EVENT_EVICTED, record.script_id, token_id=token_id(selector))
+    return not token_store_full(extra_bytes)
+
+def find_token(token: str) -> Tuple[Optional[bytes], Optional[TokenRecord]]:
+    """Look up a token's record, verifying its digest in constant time"""
+    selector, verifier = hash_token(token)
+    record = tokens.get(selector)
+    if record is None or not hmac.compare_digest(record.verifier, verifier):
+        return None, None
+    
+    if record.expires_at < time.time():
+        remove_token(selector)
+        event_broadcaster.publish(TOKEN_EVENT_EXPIRED, record.script_id, token_id=token_id(selector))
+        return None, None
+    
+    return selector, record
 
 def get_token_data(token: str) -> Optional[TokenData]:
     """Get token data if valid and not expired"""
-    if token not in tokens:
+    _, record = find_token(token)
+    if record is None:
         return None
     
-    data = tokens[token]
-    if data["expires_at"] < time.time():
-        del tokens[token]
-        return None
+    return record.to_token_data()
+
+def claim_token_use(token: str) -> Tuple[Optional[TokenData], Optional[str]]:
+    """Atomically record one use of a token.
+
+    Runs without awaiting, so concurrent redemptions of the same token
+    cannot both pass the checks. Returns the token data after the claim,
+    or an error message when the token cannot be used right now.
+    """
+    selector, record = find_token(token)
+    if record is None:
+        return None, "Invalid or expired token"
+    
+    if record.used:
+        return None, "Token has already been used"
     
-    return TokenData(**data)
+    now = time.time()
+    last_used_at = record.last_used_at
+    if last_used_at is not None and now - last_used_at < record.min_interval_seconds:
+        wait_seconds = math.ceil(record.min_interval_seconds - (now - last_used_at))
+        return None, f"Token was used too recently, try again in {wait_seconds} seconds"
+    
+    record.uses += 1
+    record.last_used_at = now
+    if record.used:
+        used_tokens[selector] = None
+    idempotency_cache.forget_token(token_id(selector))
+    return record.to_token_data(), None
 
-async def trigger_script(script_id: str) -> bool:
-    """Trigger a script via Home Assistant API"""
-    try:
-        async with aiohttp.ClientSession() as session:
-            headers = await get_hass_headers()
-            payload = {"entity_id": script_id}
-            
-            async with session.post(
-                f"{HASS_URL}/api/services/script/turn_on",
-                headers=headers,
-                json=payload
-            ) as response:
-                success = response.status == 200
-                if ENABLE_LOGGING:
-                    logger.info(f"Script {script_id} triggered: {'SUCCESS' if success else 'FAILED'}")
-                return success
-    except Exception as e:
-        logger.error(f"Error triggering script {script_id}: {e}")
+def select_tokens(script_id: Optional[str] = None, token_ids: Optional[List[str]] = None,
+                  created_before: Optional[float] = None) -> List[bytes]:
+    """Select stored tokens by id, by script (via the index) and/or by creation time"""
+    if token_ids is not None:
+        candidates = [selector for selector in map(bytes.fromhex, token_ids) if selector in tokens]
+        if script_id is not None:
+            candidates = [selector for selector in candidates if tokens[selector].script_id == script_id]
+    elif script_id is not None:
+        candidates = list(script_index.get(script_id, ()))
+    else:
+        candidates = list(tokens)
+    
+    if created_before is not None:
+        candidates = [selector for selector in candidates if tokens[selector].created_at < created_before]
+    return candidates
+
+def group_by_script(selectors: Iterable[bytes], records: Dict[bytes, TokenRecord]) -> Dict[str, List[str]]:
+    """Group token ids by script so each script gets one event per operation"""
+    groups: Dict[str, List[str]] = {}
+    for selector in selectors:
+        groups.setdefault(records[selector].script_id, []).append(token_id(selector))
+    return groups
+
+def revoke_tokens(selectors: List[bytes]) -> int:
+    """Remove tokens before they expire, in one pass over the selection"""
+    removed = {}
+    for selector in selectors:
+        record = remove_token(selector)
+        if record is not None:
+            removed[selector] = record
+    
+    for script_id, ids in group_by_script(removed, removed).items():
+        event_broadcaster.publish(TOKEN_EVENT_REVOKED, script_id, token_ids=ids)
+        audit_log.record(AUDIT_TOKENS_REVOKED, script_id=script_id, token_ids=ids)
+    return len(removed)
+
+def extend_tokens(selectors: List[bytes], seconds: float) -> int:
+    """Push back the expiry of the selected tokens, in one pass.
+
+    A token's lifetime never grows past the token expiry plus
+    MAX_EXTEND_MINUTES in total, however often it is extended; tokens
+    already at that limit are left alone.
+    """
+    now = time.time()
+    extended: Dict[float, List[bytes]] = {}
+    for selector in selectors:
+        record = tokens[selector]
+        if record.expires_at < now:
+            continue
+        latest = record.created_at + (TOKEN_EXPIRY_MINUTES + MAX_EXTEND_MINUTES) * 60
+        added = min(seconds, latest - record.expires_at)
+        if added > 0:
+            record.expires_at += added
+            index_expiry(selector, record)
+            extended.setdefault(added, []).append(selector)
+    
+    for added, group in extended.items():
+        for script_id, ids in group_by_script(group, tokens).items():
+            event_broadcaster.publish(TOKEN_EVENT_EXTENDED, script_id, token_ids=ids, extended_by_seconds=added)
+    return sum(map(len, extended.values()))
+
+async def call_trigger_script(script_id: str) -> bool:
+    """Call script/turn_on on the backend the script belongs to"""
+    backend, entity_id = split_script_id(script_id)
+    if backend is None:
+        logger.error(f"No Home Assistant backend for script {script_id}")
         return False
+    with tracer.span("hass.call", backend=backend.label, websocket=USE_WEBSOCKET):
+        return await backend.trigger(entity_id)
 
-@app.get("/", response_class=HTMLResponse)
-async def home(request: Request):
-    """Main addon interface"""
-    scripts = await get_scripts()
-    return templates.TemplateResponse(
-        "index.html",
-        {"request": request, "scripts": scripts}
-    )
+class ConcurrencyLimiter:
+    """A semaphore whose limit can be changed while tasks hold or wait for it"""
 
-@app.post("/api/generate")
-async def generate_url(request: Request):
-    """Generate a temporary URL for a script"""
-    try:
-        data = await request.json()
-        script_id = data.get("script_id")
-        
-        if not script_id:
-            raise HTTPException(status_code=400, detail="script_id is required")
-        
-        # Check if script exists
-        scripts = await get_scripts()
-        script_exists = any(s.entity_id == script_id for s in scripts)
-        if not script_exists:
-            raise HTTPException(status_code=404, detail="Script not found")
-        
-        # Check token limit per script
-        script_tokens = [t for t in tokens.values() if t["script_id"] == script_id and t["expires_at"] > time.time()]
-        if len(script_tokens) >= MAX_TOKENS_PER_SCRIPT:
-            raise HTTPException(
-                status_code=429, 
-                detail=f"Maximum tokens ({MAX_TOKENS_PER_SCRIPT}) reached for this script"
-            )
-        
-        token, token_data = create_token(script_id)
+    def __init__(self, limit: int):
+        self.limit = max(1, limit)
+        self.active = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+
+    @property
+    def idle(self) -> bool:
+        return self.active == 0 and not self.waiters
+
+    async def acquire(self):
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            return
         
-        # Generate the trigger URL
-        base_url = str(request.base_url).rstrip('/')
-        trigger_url = f"{base_url}/trigger/{token}"
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            else:
+                self.waiters.remove(waiter)
+            raise
+
+    def release(self):
+        self.active -= 1
+        self.wake()
+
+    def set_limit(self, limit: int):
+        self.limit = max(1, limit)
+        self.wake()
+
+    def wake(self):
+        while self.waiters and self.active < self.limit:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.active += 1
+                waiter.set_result(None)
+
+class UpstreamLimiter:
+    """Global and per-script limits on concurrent Home Assistant calls.
+
+    In adaptive mode the global limit follows AIMD: it grows by about one
+    slot per round of fast, successful calls and halves when a call fails
+    or is slower than ADAPTIVE_LATENCY_TARGET_SECONDS, never exceeding the
+    configured maximum.
+    """
+
+    def __init__(self, max_limit: int, per_script_limit: int, adaptive: bool = False):
+        self.max_limit = max(1, max_limit)
+        self.per_script_limit = max(1, per_script_limit)
+        self.adaptive = adaptive
+        self.adaptive_limit = float(max(1, self.max_limit // 2) if adaptive else self.max_limit)
+        self.global_limiter = ConcurrencyLimiter(int(self.adaptive_limit))
+        self.script_limiters: Dict[str, ConcurrencyLimiter] = {}
+        self.last_decrease = 0.0
+        self.calls = 0
+        self.failures = 0
+        self.latency_ewma = 0.0
+        self.queue_waits: Deque[float] = deque(maxlen=QUEUE_WAIT_SAMPLES)
+        self.max_queue_wait = 0.0
+
+    def configure(self, max_limit: int, per_script_limit: int, adaptive: bool):
+        """Apply new limits to current and future calls"""
+        self.max_limit = max(1, max_limit)
+        self.per_script_limit = max(1, per_script_limit)
+        self.adaptive = adaptive
+        self.adaptive_limit = min(self.adaptive_limit, self.max_limit) if adaptive else float(self.max_limit)
+        self.global_limiter.set_limit(int(self.adaptive_limit))
+        for limiter in self.script_limiters.values():
+            limiter.set_limit(self.per_script_limit)
+
+    async def run(self, script_id: str, call: Callable[[], Awaitable[bool]]) -> bool:
+        """Run an upstream call once both the script and global limits allow it"""
+        queued_at = time.monotonic()
+        script_limiter = self.script_limiters.get(script_id)
+        if script_limiter is None:
+            script_limiter = self.script_limiters[script_id] = ConcurrencyLimiter(self.per_script_limit)
         
-        if ENABLE_LOGGING:
-            logger.info(f"Generated token for script {script_id}: {token[:8]}...")
+        await script_limiter.acquire()
+        try:
+            await self.global_limiter.acquire()
+            try:
+                started_at = time.monotonic()
+                self.record_queue_wait(started_at - queued_at)
+                success = await call()
+                self.record_result(time.monotonic() - started_at, success)
+                return success
+            finally:
+                self.global_limiter.release()
+        finally:
+            script_limiter.release()
+            if script_limiter.idle:
+                self.script_limiters.pop(script_id, None)
+
+    def pending(self) -> int:
+        """Calls running or queued, including those still waiting for a per-script slot"""
+        return (self.global_limiter.active + len(self.global_limiter.waiters)
+                + sum(len(limiter.waiters) for limiter in self.script_limiters.values()))
+
+    def record_queue_wait(self, waited: float):
+        self.queue_waits.append(waited)
+        self.max_queue_wait = max(self.max_queue_wait, waited)
+
+    def record_result(self, latency: float, success: bool):
+        self.calls += 1
+        if not success:
+            self.failures += 1
+        self.latency_ewma = latency if self.calls == 1 else 0.9 * self.latency_ewma + 0.1 * latency
+        if not self.adaptive:
+            return
         
+        now = time.monotonic()
+        if success and latency <= ADAPTIVE_LATENCY_TARGET_SECONDS:
+            self.adaptive_limit = min(self.max_limit, self.adaptive_limit + 1 / self.adaptive_limit)
+        elif now - self.last_decrease > max(latency, 1.0):
+            # Back off at most once per round trip so one slow burst halves the limit once
+            self.adaptive_limit = max(1.0, self.adaptive_limit / 2)
+            self.last_decrease = now
+        self.global_limiter.set_limit(int(self.adaptive_limit))
+
+    def metrics(self) -> Dict:
+        waits = sorted(self.queue_waits)
         return {
-            "token": token,
-            "url": trigger_url,
-            "expires_at": datetime.fromtimestamp(token_data.expires_at).isoformat(),
-            "expires_in_minutes": TOKEN_EXPIRY_MINUTES
+            "limit": self.global_limiter.limit,
+            "max_limit": self.max_limit,
+            "per_script_limit": self.per_script_limit,
+            "adaptive": self.adaptive,
+            "active": self.global_limiter.active,
+            "queued": len(self.global_limiter.waiters) + sum(
+                len(limiter.waiters) for limiter in self.script_limiters.values()
+            ),
+            "calls": self.calls,
+            "failures": self.failures,
+            "latency_seconds_ewma": round(self.latency_ewma, 4),
+            "queue_wait_seconds": {
+                "avg": round(sum(waits) / len(waits), 4) if waits else 0.0,
+                "p95": round(waits[int(len(waits) * 0.95)], 4) if waits else 0.0,
+                "max": round(self.max_queue_wait, 4),
+            },
         }
-    
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"Error generating URL: {e}")
-        raise HTTPException(status_code=500, detail="Internal server error")
 
-@app.get("/trigger/{token}")
-async def trigger_script_url(token: str, request: Request):
-    """Trigger a script via token URL"""
-    # Get token data
-    token_data = get_token_data(token)
-    if not token_data:
+upstream_limiter = UpstreamLimiter(MAX_CONCURRENT_TRIGGERS, MAX_CONCURRENT_PER_SCRIPT, ADAPTIVE_CONCURRENCY)
+
+# Script run states
+RUN_SCHEDULED = "scheduled"
+RUN_TRIGGERED = "triggered"
+RUN_STARTED = "started"
+RUN_FINISHED = "finished"
+RUN_FAILED = "failed"
+RUN_DONE = (RUN_FINISHED, RUN_FAILED)
+
+class ScriptRun:
+    """The latest run started through one token"""
+
+    __slots__ = ("token_id", "script_id", "status", "error", "triggered_at", "accepted_at",
+                 "started_at", "finished_at", "changed")
+
+    def __init__(self, token_id: str, script_id: str, status: str):
+        self.token_id = token_id
+        self.script_id = script_id
+        self.status = status
+        self.error: Optional[str] = None
+        self.triggered_at: Optional[float] = None
+        self.accepted_at: Optional[float] = None
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.changed: Optional[asyncio.Event] = None
+
+    def to_dict(self) -> Dict:
+        def iso(ts: Optional[float]) -> Optional[str]:
+            return datetime.fromtimestamp(ts).isoformat() if ts else None
+        return {
+            "token_id": self.token_id,
+            "script_id": self.script_id,
+            "status": self.status,
+            "error": self.error,
+            "triggered_at": iso(self.triggered_at),
+            "started_at": iso(self.started_at),
+            "finished_at": iso(self.finished_at),
+        }
+
+def running_count(state: Dict) -> int:
+    """Number of runs a script state reports (the ``current`` attribute of a running script)"""
+    if state.get("state") != "on":
+        return 0
+    return int((state.get("attributes") or {}).get("current") or 1)
+
+class ScriptWatch:
+    """A backend's state trigger subscription on the scripts runs were tracked for"""
+
+    __slots__ = ("ws", "subscription", "entity_ids", "wanted", "refresh", "keeper")
+
+    def __init__(self):
+        self.ws: Optional[aiohttp.ClientWebSocketResponse] = None
+        self.subscription: Optional[int] = None
+        self.entity_ids: Set[str] = set()
+        self.wanted: Set[str] = set()
+        self.refresh: Optional[asyncio.Task] = None
+        self.keeper: Optional[asyncio.Task] = None
+
+class ScriptRunTracker:
+    """Follows token-triggered script runs to completion.
+
+    Each backend keeps one ``subscribe_trigger`` subscription on its shared
+    WebSocket, however many clients are waiting. It only covers the script
+    entities that runs were tracked for, and is widened before a new script
+    is first triggered, so other entities' state changes never reach the
+    add-on. A script turning on (or its ``current`` count going up) starts
+    the oldest triggered run of that script, and turning off finishes its
+    running ones. Home Assistant does not tell who started a run, so a run
+    started elsewhere at the same time can be credited to a token. Runs
+    that are never seen starting fail after RUN_START_TIMEOUT_SECONDS.
+    """
+
+    def __init__(self, history_size: int = RUN_HISTORY_SIZE):
+        self.history_size = history_size
+        self.runs: "OrderedDict[str, ScriptRun]" = OrderedDict()
+        self.waiting: Dict[str, Deque[ScriptRun]] = {}
+        self.running: Dict[str, Deque[ScriptRun]] = {}
+        self.watches: Dict[str, ScriptWatch] = {}
+        self.last_changed: Dict[str, Any] = {}
+        self.subscribed: Set[str] = set()
+
+    def get(self, token_id: str) -> Optional[ScriptRun]:
+        return self.runs.get(token_id)
+
+    def add(self, token_id: str, script_id: str, status: str) -> ScriptRun:
+        """Record a new run for a token, replacing its previous one"""
+        run = ScriptRun(token_id, script_id, status)
+        self.runs.pop(token_id, None)
+        self.runs[token_id] = run
+        while len(self.runs) > self.history_size:
+            self.runs.popitem(last=False)
+        return run
+
+    def update(self, run: ScriptRun, status: str, error: Optional[str] = None):
+        """Move a run to a new state and wake anyone waiting on it"""
+        now = time.time()
+        run.status = status
+        run.error = error
+        if status == RUN_STARTED:
+            run.started_at = now
+        elif status in RUN_DONE:
+            run.finished_at = now
+        if run.changed is not None:
+            run.changed.set()
+            run.changed = None
+        event_broadcaster.publish(TOKEN_EVENT_RUN, run.script_id, token_id=run.token_id, status=status, error=error)
+
+    def triggered(self, token_id: str, script_id: str) -> ScriptRun:
+        """Register a run before its call goes out, so a fast start event can't be missed"""
+        run = self.runs.get(token_id)
+        if run is None or run.status != RUN_SCHEDULED:
+            run = self.add(token_id, script_id, RUN_TRIGGERED)
+        run.triggered_at = time.time()
+        self.update(run, RUN_TRIGGERED)
+        self.waiting.setdefault(script_id, deque()).append(run)
+        return run
+
+    def call_result(self, run: ScriptRun, success: bool):
+        """Record whether Home Assistant accepted the turn_on call"""
+        if success:
+            run.accepted_at = time.time()
+            return
+        self.discard(self.waiting, run)
+        if run.status not in RUN_DONE:
+            self.update(run, RUN_FAILED, error="Home Assistant rejected the call")
+
+    def discard(self, queues: Dict[str, Deque[ScriptRun]], run: ScriptRun):
+        queue = queues.get(run.script_id)
+        if queue is None:
+            return
+        with contextlib.suppress(ValueError):
+            queue.remove(run)
+        if not queue:
+            del queues[run.script_id]
+
+    def start(self, script_id: str, count: int):
+        waiting = self.waiting.get(script_id)
+        while waiting and count > 0:
+            run = waiting.popleft()
+            self.running.setdefault(script_id, deque()).append(run)
+            self.update(run, RUN_STARTED)
+            count -= 1
+        if waiting is not None and not waiting:
+            del self.waiting[script_id]
+
+    def finish(self, script_id: str, count: Optional[int] = None):
+        """Finish the oldest running runs of a script, or all of them"""
+        running = self.running.get(script_id)
+        while running and (count is None or count > 0):
+            self.update(running.popleft(), RUN_FINISHED)
+            if count is not None:
+                count -= 1
+        if running is not None and not running:
+            del self.running[script_id]
+
+    def fail(self, script_id: str, error: str):
+        for queues in (self.waiting, self.running):
+            for run in queues.pop(script_id, ()):
+                self.update(run, RUN_FAILED, error=error)
+
+    def handle_trigger(self, backend: HassBackend, event: Dict):
+        """State trigger handler; only scripts with tracked runs are looked at"""
+        trigger = (event.get("variables") or {}).get("trigger") or {}
+        script_id = backend.script_id(trigger.get("entity_id") or "")
+        if script_id not in self.waiting and script_id not in self.running:
+            return
+        
+        new_state = trigger.get("to_state")
+        # While a subscription is being widened, old and new both deliver the change
+        changed = (new_state or {}).get("last_updated")
+        if changed and self.last_changed.get(script_id) == changed:
+            return
+        self.last_changed[script_id] = changed
+        
+        if new_state is None or new_state.get("state") == "unavailable":
+            self.fail(script_id, f"Script {'is unavailable' if new_state else 'was removed'}")
+            return
+        now_running = running_count(new_state)
+        change = now_running - running_count(trigger.get("from_state") or {})
+        if change > 0:
+            self.start(script_id, change)
+        elif now_running == 0:
+            self.finish(script_id)
+        elif change < 0:
+            self.finish(script_id, -change)
+
+    def reconcile(self, backend: HassBackend, states: List[Dict]):
+        """Finish runs of scripts that stopped while the subscription was down"""
+        for state in states:
+            script_id = backend.script_id(state.get("entity_id", ""))
+            if script_id in self.running and running_count(state) == 0:
+                self.finish(script_id)
+
+    def expire_stale(self, now: float):
+        """Fail accepted runs that never started, and forget them where runs aren't followed"""
+        cutoff = now - RUN_START_TIMEOUT_SECONDS
+        for script_id, waiting in list(self.waiting.items()):
+            backend, _ = split_script_id(script_id)
+            followed = backend is not None and backend.name in self.subscribed
+            for run in [run for run in waiting if run.accepted_at and run.accepted_at < cutoff]:
+                self.discard(self.waiting, run)
+                if followed:
+                    self.update(run, RUN_FAILED, error="Script did not start")
+
+    async def wait(self, run: ScriptRun, seen: Optional[str], timeout: float) -> ScriptRun:
+        """Wait until a run is done, or has left the state the client last saw"""
+        deadline = time.monotonic() + timeout
+        while run.status not in RUN_DONE and (seen is None or run.status == seen):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if run.changed is None:
+                run.changed = asyncio.Event()
+            try:
+                await asyncio.wait_for(run.changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        return run
+
+    def has_open_runs(self, backend: HassBackend) -> bool:
+        return any(
+            split_script_id(script_id)[0] is backend
+            for queues in (self.waiting, self.running) for script_id in queues
+        )
+
+    async def watch(self, script_id: str) -> bool:
+        """Make sure a script's state changes reach the tracker before it is triggered.
+
+        Triggers don't queue behind each other: every trigger waiting on the
+        same backend shares one refresh of its subscription, and none waits
+        longer than RUN_WATCH_TIMEOUT_SECONDS. A refresh that takes longer
+        keeps going in the background.
+        """
+        backend, entity_id = split_script_id(script_id)
+        if backend is None or not TRACK_SCRIPT_RUNS:
+            return False
+        watch = self.watches.setdefault(backend.name, ScriptWatch())
+        watch.wanted.add(entity_id)
+        deadline = time.monotonic() + RUN_WATCH_TIMEOUT_SECONDS
+        try:
+            # A refresh that finished just before this entity was wanted doesn't cover it
+            while not self.covers(backend, watch, {entity_id}):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                await asyncio.wait_for(asyncio.shield(self.refresh(backend, watch)), remaining)
+            return True
+        except asyncio.TimeoutError:
+            if ENABLE_LOGGING:
+                logger.warning(f"Script run tracking on {backend.label} is still subscribing")
+            return False
+        except Exception as e:
+            if ENABLE_LOGGING:
+                logger.warning(f"Script run tracking on {backend.label} unavailable: {e!r}")
+            return False
+
+    def covers(self, backend: HassBackend, watch: ScriptWatch, entity_ids: Set[str]) -> bool:
+        """Whether the live subscription already includes these entities"""
+        websocket = backend.websocket
+        return watch.ws is websocket.ws and websocket.connected and entity_ids <= watch.entity_ids
+
+    def refresh(self, backend: HassBackend, watch: ScriptWatch) -> asyncio.Task:
+        """The backend's running subscription refresh, started if there is none"""
+        if watch.refresh is None or watch.refresh.done():
+            watch.refresh = asyncio.create_task(self.resubscribe(backend, watch))
+            # Nobody may be left waiting for it; don't warn about an unretrieved error
+            watch.refresh.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return watch.refresh
+
+    async def resubscribe(self, backend: HassBackend, watch: ScriptWatch):
+        """Subscribe until every wanted entity is covered.
+
+        Waits briefly first so a burst of first triggers ends up in one
+        subscription, and folds in entities wanted while a call is out.
+        """
+        await asyncio.sleep(RUN_WATCH_DEBOUNCE_SECONDS)
+        while not self.covers(backend, watch, watch.wanted):
+            await self.subscribe(backend, watch, watch.entity_ids | watch.wanted)
+
+    async def subscribe(self, backend: HassBackend, watch: ScriptWatch, entity_ids: Set[str]):
+        """(Re)subscribe a backend's state trigger to a set of script entities"""
+        websocket = backend.websocket
+        if self.covers(backend, watch, entity_ids):
+            return
+        
+        def handler(event: Dict):
+            self.handle_trigger(backend, event)
+        
+        subscription = await websocket.subscribe_trigger(
+            {"platform": "state", "entity_id": sorted(entity_ids)}, handler
+        )
+        reconnected = watch.ws is not websocket.ws
+        previous = None if reconnected else watch.subscription
+        watch.ws, watch.subscription, watch.entity_ids = websocket.ws, subscription, entity_ids
+        self.subscribed.add(backend.name)
+        if previous is not None:
+            await websocket.unsubscribe(previous)
+        if not reconnected:
+            return
+        
+        if any(split_script_id(script_id)[0] is backend for script_id in self.running):
+            # Finish runs of scripts that stopped while the subscription was down
+            states = await websocket.command({"type": "get_states"})
+            self.reconcile(backend, states.get("result") or [])
+        if watch.keeper is None or watch.keeper.done():
+            watch.keeper = asyncio.create_task(self.keep_subscribed(backend, watch))
+
+    async def keep_subscribed(self, backend: HassBackend, watch: ScriptWatch):
+        """Renew a subscription after its connection drops, while runs are still open"""
+        while True:
+            await backend.websocket.wait_closed()
+            self.subscribed.discard(backend.name)
+            if not TRACK_SCRIPT_RUNS or not self.has_open_runs(backend):
+                return  # the next watch() subscribes again
+            await asyncio.sleep(RUN_TRACKER_RETRY_SECONDS)
+            try:
+                await asyncio.shield(self.refresh(backend, watch))
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling():
+                    raise  # close() is stopping the keeper
+                # Only the refresh was cancelled; retry after the delay like any failure
+                if ENABLE_LOGGING:
+                    logger.warning(f"Script run tracking on {backend.label}: subscribing was cancelled")
+            except Exception as e:
+                if ENABLE_LOGGING:
+                    logger.warning(f"Script run tracking on {backend.label} unavailable: {e!r}")
+
+    def close(self):
+        for watch in self.watches.values():
+            for task in (watch.refresh, watch.keeper):
+                if task is not None:
+                    task.cancel()
+
+run_tracker = ScriptRunTracker()
+
+async def trigger_script(script_id: str) -> bool:
+    """Trigger a script via Home Assistant API, within the upstream concurrency limits"""
+    started_at = time.monotonic()
+    with tracer.span("upstream.trigger", script_id=script_id) as span:
+        success = await upstream_limiter.run(script_id, lambda: call_trigger_script(script_id))
+        if span is not None:
+            span.tags["success"] = success
+    audit_log.record(
+        AUDIT_TRIGGER_RESULT,
+        script_id=script_id,
+        success=success,
+        duration_ms=round((time.monotonic() - started_at) * 1000, 1)
+    )
+    return success
+
+async def trigger_token_run(script_id: str, token_id: Optional[str]) -> bool:
+    """Trigger a script for a token and track the run until Home Assistant reports it done"""
+    if token_id is None:
+        return await trigger_script(script_id)
+    await run_tracker.watch(script_id)
+    run = run_tracker.triggered(token_id, script_id)
+    success = await trigger_script(script_id)
+    run_tracker.call_result(run, success)
+    return success
+
+class ScheduledRun(BaseModel):
+    run_id: str
+    script_id: str
+    run_at: float
+    created_at: float
+    token_id: Optional[str] = None
+
+class TriggerScheduler:
+    """Runs scripts at a later time from a single dispatcher task.
+
+    Pending runs wait in a heap ordered by due time rather than as sleeping
+    tasks. The dispatcher sleeps until the earliest run, or until an earlier
+    one is added, and only due runs are handed to the pooled HA client.
+    """
+
+    def __init__(self):
+        self.runs: Dict[str, ScheduledRun] = {}
+        self.heap: List[Tuple[float, str]] = []
+        self.wakeup: Optional[asyncio.Event] = None
+        self.dispatching: Set[asyncio.Task] = set()
+
+    def schedule(self, script_id: str, run_at: float, token_id: Optional[str] = None) -> ScheduledRun:
+        """Queue a script run for an absolute time"""
+        run = ScheduledRun(
+            run_id=secrets.token_hex(8),
+            script_id=script_id,
+            run_at=run_at,
+            created_at=time.time(),
+            token_id=token_id
+        )
+        self.runs[run.run_id] = run
+        heapq.heappush(self.heap, (run.run_at, run.run_id))
+        if self.wakeup is not None and self.heap[0][1] == run.run_id:
+            self.wakeup.set()
+        return run
+
+    def restore(self, run: ScheduledRun):
+        """Re-queue a run saved in a snapshot, keeping its id"""
+        self.runs[run.run_id] = run
+        heapq.heappush(self.heap, (run.run_at, run.run_id))
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def cancel(self, run_id: str) -> bool:
+        """Cancel a pending run; its heap entry is skipped when it comes due"""
+        if self.runs.pop(run_id, None) is None:
+            return False
+        if len(self.heap) > 2 * len(self.runs) + 64:
+            self.heap = [(run_at, rid) for run_at, rid in self.heap if rid in self.runs]
+            heapq.heapify(self.heap)
+        return True
+
+    def pop_due(self, now: float) -> List[ScheduledRun]:
+        """Remove and return every run due at or before now"""
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            _, run_id = heapq.heappop(self.heap)
+            run = self.runs.pop(run_id, None)
+            if run is not None:
+                due.append(run)
+        return due
+
+    async def run_forever(self):
+        """Dispatcher loop"""
+        self.wakeup = asyncio.Event()
+        while True:
+            now = time.time()
+            due = self.pop_due(now) if accepting_triggers else []
+            if due:
+                task = asyncio.create_task(self.dispatch(due))
+                self.dispatching.add(task)
+                task.add_done_callback(self.dispatching.discard)
+            
+            timeout = self.heap[0][0] - now if self.heap and accepting_triggers else None
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def dispatch(self, due: List[ScheduledRun]):
+        """Trigger a batch of due runs"""
+        results = await asyncio.gather(*(trigger_token_run(run.script_id, run.token_id) for run in due))
         if ENABLE_LOGGING:
-            logger.warning(f"Invalid or expired token attempted: {token[:8]}...")
-        return templates.TemplateResponse(
-            "error.html",
-            {"request": request, "message": "Invalid or expired token"}
+            for run, success in zip(due, results):
+                logger.info(f"Scheduled run {run.run_id} of {run.script_id}: {'SUCCESS' if success else 'FAILED'}")
+
+scheduler = TriggerScheduler()
+
+# Cleared at shutdown so the scheduler starts no new runs while its calls drain.
+# Trigger requests are not covered: uvicorn stops taking requests and gives
+# open ones SHUTDOWN_GRACE_SECONDS, cancelling the rest, before shutdown hooks run.
+accepting_triggers = True
+
+# json.dumps builds a new encoder per call when given separators
+compact_json = json.JSONEncoder(separators=(",", ":")).encode
+
+def snapshot_lines() -> Iterator[str]:
+    """Compact NDJSON lines for every live token and pending run"""
+    yield compact_json({"type": "snapshot", "version": SNAPSHOT_VERSION, "saved_at": time.time()}) + "\n"
+    now = time.time()
+    # Copy only the keys; tokens removed meanwhile are skipped
+    for selector in list(tokens):
+        record = tokens.get(selector)
+        if record is not None and record.expires_at > now:
+            yield compact_json(serialize_token(selector, record)) + "\n"
+    for run in list(scheduler.runs.values()):
+        yield compact_json({"type": "run", **run.model_dump()}) + "\n"
+
+def serialize_token(selector: bytes, record: TokenRecord) -> Dict:
+    entry = {"type": "token", "selector": selector.hex(), "verifier": record.verifier.hex()}
+    entry.update((slot, getattr(record, slot)) for slot in TokenRecord.__slots__ if slot != "verifier")
+    return entry
+
+def deserialize_token(entry: Dict) -> Tuple[bytes, TokenRecord]:
+    """Rebuild a stored token from its snapshot entry, raising ValueError if malformed"""
+    try:
+        selector = bytes.fromhex(entry["selector"])
+        verifier = bytes.fromhex(entry["verifier"])
+        record = TokenRecord(
+            verifier=verifier,
+            script_id=str(entry["script_id"]),
+            created_at=float(entry["created_at"]),
+            expires_at=float(entry["expires_at"]),
+            max_uses=int(entry["max_uses"]),
+            uses=int(entry["uses"]),
+            min_interval_seconds=float(entry["min_interval_seconds"]),
+            last_used_at=None if entry["last_used_at"] is None else float(entry["last_used_at"]),
+            delay_seconds=float(entry["delay_seconds"])
         )
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid token entry: {e}")
+    if len(selector) != TOKEN_SELECTOR_SIZE or len(verifier) != TOKEN_SELECTOR_SIZE or record.max_uses < 1:
+        raise ValueError("Invalid token entry")
+    return selector, record
+
+class TokenImporter:
+    """Feeds snapshot lines into the store and the scheduler one at a time.
+
+    Expired, duplicate and malformed entries are skipped and counted, and
+    tokens beyond the global caps are refused rather than evicting live ones.
+    Runs overdue by more than MAX_RUN_LATENESS_SECONDS are dropped like
+    expired tokens, so an old snapshot or backup can't fire them days late.
+    """
+
+    def __init__(self):
+        self.now = time.time()
+        self.counts = {"tokens": 0, "runs": 0, "expired": 0, "stale_runs": 0, "duplicates": 0,
+                       "invalid": 0, "store_full": 0}
+        self.last_error: Optional[str] = None
+
+    def add(self, line: str):
+        """Import one NDJSON line"""
+        if not line.strip():
+            return
+        try:
+            entry = json.loads(line)
+            kind = entry.get("type")
+            if kind == "token":
+                self.add_token(entry)
+            elif kind == "run":
+                self.add_run(entry)
+            elif kind != "snapshot":
+                raise ValueError(f"Unknown entry type {kind!r}")
+        except (ValueError, AttributeError) as e:
+            self.counts["invalid"] += 1
+            self.last_error = str(e)
+
+    def add_token(self, entry: Dict):
+        selector, record = deserialize_token(entry)
+        if record.expires_at <= self.now:
+            self.counts["expired"] += 1
+        elif selector in tokens:
+            self.counts["duplicates"] += 1
+        elif token_store_full(NEW_TOKEN_BYTES):
+            self.counts["store_full"] += 1
+        else:
+            store_token(selector, record)
+            self.counts["tokens"] += 1
+
+    def add_run(self, entry: Dict):
+        run = ScheduledRun(**{k: v for k, v in entry.items() if k != "type"})
+        if run.run_at < self.now - MAX_RUN_LATENESS_SECONDS:
+            self.counts["stale_runs"] += 1
+        elif run.run_id in scheduler.runs:
+            self.counts["duplicates"] += 1
+        else:
+            scheduler.restore(run)
+            self.counts["runs"] += 1
+
+def write_snapshot(path: str) -> int:
+    """Write the snapshot atomically; returns the number of entries"""
+    target = Path(path)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    partial = target.with_name(target.name + ".tmp")
+    count = 0
+    with gzip.open(partial, "wt", compresslevel=1) as f:
+        for line in snapshot_lines():
+            f.write(line)
+            count += 1
+    os.replace(partial, target)
+    return count - 1
+
+def load_snapshot(path: str) -> Tuple[int, int]:
+    """Stream a snapshot back into the store and the scheduler.
+
+    Expired tokens, long overdue runs and malformed lines are skipped and the global caps are
+    respected. The file is removed afterwards so tokens revoked later can't
+    come back from an old snapshot after a crash. Returns (tokens, runs).
+    """
+    target = Path(path)
+    if not target.exists():
+        return 0, 0
     
-    # Check if already used
-    if token_data.used:
+    importer = TokenImporter()
+    with gzip.open(target, "rt") as f:
+        for line in f:
+            importer.add(line)
+    if importer.counts["invalid"]:
+        logger.warning(f"Skipped {importer.counts['invalid']} invalid snapshot lines: {importer.last_error}")
+    if importer.counts["stale_runs"]:
+        logger.warning(f"Dropped {importer.counts['stale_runs']} scheduled runs overdue by more than "
+                       f"{MAX_RUN_LATENESS_SECONDS} seconds")
+    target.unlink()
+    return importer.counts["tokens"], importer.counts["runs"]
+
+async def drain_upstream_calls(deadline: float) -> int:
+    """Wait for scheduled dispatches and their upstream calls to finish; returns how many were cut off.
+
+    Runs from the shutdown hook, after uvicorn has finished or cancelled the
+    open HTTP requests, so only calls started by the scheduler are left.
+    """
+    if scheduler.dispatching:
+        await asyncio.wait(list(scheduler.dispatching), timeout=max(0.0, deadline - time.monotonic()))
+    while time.monotonic() < deadline:
+        if not upstream_limiter.pending():
+            return 0
+        await asyncio.sleep(0.05)
+    return upstream_limiter.pending()
+
+def route_label(scope: Dict) -> str:
+    """Route template for a request scope, so tokens never end up in reports"""
+    endpoint = scope.get("endpoint")
+    for route in app.routes:
+        if endpoint is not None and getattr(route, "endpoint", None) is endpoint:
+            return route.path
+    return "unmatched"
+
+class RequestProfiler:
+    """Opt-in cProfile sampling of trigger and generate requests.
+
+    cProfile sees everything the event loop runs while the sampled request
+    is in flight, so only one request is profiled at a time. Stats are
+    merged into per-function totals and pruned to the hottest functions.
+    Disabled, the cost per request is one attribute check.
+    """
+
+    def __init__(self, top_n: int = PROFILE_TOP_FUNCTIONS):
+        self.top_n = top_n
+        self.enabled = False
+        self.sample_rate = 0.1
+        self.active = False
+        self.reset()
+
+    def reset(self):
+        self.samples: Dict[str, int] = {}
+        self.functions: Dict[Tuple[str, int, str], List[float]] = {}
+
+    def configure(self, enabled: Optional[bool] = None, sample_rate: Optional[float] = None):
+        if enabled is not None:
+            self.enabled = enabled
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+
+    def start(self, scope: Dict) -> Optional[cProfile.Profile]:
+        """Start profiling this request if it is sampled"""
+        if not self.enabled or self.active or not scope["path"].startswith(INSTRUMENTED_PATHS):
+            return None
+        if random.random() >= self.sample_rate:
+            return None
+        self.active = True
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def finish(self, profile: cProfile.Profile, scope: Dict):
+        profile.disable()
+        self.active = False
+        route = route_label(scope)
+        self.samples[route] = self.samples.get(route, 0) + 1
+        for function, (_, calls, total, cumulative, _) in pstats.Stats(profile).stats.items():
+            totals = self.functions.setdefault(function, [0, 0.0, 0.0])
+            totals[0] += calls
+            totals[1] += total
+            totals[2] += cumulative
+        # Keep some headroom so functions can climb into the top N over time
+        if len(self.functions) > self.top_n * 4:
+            hottest = sorted(self.functions.items(), key=lambda item: item[1][1], reverse=True)
+            self.functions = dict(hottest[:self.top_n * 2])
+
+    def report(self) -> Dict:
+        hottest = sorted(self.functions.items(), key=lambda item: item[1][1], reverse=True)[:self.top_n]
+        return {
+            "enabled": self.enabled,
+            "sample_rate": self.sample_rate,
+            "samples": self.samples,
+            "functions": [
+                {
+                    "function": name,
+                    "file": f"{filename}:{line}",
+                    "calls": calls,
+                    "total_ms": round(total * 1000, 3),
+                    "cumulative_ms": round(cumulative * 1000, 3),
+                }
+                for (filename, line, name), (calls, total, cumulative) in hottest
+            ],
+        }
+
+request_profiler = RequestProfiler()
+
+class LoopLagMonitor:
+    """Record event loop stalls and the requests that were running.
+
+    A request that blocks the loop may finish before the monitor wakes up
+    again, so recently finished requests are remembered briefly too.
+    """
+
+    def __init__(self, threshold_ms: int, interval: float = LOOP_LAG_INTERVAL_SECONDS):
+        self.threshold = threshold_ms / 1000
+        self.interval = interval
+        self.running: Dict[int, Dict] = {}
+        self.finished: Deque[Tuple[float, Dict]] = deque(maxlen=32)
+        self.stalls: Deque[Dict] = deque(maxlen=LOOP_STALL_HISTORY)
+        self.max_lag = 0.0
+
+    def check(self, expected: float, now: float):
+        """Record a stall if the loop woke up late"""
+        lag = now - expected
+        self.max_lag = max(self.max_lag, lag)
+        if self.threshold <= 0 or lag < self.threshold:
+            return
+        scopes = list(self.running.values())
+        scopes += [scope for finished_at, scope in self.finished if finished_at >= expected]
+        routes = sorted({route_label(scope) for scope in scopes})
+        self.stalls.append({
+            "at": datetime.now().isoformat(),
+            "lag_ms": round(lag * 1000, 1),
+            "routes": routes,
+        })
         if ENABLE_LOGGING:
-            logger.warning(f"Token already used: {token[:8]}...")
-        return templates.TemplateResponse(
-            "error.html",
-            {"request": request, "message": "Token has already been used"}
+            logger.warning(f"Event loop stalled for {lag * 1000:.0f}ms during {', '.join(routes) or 'no request'}")
+
+    async def run_forever(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            self.check(expected, time.monotonic())
+
+    def report(self) -> Dict:
+        return {
+            "threshold_ms": round(self.threshold * 1000),
+            "max_lag_ms": round(self.max_lag * 1000, 1),
+            "stalls": list(self.stalls),
+        }
+
+loop_monitor = LoopLagMonitor(LOOP_LAG_THRESHOLD_MS)
+
+class RequestProbe:
+    """ASGI middleware feeding the loop monitor and the request profiler"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        # Open streams are idle nearly all the time and would be blamed for every stall
+        monitored = not scope["path"].startswith(STREAMING_PATHS)
+        key = id(scope)
+        if monitored:
+            loop_monitor.running[key] = scope
+        profile = request_profiler.start(scope)
+        root = tracer.start_trace("request") if scope["path"].startswith(INSTRUMENTED_PATHS) else None
+        try:
+            if root is None:
+                await self.app(scope, receive, send)
+            else:
+                await self.traced(root, scope, receive, send)
+        finally:
+            if monitored:
+                del loop_monitor.running[key]
+                loop_monitor.finished.append((time.monotonic(), scope))
+            if profile is not None:
+                request_profiler.finish(profile, scope)
+
+    async def traced(self, root: Span, scope, receive, send):
+        """Run a sampled request under its root span, timing the response separately"""
+        response: Dict[str, float] = {}
+
+        async def traced_send(message):
+            if message["type"] == "http.response.start":
+                root.tags["http.status_code"] = message["status"]
+                response["started_at"], response["started"] = time.time(), time.perf_counter()
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body") and response:
+                tracer.record("response", root, response["started_at"], time.perf_counter() - response["started"])
+
+        with root:
+            try:
+                await self.app(scope, receive, traced_send)
+            finally:
+                # Named after the route template so tokens never reach the trace
+                root.name = f"{scope['method']} {route_label(scope)}"
+
+app.add_middleware(RequestProbe)
+
+def is_admin_request(request: Request) -> bool:
+    """Requests through Home Assistant ingress, or bearing the admin token"""
+    if request.client and request.client.host == HASS_INGRESS_ADDRESS:
+        return True
+    if ADMIN_TOKEN:
+        scheme, _, credentials = request.headers.get("authorization", "").partition(" ")
+        return scheme.lower() == "bearer" and hmac.compare_digest(credentials.encode(), ADMIN_TOKEN.encode())
+    return False
+
+# Rendered index shells keyed by static path prefix; the page no longer depends on HA data
+INDEX_CACHE_SIZE = 8
+index_cache: Dict[str, str] = {}
+
+def render_index(request: Request) -> str:
+    """Render the index shell once per static path prefix and reuse it"""
+    prefix = static_prefix(request)
+    html = index_cache.get(prefix)
+    if html is None:
+        if len(index_cache) >= INDEX_CACHE_SIZE:
+            index_cache.clear()
+        html = templates.get_template("index.html").render(
+            request=request,
+            token_expiry_minutes=TOKEN_EXPIRY_MINUTES
+        )
+        index_cache[prefix] = html
+    return html
+
+def build_qr(url: str, fmt: str, scale: int) -> bytes:
+    matrix = qr_encoder.encode(url)
+    if fmt == "png":
+        return qr_encoder.to_png(matrix, scale)
+    return qr_encoder.to_svg(matrix, scale).encode()
+
+async def render_qr(url: str, fmt: str, scale: int) -> bytes:
+    """Render a QR code for url.
+
+    Images of trigger URLs are as redeemable as the URL, so none are kept.
+    Encoding is pure Python, so it runs off the event loop.
+    """
+    return await asyncio.to_thread(build_qr, url, fmt, scale)
+
+def parse_qr_options(fmt: Any, scale: Any) -> Tuple[str, int]:
+    """Validate a requested QR format and scale"""
+    if fmt not in QR_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"QR format must be one of: {', '.join(QR_MEDIA_TYPES)}")
+    if isinstance(scale, bool) or not isinstance(scale, int) or not 1 <= scale <= QR_MAX_SCALE:
+        raise HTTPException(status_code=400, detail=f"QR scale must be an integer between 1 and {QR_MAX_SCALE}")
+    return fmt, scale
+
+def build_trigger_url(request: Request, token: str) -> str:
+    return f"{str(request.base_url).rstrip('/')}/trigger/{token}"
+
+def integer_option(value: Any) -> int:
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        raise ValueError("expected a non-negative integer")
+    return value
+
+def float_option(value: Any) -> float:
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 <= value <= 1:
+        raise ValueError("expected a number between 0 and 1")
+    return float(value)
+
+def bool_option(value: Any) -> bool:
+    if not isinstance(value, bool):
+        raise ValueError("expected true or false")
+    return value
+
+def string_option(value: Any) -> str:
+    if value is None:
+        return ""
+    if not isinstance(value, str):
+        raise ValueError("expected a string")
+    return value
+
+# Add-on options that can change at runtime: option name -> (setting, parser)
+RELOADABLE_OPTIONS = {
+    "token_expiry_minutes": ("TOKEN_EXPIRY_MINUTES", integer_option),
+    "max_tokens_per_script": ("MAX_TOKENS_PER_SCRIPT", integer_option),
+    "max_uses_per_token": ("MAX_USES_PER_TOKEN", integer_option),
+    "max_tokens_total": ("MAX_TOKENS_TOTAL", integer_option),
+    "max_token_store_kb": ("MAX_TOKEN_STORE_KB", integer_option),
+    "max_concurrent_triggers": ("MAX_CONCURRENT_TRIGGERS", integer_option),
+    "max_concurrent_per_script": ("MAX_CONCURRENT_PER_SCRIPT", integer_option),
+    "adaptive_concurrency": ("ADAPTIVE_CONCURRENCY", bool_option),
+    "use_websocket": ("USE_WEBSOCKET", bool_option),
+    "hass_backends": ("HASS_BACKENDS", string_option),
+    "enable_logging": ("ENABLE_LOGGING", bool_option),
+    "audit_log_max_mb": ("AUDIT_LOG_MAX_MB", integer_option),
+    "audit_log_backups": ("AUDIT_LOG_BACKUPS", integer_option),
+    "admin_token": ("ADMIN_TOKEN", string_option),
+    "loop_lag_threshold_ms": ("LOOP_LAG_THRESHOLD_MS", integer_option),
+    "trace_sample_rate": ("TRACE_SAMPLE_RATE", float_option),
+    "track_script_runs": ("TRACK_SCRIPT_RUNS", bool_option),
+}
+
+# Options only read when the add-on starts
+RESTART_OPTIONS = {"trace_export_path": ("TRACE_EXPORT_PATH", string_option)}
+
+def apply_options(options: Dict, startup: bool = False) -> List[str]:
+    """Validate a full set of add-on options and apply the changed ones.
+
+    Everything is checked before anything is applied, and applying never
+    awaits, so requests see either the old settings or the new ones.
+    Live tokens keep their expiry; new TTLs and limits apply to new work.
+    RESTART_OPTIONS are only applied at startup.
+    Returns the names of the options that changed.
+    """
+    settings = globals()
+    updates = {}
+    pending_restart = []
+    for option, (setting, parse) in {**RELOADABLE_OPTIONS, **RESTART_OPTIONS}.items():
+        if option not in options:
+            continue
+        try:
+            value = parse(options[option])
+        except ValueError as e:
+            raise ValueError(f"Invalid option {option}: {e}")
+        if value == settings[setting]:
+            continue
+        if option in RESTART_OPTIONS and not startup:
+            pending_restart.append(option)
+        else:
+            updates[option] = value
+    
+    extra_backends = parse_backends(updates["hass_backends"]) if "hass_backends" in updates else None
+    
+    for option, value in updates.items():
+        settings[(RELOADABLE_OPTIONS.get(option) or RESTART_OPTIONS[option])[0]] = value
+    
+    if updates.keys() & {"max_concurrent_triggers", "max_concurrent_per_script", "adaptive_concurrency"}:
+        upstream_limiter.configure(MAX_CONCURRENT_TRIGGERS, MAX_CONCURRENT_PER_SCRIPT, ADAPTIVE_CONCURRENCY)
+    audit_log.max_bytes = AUDIT_LOG_MAX_MB * 1024 * 1024
+    audit_log.backups = AUDIT_LOG_BACKUPS
+    loop_monitor.threshold = LOOP_LAG_THRESHOLD_MS / 1000
+    tracer.sample_rate = TRACE_SAMPLE_RATE
+    if "token_expiry_minutes" in updates:
+        index_cache.clear()
+    if extra_backends is not None:
+        replace_backends(extra_backends)
+    
+    for option in pending_restart:
+        logger.warning(f"Option {option} changes after a restart")
+    return sorted(updates)
+
+def replace_backends(extra: List[Dict[str, str]]):
+    """Swap in a new set of backends, keeping unchanged ones and their caches"""
+    global backends
+    previous = backends
+    configured = build_backends(extra)
+    for name, backend in configured.items():
+        current = previous.get(name)
+        if current is not None and (current.url, current.token) == (backend.url, backend.token):
+            configured[name] = current
+    backends = configured
+    
+    retired = [backend for name, backend in previous.items() if configured.get(name) is not backend]
+    if retired:
+        # Let calls already using the old clients finish before closing them
+        retired_backends.extend(retired)
+        asyncio.get_running_loop().call_later(
+            BACKEND_CLOSE_DELAY_SECONDS, lambda: asyncio.create_task(close_retired_backends(retired))
+        )
+
+# Replaced backends waiting to be closed
+retired_backends: List[HassBackend] = []
+
+async def close_retired_backends(retired: List[HassBackend]):
+    for backend in retired:
+        if backend in retired_backends:
+            retired_backends.remove(backend)
+            await backend.close()
+
+class OptionsWatcher:
+    """Polls the add-on options file and applies changes as they are saved"""
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.signature: Optional[Tuple[int, int]] = None
+        self.reloads = 0
+        self.last_error: Optional[str] = None
+
+    def check(self, startup: bool = False) -> List[str]:
+        """Apply the options file if it changed since the last check"""
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            return []
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature == self.signature:
+            return []
+        self.signature = signature
+        
+        try:
+            with open(self.path) as f:
+                options = json.load(f)
+            if not isinstance(options, dict):
+                raise ValueError("options must be a JSON object")
+            changed = apply_options(options, startup)
+        except (OSError, ValueError) as e:
+            # Keep running on the previous options until the file is fixed
+            self.last_error = str(e)
+            logger.error(f"Not applying {self.path}: {e}")
+            return []
+        
+        self.last_error = None
+        if changed:
+            self.reloads += 1
+            logger.info(f"Applied option changes: {', '.join(changed)}")
+        return changed
+
+    async def run_forever(self):
+        while True:
+            await asyncio.sleep(OPTIONS_POLL_SECONDS)
+            self.check()
+
+options_watcher = OptionsWatcher(OPTIONS_PATH)
+
+async def sweep_expired_tokens():
+    """Periodically expire tokens so subscribers hear about them promptly"""
+    while True:
+        await asyncio.sleep(TOKEN_SWEEP_INTERVAL_SECONDS)
+        cleanup_expired_tokens()
+        run_tracker.expire_stale(time.time())
+
+@app.on_event("startup")
+async def start_background_tasks():
+    """Restore the last snapshot and start background maintenance tasks"""
+    global accepting_triggers
+    accepting_triggers = True
+    options_watcher.check(startup=True)
+    tracer.set_export_path(TRACE_EXPORT_PATH)
+    try:
+        restored_tokens, restored_runs = await asyncio.to_thread(load_snapshot, SNAPSHOT_PATH)
+        if restored_tokens or restored_runs:
+            logger.info(f"Restored {restored_tokens} tokens and {restored_runs} scheduled runs from {SNAPSHOT_PATH}")
+    except (OSError, EOFError) as e:
+        logger.error(f"Error loading snapshot {SNAPSHOT_PATH}: {e}")
+    app.state.sweeper = asyncio.create_task(sweep_expired_tokens())
+    app.state.options_watcher = asyncio.create_task(options_watcher.run_forever())
+    app.state.scheduler = asyncio.create_task(scheduler.run_forever())
+    app.state.audit_writer = asyncio.create_task(audit_log.run_forever())
+    app.state.trace_writer = asyncio.create_task(tracer.exporter.run_forever()) if tracer.exporter else None
+    app.state.loop_monitor = asyncio.create_task(loop_monitor.run_forever())
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    """Drain scheduled runs' upstream calls, snapshot the store and stop background tasks"""
+    global accepting_triggers
+    accepting_triggers = False
+    app.state.sweeper.cancel()
+    app.state.options_watcher.cancel()
+    run_tracker.close()
+    
+    cut_off = await drain_upstream_calls(time.monotonic() + SHUTDOWN_DRAIN_SECONDS)
+    if cut_off:
+        logger.warning(f"Shutting down with {cut_off} upstream calls still in flight")
+    app.state.scheduler.cancel()
+    try:
+        saved = await asyncio.to_thread(write_snapshot, SNAPSHOT_PATH)
+        logger.info(f"Saved {saved} tokens and scheduled runs to {SNAPSHOT_PATH}")
+    except OSError as e:
+        logger.error(f"Error writing snapshot {SNAPSHOT_PATH}: {e}")
+    
+    # Let a cancelled writer finish its batch before the final flush
+    app.state.audit_writer.cancel()
+    await asyncio.wait({app.state.audit_writer})
+    if app.state.trace_writer:
+        app.state.trace_writer.cancel()
+        await asyncio.wait({app.state.trace_writer})
+        await tracer.exporter.flush()
+    app.state.loop_monitor.cancel()
+    await audit_log.flush()
+    await close_retired_backends(list(retired_backends))
+    for backend in backends.values():
+        await backend.close()
+
+@app.get("/", response_class=HTMLResponse)
+async def home(request: Request):
+    """Main addon interface; scripts are loaded by the page from /api/scripts"""
+    return HTMLResponse(render_index(request))
+
+async def generate_for_request(request: Request, data: Dict) -> Dict:
+    """Validate a generate request, create the token and build the response"""
+    script_id = data.get("script_id")
+    
+    if not script_id:
+        raise HTTPException(status_code=400, detail="script_id is required")
+    
+    max_uses = data.get("max_uses", 1)
+    if isinstance(max_uses, bool) or not isinstance(max_uses, int) or not 1 <= max_uses <= MAX_USES_PER_TOKEN:
+        raise HTTPException(
+            status_code=400,
+            detail=f"max_uses must be an integer between 1 and {MAX_USES_PER_TOKEN}"
         )
     
-    # Trigger the script
-    success = await trigger_script(token_data.script_id)
+    min_interval_seconds = data.get("min_interval_seconds", 0)
+    if (isinstance(min_interval_seconds, bool) or not isinstance(min_interval_seconds, (int, float))
+            or not 0 <= min_interval_seconds <= TOKEN_EXPIRY_MINUTES * 60):
+        raise HTTPException(
+            status_code=400,
+            detail="min_interval_seconds must be between 0 and the token expiry"
+        )
+    
+    qr = data.get("qr")
+    if qr is not None:
+        qr = parse_qr_options(qr, data.get("qr_scale", QR_DEFAULT_SCALE))
+    
+    delay_seconds = data.get("delay_seconds", 0)
+    if (isinstance(delay_seconds, bool) or not isinstance(delay_seconds, (int, float))
+            or not 0 <= delay_seconds <= MAX_SCHEDULE_DELAY_SECONDS):
+        raise HTTPException(
+            status_code=400,
+            detail=f"delay_seconds must be between 0 and {MAX_SCHEDULE_DELAY_SECONDS}"
+        )
     
-    # Mark token as used
-    tokens[token]["used"] = True
+    # Check if script exists
+    with tracer.span("catalog.lookup", script_id=script_id):
+        script = await find_script(script_id)
+    if script is None:
+        raise HTTPException(status_code=404, detail="Script not found")
+    
+    with tracer.span("quota.check"):
+        # Check token limit per script
+        if count_script_tokens(script_id) >= MAX_TOKENS_PER_SCRIPT:
+            raise HTTPException(
+                status_code=429, 
+                detail=f"Maximum tokens ({MAX_TOKENS_PER_SCRIPT}) reached for this script"
+            )
+        
+        # Check the global store caps, evicting what can go
+        if not make_room_for_token():
+            if ENABLE_LOGGING:
+                logger.warning(f"Token store full ({len(tokens)} tokens, {token_store_bytes} bytes), refusing generation")
+            raise HTTPException(
+                status_code=503,
+                detail="Token store is full, try again once existing URLs have expired",
+                headers={"Retry-After": str(TOKEN_EVICTION_GRACE_SECONDS)}
+            )
+    
+    with tracer.span("token.insert"):
+        token, token_data = create_token(script_id, max_uses, min_interval_seconds, delay_seconds)
+    
+    # Generate the trigger URL
+    trigger_url = build_trigger_url(request, token)
+    
+    if ENABLE_LOGGING:
+        logger.info(f"Generated token for script {script_id}: {mask_token(token)}")
+    
+    response = {
+        "token": token,
+        "token_id": token_id(hash_token(token)[0]),
+        "url": trigger_url,
+        "expires_at": datetime.fromtimestamp(token_data.expires_at).isoformat(),
+        "expires_in_minutes": TOKEN_EXPIRY_MINUTES,
+        "max_uses": token_data.max_uses,
+        "min_interval_seconds": token_data.min_interval_seconds,
+        "delay_seconds": token_data.delay_seconds
+    }
+    if qr is not None:
+        with tracer.span("qr.render", format=qr[0]):
+            image = await render_qr(trigger_url, *qr)
+        response["qr"] = f"data:{QR_MEDIA_TYPES[qr[0]]};base64,{base64.b64encode(image).decode()}"
+    return response
+
+@app.post("/api/generate")
+async def generate_url(request: Request):
+    """Generate a temporary URL for a script"""
+    try:
+        data = await request.json()
+        
+        # Retries carrying the same Idempotency-Key get the original response back
+        idempotency_key = request.headers.get("Idempotency-Key")
+        if idempotency_key:
+            if len(idempotency_key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+                raise HTTPException(status_code=400, detail="Idempotency-Key is too long")
+            return await idempotency_cache.run(
+                idempotency_key,
+                data,
+                lambda: generate_for_request(request, data)
+            )
+        
+        return await generate_for_request(request, data)
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error generating URL: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+@app.post("/api/generate/batch")
+async def generate_batch(request: Request):
+    """Generate several URLs in one call, e.g. to provision kiosks.
+
+    Top-level fields other than "items" are defaults for every item.
+    Items are generated in order and fail independently.
+    """
+    try:
+        data = await request.json()
+        items = data.get("items") if isinstance(data, dict) else None
+        if not isinstance(items, list) or not items or not all(isinstance(item, dict) for item in items):
+            raise HTTPException(status_code=400, detail="items must be a non-empty list of generate requests")
+        if len(items) > MAX_BATCH_SIZE:
+            raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_SIZE} items per batch")
+        defaults = {key: value for key, value in data.items() if key != "items"}
+        
+        async def generate_all() -> Dict:
+            results = []
+            for item in items:
+                try:
+                    results.append(await generate_for_request(request, {**defaults, **item}))
+                except HTTPException as e:
+                    results.append({"script_id": item.get("script_id"), "error": e.detail, "status_code": e.status_code})
+            return {
+                "generated": sum(1 for result in results if "error" not in result),
+                "results": results
+            }
+        
+        idempotency_key = request.headers.get("Idempotency-Key")
+        if idempotency_key:
+            if len(idempotency_key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+                raise HTTPException(status_code=400, detail="Idempotency-Key is too long")
+            return await idempotency_cache.run(idempotency_key, data, generate_all)
+        
+        return await generate_all()
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error generating URL batch: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+@app.get("/qr/{token}")
+async def qr_code(token: str, request: Request, format: str = "svg", scale: int = QR_DEFAULT_SCALE):
+    """QR code image of a token's trigger URL"""
+    fmt, scale = parse_qr_options(format, scale)
+    _, record = find_token(token)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Invalid or expired token")
+    
+    image = await render_qr(build_trigger_url(request, token), fmt, scale)
+    # The image is as sensitive as the URL itself
+    return Response(content=image, media_type=QR_MEDIA_TYPES[fmt], headers={"Cache-Control": "private, no-store"})
+
+def render_page(request: Request, name: str, context: Dict, status_code: int = 200) -> Response:
+    """Render a page template, as its own span when the request is traced"""
+    with tracer.span("template.render", template=name):
+        return templates.TemplateResponse(name, {"request": request, **context}, status_code=status_code)
+
+@app.get("/trigger/{token}")
+async def trigger_script_url(token: str, request: Request):
+    """Trigger a script via token URL"""
+    # Claim a use before calling Home Assistant so concurrent requests can't reuse it
+    with tracer.span("store.lookup"):
+        selector, _ = hash_token(token)
+        token_data, error = claim_token_use(token)
+    if not token_data:
+        audit_log.record(AUDIT_TOKEN_REJECTED, token_id=token_id(selector), reason=error)
+        if ENABLE_LOGGING:
+            logger.warning(f"Token rejected ({error}): {mask_token(token)}")
+        return render_page(request, "error.html", {"message": error})
+    
+    audit_log.record(
+        AUDIT_TOKEN_REDEEMED,
+        script_id=token_data.script_id,
+        token_id=token_id(selector),
+        uses=token_data.uses,
+        client=request.client.host if request.client else None
+    )
+    
+    # Trigger the script, or queue it when the token was generated with a delay
+    scheduled_for = None
+    if token_data.delay_seconds:
+        run = scheduler.schedule(
+            token_data.script_id,
+            time.time() + token_data.delay_seconds,
+            token_id=token_id(selector)
+        )
+        run_tracker.add(token_id(selector), token_data.script_id, RUN_SCHEDULED)
+        scheduled_for = datetime.fromtimestamp(run.run_at).isoformat()
+        success = True
+    else:
+        success = await trigger_token_run(token_data.script_id, token_id(selector))
+    
+    event_broadcaster.publish(
+        TOKEN_EVENT_CONSUMED,
+        token_data.script_id,
+        token_id=token_id(selector),
+        success=success,
+        remaining_uses=token_data.remaining_uses,
+        scheduled_for=scheduled_for
+    )
     
     if success:
         if ENABLE_LOGGING:
-            logger.info(f"Script {token_data.script_id} successfully triggered via token {token[:8]}...")
-        return templates.TemplateResponse(
+            action = f"scheduled for {scheduled_for}" if scheduled_for else "successfully triggered"
+            logger.info(f"Script {token_data.script_id} {action} via token {mask_token(token)}")
+        return render_page(
+            request,
             "success.html",
-            {"request": request, "script_id": token_data.script_id}
+            {
+                "script_id": token_data.script_id,
+                "remaining_uses": token_data.remaining_uses,
+                "scheduled_for": scheduled_for
+            }
         )
     else:
         if ENABLE_LOGGING:
-            logger.error(f"Failed to trigger script {token_data.script_id} via token {token[:8]}...")
-        return templates.TemplateResponse(
-            "error.html",
-            {"request": request, "message": "Failed to trigger script"}
-        )
+            logger.error(f"Failed to trigger script {token_data.script_id} via token {mask_token(token)}")
+        return render_page(request, "error.html", {"message": "Failed to trigger script"})
+
+@app.api_route("/static/{path:path}", methods=["GET", "HEAD"], name="static")
+async def static_file(path: str, request: Request):
+    """Serve fingerprinted static assets with immutable caching"""
+    asset = static_assets.get(path)
+    if asset is None:
+        raise HTTPException(status_code=404, detail="Not found")
+
+    # Only fingerprinted URLs are safe to cache forever; logical paths revalidate
+    headers = {
+        "Cache-Control": STATIC_CACHE_CONTROL if path == asset.path else "no-cache",
+        "ETag": asset.etag,
+        "Vary": "Accept-Encoding",
+    }
+    if etag_matches(request.headers.get("if-none-match", ""), asset.etag):
+        return Response(status_code=304, headers=headers)
+
+    body, encoding = select_asset_body(asset, request.headers.get("accept-encoding", ""))
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type=asset.media_type, headers=headers)
 
 @app.get("/api/scripts")
 async def api_scripts():
     """API endpoint to get available scripts"""
     scripts = await get_scripts()
-    return [{"entity_id": s.entity_id, "name": s.friendly_name} for s in scripts]
+    return [{"entity_id": s.entity_id, "name": s.friendly_name, "backend": s.backend} for s in scripts]
 
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {"status": "healthy", "timestamp": datetime.now().isoformat()}
+    return {
+        "status": "healthy",
+        "timestamp": datetime.now().isoformat(),
+        "backends": {backend.label: backend.health() for backend in backends.values()}
+    }
+
+@app.get("/health/profile")
+async def health_profile(request: Request):
+    """Profiling samples and event loop stalls (admin only)"""
+    if not is_admin_request(request):
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return {"profiling": request_profiler.report(), "event_loop": loop_monitor.report()}
+
+@app.post("/health/profile")
+async def configure_profiling(request: Request):
+    """Switch request profiling on or off (admin only)"""
+    if not is_admin_request(request):
+        raise HTTPException(status_code=403, detail="Admin access required")
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        raise HTTPException(status_code=400, detail="Request body must be a JSON object")
+    enabled = data.get("enabled")
+    sample_rate = data.get("sample_rate")
+    if enabled is not None and not isinstance(enabled, bool):
+        raise HTTPException(status_code=400, detail="enabled must be true or false")
+    if sample_rate is not None:
+        if isinstance(sample_rate, bool) or not isinstance(sample_rate, (int, float)) or not 0 < sample_rate <= 1:
+            raise HTTPException(status_code=400, detail="sample_rate must be greater than 0 and at most 1")
+    request_profiler.configure(enabled, sample_rate)
+    if data.get("reset"):
+        request_profiler.reset()
+    return {"enabled": request_profiler.enabled, "sample_rate": request_profiler.sample_rate}
+
+@app.get("/health/traces")
+async def health_traces(request: Request, limit: int = 20):
+    """Recent sampled request traces as Zipkin v2 spans (admin only)"""
+    if not is_admin_request(request):
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return {
+        "sample_rate": tracer.sample_rate,
+        "exporting_to": str(tracer.exporter.path) if tracer.exporter else None,
+        "traces": tracer.traces(max(1, min(limit, 200))),
+    }
+
+@app.get("/metrics")
+async def metrics():
+    """Runtime metrics for the token store and upstream Home Assistant calls"""
+    return {
+        "tokens": len(tokens),
+        "token_store": {
+            "bytes": token_store_bytes,
+            "max_bytes": MAX_TOKEN_STORE_KB * 1024,
+            "max_tokens": MAX_TOKENS_TOTAL,
+        },
+        "scheduled_runs": len(scheduler.runs),
+        "script_runs": {
+            "tracked": len(run_tracker.runs),
+            "waiting": sum(map(len, run_tracker.waiting.values())),
+            "running": sum(map(len, run_tracker.running.values())),
+            "subscribed_backends": len(run_tracker.subscribed),
+        },
+        "sse_subscribers": len(event_broadcaster.subscribers),
+        "audit_log": audit_log.stats(),
+        "options": {"reloads": options_watcher.reloads, "last_error": options_watcher.last_error},
+        "upstream": upstream_limiter.metrics(),
+    }
+
+@app.get("/api/audit")
+async def api_audit(request: Request, event: Optional[str] = None, script_id: Optional[str] = None,
+                    since: Optional[str] = None, limit: int = 1000):
+    """Stream audit records as NDJSON, oldest first (admin only)"""
+    if not is_admin_request(request):
+        raise HTTPException(status_code=403, detail="Admin access required")
+    since_ts = None
+    if since is not None:
+        try:
+            since_ts = datetime.fromisoformat(since).timestamp()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="since must be an ISO timestamp")
+    limit = max(1, min(limit, AUDIT_QUERY_MAX_LIMIT))
+    
+    await audit_log.flush()
+    return StreamingResponse(
+        audit_log.query(event, script_id, since_ts, limit),
+        media_type="application/x-ndjson"
+    )
 
 @app.get("/api/tokens")
 async def api_tokens():
@@ -274,21 +2971,327 @@ async def api_tokens():
         "active_tokens": len(tokens),
         "tokens": [
             {
-                "token": token[:8] + "...",
-                "script_id": data["script_id"],
-                "created_at": datetime.fromtimestamp(data["created_at"]).isoformat(),
-                "expires_at": datetime.fromtimestamp(data["expires_at"]).isoformat(),
-                "used": data["used"]
+                "token_id": token_id(selector),
+                "script_id": record.script_id,
+                "created_at": datetime.fromtimestamp(record.created_at).isoformat(),
+                "expires_at": datetime.fromtimestamp(record.expires_at).isoformat(),
+                "used": record.used,
+                "uses": record.uses,
+                "max_uses": record.max_uses
+            }
+            for selector, record in tokens.items()
+        ]
+    }
+
+async def export_chunks() -> AsyncIterator[bytes]:
+    """The snapshot as a gzip stream, built a batch of lines at a time between yields to the loop"""
+    compressor = zlib.compressobj(1, zlib.DEFLATED, 31)
+    lines = snapshot_lines()
+    exported = -1  # not counting the header line
+    while True:
+        batch = list(itertools.islice(lines, EXPORT_BATCH_LINES))
+        if not batch:
+            break
+        exported += len(batch)
+        data = compressor.compress("".join(batch).encode())
+        if data:
+            yield data
+        await asyncio.sleep(0)
+    yield compressor.flush()
+    audit_log.record(AUDIT_TOKENS_EXPORTED, entries=exported)
+
+async def upload_blocks(request: Request) -> AsyncIterator[bytes]:
+    """Request body in blocks, gunzipped when it starts with the gzip magic"""
+    stream = request.stream()
+    head = b""
+    async for chunk in stream:
+        head += chunk
+        if len(head) >= len(GZIP_MAGIC):
+            break
+    if not head.startswith(GZIP_MAGIC):
+        if head:
+            yield head
+        async for chunk in stream:
+            yield chunk
+        return
+    
+    decompressor = zlib.decompressobj(31)
+    data = head
+    while True:
+        while data:
+            # Bounded output per step keeps memory flat whatever the ratio
+            yield decompressor.decompress(data, IMPORT_BLOCK_BYTES)
+            data = decompressor.unconsumed_tail
+            if decompressor.eof:
+                # Concatenated gzip members, as left by appending to a snapshot
+                data = decompressor.unused_data
+                decompressor = zlib.decompressobj(31)
+        try:
+            data = await stream.__anext__()
+        except StopAsyncIteration:
+            break
+    yield decompressor.flush()
+
+async def upload_lines(request: Request) -> AsyncIterator[str]:
+    """NDJSON lines of an upload, yielding to the loop after every block"""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    partial = ""
+    async for block in upload_blocks(request):
+        lines = (partial + decoder.decode(block)).split("\n")
+        partial = lines.pop()
+        if len(partial) > IMPORT_MAX_LINE_BYTES:
+            raise ValueError("Line too long")
+        for line in lines:
+            yield line
+        await asyncio.sleep(0)
+    partial += decoder.decode(b"", final=True)
+    if partial:
+        yield partial
+
+def parse_token_selection(data: Dict) -> List[bytes]:
+    """Turn a revoke/extend request body into the selected token selectors"""
+    if not isinstance(data, dict):
+        raise HTTPException(status_code=400, detail="Request body must be a JSON object")
+    script_id = data.get("script_id")
+    token_ids = data.get("token_ids")
+    created_before = data.get("created_before")
+    
+    if script_id is None and token_ids is None and created_before is None:
+        raise HTTPException(
+            status_code=400,
+            detail="One of token_ids, script_id or created_before is required"
+        )
+    
+    if script_id is not None and not isinstance(script_id, str):
+        raise HTTPException(status_code=400, detail="script_id must be a string")
+    
+    if token_ids is not None:
+        if not isinstance(token_ids, list) or not all(isinstance(tid, str) for tid in token_ids):
+            raise HTTPException(status_code=400, detail="token_ids must be a list of token ids")
+        try:
+            for tid in token_ids:
+                if len(bytes.fromhex(tid)) != TOKEN_SELECTOR_SIZE:
+                    raise ValueError(tid)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid token id")
+    
+    if created_before is not None:
+        try:
+            if isinstance(created_before, str):
+                created_before = datetime.fromisoformat(created_before).timestamp()
+            elif isinstance(created_before, bool):
+                raise TypeError(created_before)
+            else:
+                created_before = float(created_before)
+            if not math.isfinite(created_before):
+                raise ValueError(created_before)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="created_before must be an ISO timestamp")
+    
+    return select_tokens(script_id, token_ids, created_before)
+
+@app.delete("/api/tokens/{token_id}")
+async def api_revoke_token(token_id: str, request: Request):
+    """Revoke a single token (admin only)"""
+    if not is_admin_request(request):
+        raise HTTPException(status_code=403, detail="Admin access required")
+    selectors = parse_token_selection({"token_ids": [token_id]})
+    if not selectors:
+        raise HTTPException(status_code=404, detail="Token not found")
+    return {"revoked": revoke_tokens(selectors)}
+
+@app.get("/api/tokens/export")
+async def api_export_tokens(request: Request):
+    """Stream live tokens and scheduled runs as gzip-compressed NDJSON (admin only).
+
+    The format is the shutdown snapshot's, so an export also works as a
+    snapshot file. Tokens are stored hashed, so it holds no usable URLs.
+    """
+    if not is_admin_request(request):
+        raise HTTPException(status_code=403, detail="Admin access required")
+    filename = f"tokens-{datetime.now().strftime('%Y%m%d-%H%M%S')}.ndjson.gz"
+    return StreamingResponse(
+        export_chunks(),
+        media_type="application/gzip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"', "Cache-Control": "no-store"}
+    )
+
+@app.post("/api/tokens/import")
+async def api_import_tokens(request: Request):
+    """Import an export, gzipped or plain NDJSON, streaming it line by line (admin only).
+
+    Entries already in the store are skipped, so a failed import can simply
+    be retried.
+    """
+    if not is_admin_request(request):
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    importer = TokenImporter()
+    lines = upload_lines(request)
+    try:
+        async for line in lines:
+            if not line.strip():
+                continue
+            header = json.loads(line)
+            if not isinstance(header, dict) or header.get("type") != "snapshot":
+                raise ValueError("Not a token export")
+            if header.get("version") != SNAPSHOT_VERSION:
+                raise ValueError(f"Unsupported export version {header.get('version')}")
+            break
+        else:
+            raise ValueError("Empty upload")
+        async for line in lines:
+            importer.add(line)
+    except (ValueError, zlib.error) as e:
+        raise HTTPException(status_code=400, detail={"error": f"Import stopped: {e}", **importer.counts})
+    
+    audit_log.record(AUDIT_TOKENS_IMPORTED, **importer.counts)
+    if ENABLE_LOGGING:
+        logger.info(f"Imported tokens: {importer.counts}")
+    return {**importer.counts, "last_error": importer.last_error}
+
+@app.get("/api/tokens/{token_id}/run")
+async def api_token_run(token_id: str, wait: float = 0, status: Optional[str] = None):
+    """Status of the latest script run started through a token.
+
+    With ``wait`` the request is held (up to RUN_WAIT_MAX_SECONDS) until the
+    run finishes or fails, or, when ``status`` is given, until it leaves
+    that state.
+    """
+    run = run_tracker.get(token_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail="No run for this token")
+    if wait > 0:
+        await run_tracker.wait(run, status, min(wait, RUN_WAIT_MAX_SECONDS))
+    return run.to_dict()
+
+@app.post("/api/tokens/revoke")
+async def api_revoke_tokens(request: Request):
+    """Revoke tokens by id, by script and/or by creation time (admin only)"""
+    if not is_admin_request(request):
+        raise HTTPException(status_code=403, detail="Admin access required")
+    data = await request.json()
+    revoked = revoke_tokens(parse_token_selection(data))
+    if ENABLE_LOGGING:
+        logger.info(f"Revoked {revoked} tokens")
+    return {"revoked": revoked}
+
+@app.post("/api/tokens/extend")
+async def api_extend_tokens(request: Request):
+    """Extend the expiry of tokens selected by id, by script and/or by creation time (admin only)"""
+    if not is_admin_request(request):
+        raise HTTPException(status_code=403, detail="Admin access required")
+    data = await request.json()
+    minutes = data.get("minutes") if isinstance(data, dict) else None
+    if isinstance(minutes, bool) or not isinstance(minutes, (int, float)) or not 0 < minutes <= MAX_EXTEND_MINUTES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"minutes must be between 0 and {MAX_EXTEND_MINUTES}"
+        )
+    
+    extended = extend_tokens(parse_token_selection(data), minutes * 60)
+    if ENABLE_LOGGING:
+        logger.info(f"Extended {extended} tokens by {minutes} minutes")
+    return {"extended": extended}
+
+@app.post("/api/schedule")
+async def api_schedule(request: Request):
+    """Queue a script run at an absolute time or after a delay (admin only)"""
+    if not is_admin_request(request):
+        raise HTTPException(status_code=403, detail="Admin access required")
+    data = await request.json()
+    script_id = data.get("script_id")
+    if not script_id:
+        raise HTTPException(status_code=400, detail="script_id is required")
+    
+    now = time.time()
+    try:
+        if data.get("run_at") is not None:
+            run_at = datetime.fromisoformat(data["run_at"]).timestamp()
+        else:
+            run_at = now + float(data.get("delay_seconds", 0))
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="run_at must be an ISO timestamp")
+    if not now - 1 <= run_at <= now + MAX_SCHEDULE_DELAY_SECONDS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Runs can be scheduled up to {MAX_SCHEDULE_DELAY_SECONDS} seconds ahead"
+        )
+    
+    if await find_script(script_id) is None:
+        raise HTTPException(status_code=404, detail="Script not found")
+    
+    run = scheduler.schedule(script_id, run_at)
+    if ENABLE_LOGGING:
+        logger.info(f"Scheduled run {run.run_id} of {script_id} for {datetime.fromtimestamp(run_at).isoformat()}")
+    return {
+        "run_id": run.run_id,
+        "script_id": run.script_id,
+        "run_at": datetime.fromtimestamp(run.run_at).isoformat()
+    }
+
+@app.get("/api/schedule")
+async def api_scheduled_runs(request: Request):
+    """List pending scheduled runs (admin only)"""
+    if not is_admin_request(request):
+        raise HTTPException(status_code=403, detail="Admin access required")
+    runs = sorted(scheduler.runs.values(), key=lambda run: run.run_at)
+    return {
+        "pending_runs": len(runs),
+        "runs": [
+            {
+                "run_id": run.run_id,
+                "script_id": run.script_id,
+                "run_at": datetime.fromtimestamp(run.run_at).isoformat(),
+                "token_id": run.token_id
             }
-            for token, data in tokens.items()
+            for run in runs
         ]
     }
 
+@app.delete("/api/schedule/{run_id}")
+async def api_cancel_scheduled_run(run_id: str, request: Request):
+    """Cancel a pending scheduled run (admin only)"""
+    if not is_admin_request(request):
+        raise HTTPException(status_code=403, detail="Admin access required")
+    run = scheduler.runs.get(run_id)
+    if not scheduler.cancel(run_id):
+        raise HTTPException(status_code=404, detail="Scheduled run not found")
+    tracked = run_tracker.get(run.token_id) if run.token_id else None
+    if tracked is not None and tracked.status == RUN_SCHEDULED:
+        run_tracker.update(tracked, RUN_FAILED, error="Scheduled run was cancelled")
+    return {"cancelled": run_id}
+
+@app.get("/api/tokens/events")
+async def api_token_events(request: Request, script_id: Optional[str] = None):
+    """Stream token lifecycle and script run events as SSE"""
+    queue = event_broadcaster.subscribe(script_id)
+
+    async def stream():
+        try:
+            yield f"retry: {SSE_KEEPALIVE_SECONDS * 1000}\n\n"
+            while True:
+                try:
+                    yield await asyncio.wait_for(queue.get(), timeout=SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": keepalive\n\n"
+        finally:
+            event_broadcaster.unsubscribe(queue)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
         port=8080,
-        log_level="info"
+        log_level="info",
+        timeout_graceful_shutdown=SHUTDOWN_GRACE_SECONDS
     ) 
\ No newline at end of file
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+"""
+QR code encoder for Script URL Generator
+Pure-Python byte-mode QR encoding (ISO/IEC 18004, versions 1-40) with SVG and PNG output
+"""
+
+import struct
+import zlib
+from typing import List, Union
+
+Matrix = List[List[bool]]
+
+# Error correction levels: (format bits, index into the tables below)
+ECC_LEVELS = {"L": (1, 0), "M": (0, 1), "Q": (3, 2), "H": (2, 3)}
+
+# Error correction codewords per block, indexed by [level][version]
+ECC_CODEWORDS_PER_BLOCK = (
+    (-1, 7, 10, 15, 20, 26, 18, 20, 24, 30, 18, 20, 24, 26, 30, 22, 24, 28, 30, 28, 28,
+     28, 28, 30, 30, 26, 28, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30),
+    (-1, 10, 16, 26, 18, 24, 16, 18, 22, 22, 26, 30, 22, 22, 24, 24, 28, 28, 26, 26, 26,
+     26, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28),
+    (-1, 13, 22, 18, 26, 18, 24, 18, 22, 20, 24, 28, 26, 24, 20, 30, 24, 28, 28, 26, 30,
+     28, 30, 30, 30, 30, 28, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30),
+    (-1, 17, 28, 22, 16, 22, 28, 26, 26, 24, 28, 24, 28, 22, 24, 24, 30, 28, 28, 26, 28,
+     30, 24, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30),
+)
+
+# Error correction blocks, indexed by [level][version]
+ERROR_CORRECTION_BLOCKS = (
+    (-1, 1, 1, 1, 1, 1, 2, 2, 2, 2, 4, 4, 4, 4, 4, 6, 6, 6, 6, 7, 8,
+     8, 9, 9, 10, 12, 12, 12, 13, 14, 15, 16, 17, 18, 19, 19, 20, 21, 22, 24, 25),
+    (-1, 1, 1, 1, 2, 2, 4, 4, 4, 5, 5, 5, 8, 9, 9, 10, 10, 11, 13, 14, 16,
+     17, 17, 18, 20, 21, 23, 25, 26, 28, 29, 31, 33, 35, 37, 38, 40, 43, 45, 47, 49),
+    (-1, 1, 1, 2, 2, 4, 4, 6, 6, 8, 8, 8, 10, 12, 16, 12, 17, 16, 18, 21, 20,
+     23, 23, 25, 27, 29, 34, 34, 35, 38, 40, 43, 45, 48, 51, 53, 56, 59, 62, 65, 68),
+    (-1, 1, 1, 2, 4, 4, 4, 5, 6, 8, 8, 11, 11, 16, 16, 18, 16, 19, 21, 25, 25,
+     25, 34, 30, 32, 35, 37, 40, 42, 45, 48, 51, 54, 57, 60, 63, 66, 70, 74, 77, 81),
+)
+
+MIN_VERSION = 1
+MAX_VERSION = 40
+BYTE_MODE = 0x4
+DEFAULT_BORDER = 4
+
+def raw_data_modules(version: int) -> int:
+    """Modules left for data and error correction after the function patterns"""
+    result = (16 * version + 128) * version + 64
+    if version >= 2:
+        alignments = version // 7 + 2
+        result -= (25 * alignments - 10) * alignments - 55
+        if version >= 7:
+            result -= 36
+    return result
+
+def data_codewords(version: int, level: int) -> int:
+    return (raw_data_modules(version) // 8
+            - ECC_CODEWORDS_PER_BLOCK[level][version] * ERROR_CORRECTION_BLOCKS[level][version])
+
+def capacity(version: int, ecc: str = "M") -> int:
+    """Bytes of payload that fit in a symbol of this version and level"""
+    header_bits = 4 + (8 if version < 10 else 16)
+    return (data_codewords(version, ECC_LEVELS[ecc][1]) * 8 - header_bits) // 8
+
+# GF(256) arithmetic for Reed-Solomon, reduced by x^8 + x^4 + x^3 + x^2 + 1
+GF_EXP = [0] * 512
+GF_LOG = [0] * 256
+_value = 1
+for _power in range(255):
+    GF_EXP[_power] = _value
+    GF_LOG[_value] = _power
+    _value <<= 1
+    if _value & 0x100:
+        _value ^= 0x11D
+for _power in range(255, 512):
+    GF_EXP[_power] = GF_EXP[_power - 255]
+
+def gf_multiply(x: int, y: int) -> int:
+    if x == 0 or y == 0:
+        return 0
+    return GF_EXP[GF_LOG[x] + GF_LOG[y]]
+
+def reed_solomon_divisor(degree: int) -> List[int]:
+    """Generator polynomial coefficients, highest power first (leading 1 omitted)"""
+    result = [0] * (degree - 1) + [1]
+    root = 1
+    for _ in range(degree):
+        for j in range(degree):
+            result[j] = gf_multiply(result[j], root)
+            if j + 1 < degree:
+                result[j] ^= result[j + 1]
+        root = gf_multiply(root, 0x02)
+    return result
+
+def reed_solomon_remainder(data: List[int], divisor: List[int]) -> List[int]:
+    result = [0] * len(divisor)
+    for byte in data:
+        factor = byte ^ result.pop(0)
+        result.append(0)
+        if factor:
+            for i, coefficient in enumerate(divisor):
+                result[i] ^= gf_multiply(coefficient, factor)
+    return result
+
+def fits(length: int, version: int, level: int) -> bool:
+    header_bits = 4 + (8 if version < 10 else 16)
+    return header_bits + length * 8 <= data_codewords(version, level) * 8
+
+def choose_version(length: int, level: int) -> int:
+    for version in range(MIN_VERSION, MAX_VERSION + 1):
+        if fits(length, version, level):
+            return version
+    raise ValueError(f"Data too long for a QR code ({length} bytes)")
+
+def build_codewords(data: bytes, version: int, level: int) -> List[int]:
+    """Byte-mode segment, terminator and padding, split into blocks with error correction"""
+    bits: List[int] = []
+
+    def append_bits(value: int, count: int):
+        bits.extend((value >> i) & 1 for i in reversed(range(count)))
+
+    capacity_bits = data_codewords(version, level) * 8
+    append_bits(BYTE_MODE, 4)
+    append_bits(len(data), 8 if version < 10 else 16)
+    for byte in data:
+        append_bits(byte, 8)
+    append_bits(0, min(4, capacity_bits - len(bits)))
+    append_bits(0, -len(bits) % 8)
+    pad = 0xEC
+    while len(bits) < capacity_bits:
+        append_bits(pad, 8)
+        pad ^= 0xEC ^ 0x11
+
+    codewords = [
+        int("".join(map(str, bits[i:i + 8])), 2) for i in range(0, len(bits), 8)
+    ]
+
+    blocks_count = ERROR_CORRECTION_BLOCKS[level][version]
+    ecc_length = ECC_CODEWORDS_PER_BLOCK[level][version]
+    raw_codewords = raw_data_modules(version) // 8
+    short_blocks = blocks_count - raw_codewords % blocks_count
+    short_length = raw_codewords // blocks_count
+
+    divisor = reed_solomon_divisor(ecc_length)
+    blocks = []
+    offset = 0
+    for i in range(blocks_count):
+        length = short_length - ecc_length + (0 if i < short_blocks else 1)
+        block = codewords[offset:offset + length]
+        offset += length
+        ecc = reed_solomon_remainder(block, divisor)
+        if i < short_blocks:
+            block.append(0)  # placeholder so all blocks interleave column by column
+        blocks.append(block + ecc)
+
+    result = []
+    for i in range(len(blocks[0])):
+        for j, block in enumerate(blocks):
+            if i != short_length - ecc_length or j >= short_blocks:
+                result.append(block[i])
+    return result
+
+def alignment_positions(version: int) -> List[int]:
+    if version == 1:
+        return []
+    count = version // 7 + 2
+    step = (version * 8 + count * 3 + 5) // (count * 4 - 4) * 2
+    size = version * 4 + 17
+    return [6] + [size - 7 - i * step for i in reversed(range(count - 1))]
+
+class QRSymbol:
+    """Module grid of one QR symbol while it is being drawn"""
+
+    def __init__(self, version: int, ecc_format: int):
+        self.version = version
+        self.ecc_format = ecc_format
+        self.size = version * 4 + 17
+        self.modules: Matrix = [[False] * self.size for _ in range(self.size)]
+        self.function: Matrix = [[False] * self.size for _ in range(self.size)]
+        self.draw_function_patterns()
+
+    def set_function(self, x: int, y: int, dark: bool):
+        self.modules[y][x] = dark
+        self.function[y][x] = True
+
+    def draw_function_patterns(self):
+        size = self.size
+        for i in range(size):
+            self.set_function(6, i, i % 2 == 0)
+            self.set_function(i, 6, i % 2 == 0)
+
+        for cx, cy in ((3, 3), (size - 4, 3), (3, size - 4)):
+            for dy in range(-4, 5):
+                for dx in range(-4, 5):
+                    x, y = cx + dx, cy + dy
+                    if 0 <= x < size and 0 <= y < size:
+                        self.set_function(x, y, max(abs(dx), abs(dy)) not in (2, 4))
+
+        positions = alignment_positions(self.version)
+        last = len(positions) - 1
+        for i, cx in enumerate(positions):
+            for j, cy in enumerate(positions):
+                if (i, j) in ((0, 0), (0, last), (last, 0)):
+                    continue  # these corners hold finder patterns
+                for dy in range(-2, 3):
+                    for dx in range(-2, 3):
+                        self.set_function(cx + dx, cy + dy, max(abs(dx), abs(dy)) != 1)
+
+        self.draw_format_bits(0)  # reserve the area; redrawn once the mask is known
+        self.draw_version()
+
+    def draw_format_bits(self, mask: int):
+        data = self.ecc_format << 3 | mask
+        remainder = data
+        for _ in range(10):
+            remainder = (remainder << 1) ^ ((remainder >> 9) * 0x537)
+        bits = (data << 10 | remainder) ^ 0x5412
+
+        def bit(i: int) -> bool:
+            return (bits >> i) & 1 != 0
+
+        size = self.size
+        for i in range(6):
+            self.set_function(8, i, bit(i))
+        self.set_function(8, 7, bit(6))
+        self.set_function(8, 8, bit(7))
+        self.set_function(7, 8, bit(8))
+        for i in range(9, 15):
+            self.set_function(14 - i, 8, bit(i))
+
+        for i in range(8):
+            self.set_function(size - 1 - i, 8, bit(i))
+        for i in range(8, 15):
+            self.set_function(8, size - 15 + i, bit(i))
+        self.set_function(8, size - 8, True)
+
+    def draw_version(self):
+        if self.version < 7:
+            return
+        remainder = self.version
+        for _ in range(12):
+            remainder = (remainder << 1) ^ ((remainder >> 11) * 0x1F25)
+        bits = self.version << 12 | remainder
+        for i in range(18):
+            dark = (bits >> i) & 1 != 0
+            a, b = self.size - 11 + i % 3, i // 3
+            self.set_function(a, b, dark)
+            self.set_function(b, a, dark)
+
+    def draw_codewords(self, codewords: List[int]):
+        """Place data bits in the zigzag order, two columns at a time from the right"""
+        size = self.size
+        total_bits = len(codewords) * 8
+        i = 0
+        right = size - 1
+        while right >= 1:
+            if right == 6:
+                right = 5  # skip the vertical timing pattern
+            upward = (right + 1) & 2 == 0
+            for vertical in range(size):
+                y = size - 1 - vertical if upward else vertical
+                for x in (right, right - 1):
+                    if not self.function[y][x] and i < total_bits:
+                        self.modules[y][x] = (codewords[i >> 3] >> (7 - (i & 7))) & 1 != 0
+                        i += 1
+            right -= 2
+
+    def apply_mask(self, mask: int):
+        condition = MASK_PATTERNS[mask]
+        for y in range(self.size):
+            row = self.modules[y]
+            function = self.function[y]
+            for x in range(self.size):
+                if not function[x] and condition(x, y):
+                    row[x] = not row[x]
+
+    def penalty(self) -> int:
+        """Mask penalty score; lower scores are easier to scan"""
+        size = self.size
+        modules = self.modules
+        score = 0
+        lines = modules + [list(column) for column in zip(*modules)]
+
+        for line in lines:
+            run_color, run_length = line[0], 0
+            for dark in line:
+                if dark == run_color:
+                    run_length += 1
+                else:
+                    if run_length >= 5:
+                        score += run_length - 2
+                    run_color, run_length = dark, 1
+            if run_length >= 5:
+                score += run_length - 2
+
+            padded = "0000" + "".join("1" if dark else "0" for dark in line) + "0000"
+            for pattern in FINDER_LIKE_PATTERNS:
+                start = padded.find(pattern)
+                while start != -1:
+                    score += 40
+                    start = padded.find(pattern, start + 1)
+
+        for y in range(size - 1):
+            for x in range(size - 1):
+                color = modules[y][x]
+                if color == modules[y][x + 1] == modules[y + 1][x] == modules[y + 1][x + 1]:
+                    score += 3
+
+        dark = sum(sum(row) for row in modules)
+        total = size * size
+        score += ((abs(dark * 20 - total * 10) + total - 1) // total - 1) * 10
+        return score
+
+MASK_PATTERNS = (
+    lambda x, y: (x + y) % 2 == 0,
+    lambda x, y: y % 2 == 0,
+    lambda x, y: x % 3 == 0,
+    lambda x, y: (x + y) % 3 == 0,
+    lambda x, y: (x // 3 + y // 2) % 2 == 0,
+    lambda x, y: x * y % 2 + x * y % 3 == 0,
+    lambda x, y: (x * y % 2 + x * y % 3) % 2 == 0,
+    lambda x, y: ((x + y) % 2 + x * y % 3) % 2 == 0,
+)
+
+FINDER_LIKE_PATTERNS = ("10111010000", "00001011101")
+
+def encode(data: Union[str, bytes], ecc: str = "M") -> Matrix:
+    """Encode data as a QR code and return its module grid (True is dark).
+
+    The smallest version that fits is used, and the error correction level
+    is raised for free when the data still fits that version.
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    if ecc not in ECC_LEVELS:
+        raise ValueError(f"Unknown error correction level: {ecc}")
+
+    level = ECC_LEVELS[ecc][1]
+    version = choose_version(len(data), level)
+    for candidate in ("M", "Q", "H"):
+        candidate_level = ECC_LEVELS[candidate][1]
+        if candidate_level > level and fits(len(data), version, candidate_level):
+            ecc, level = candidate, candidate_level
+
+    symbol = QRSymbol(version, ECC_LEVELS[ecc][0])
+    symbol.draw_codewords(build_codewords(data, version, level))
+
+    best_mask, best_score = 0, None
+    for mask in range(len(MASK_PATTERNS)):
+        symbol.apply_mask(mask)
+        symbol.draw_format_bits(mask)
+        score = symbol.penalty()
+        if best_score is None or score < best_score:
+            best_mask, best_score = mask, score
+        symbol.apply_mask(mask)  # XOR again to undo
+    symbol.apply_mask(best_mask)
+    symbol.draw_format_bits(best_mask)
+    return symbol.modules
+
+def to_svg(matrix: Matrix, scale: int = 8, border: int = DEFAULT_BORDER) -> str:
+    """Render a module grid as a compact SVG document"""
+    size = len(matrix) + border * 2
+    path = "".join(
+        f"M{x + border},{y + border}h1v1h-1z"
+        for y, row in enumerate(matrix)
+        for x, dark in enumerate(row)
+        if dark
+    )
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" version="1.1" viewBox="0 0 {size} {size}" '
+        f'width="{size * scale}" height="{size * scale}" shape-rendering="crispEdges">'
+        f'<rect width="100%" height="100%" fill="#ffffff"/>'
+        f'<path d="{path}" fill="#000000"/></svg>'
+    )
+
+def to_png(matrix: Matrix, scale: int = 8, border: int = DEFAULT_BORDER) -> bytes:
+    """Render a module grid as a 1-bit grayscale PNG"""
+    modules = len(matrix) + border * 2
+    width = modules * scale
+    row_bytes = (width + 7) // 8
+    blank = b"\x00" + b"\xff" * row_bytes
+
+    rows = []
+    for y in range(-border, len(matrix) + border):
+        if 0 <= y < len(matrix):
+            light = [True] * border + [not dark for dark in matrix[y]] + [True] * border
+            bits = "".join(("1" if module else "0") * scale for module in light)
+            bits += "1" * (-len(bits) % 8)
+            line = b"\x00" + int(bits, 2).to_bytes(row_bytes, "big")
+        else:
+            line = blank
+        rows.extend([line] * scale)
+
+    def chunk(kind: bytes, body: bytes) -> bytes:
+        return struct.pack(">I", len(body)) + kind + body + struct.pack(">I", zlib.crc32(kind + body))
+
+    header = struct.pack(">IIBBBBB", width, width, 1, 0, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", header)
+        + chunk(b"IDAT", zlib.compress(b"".join(rows), 9))
+        + chunk(b"IEND", b"")
+    )
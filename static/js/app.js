@@ -5,12 +5,43 @@ class ScriptUrlGenerator {
         this.currentUrl = null;
         this.expiryTime = null;
         this.countdownInterval = null;
+        this.eventSource = null;
         this.init();
     }
 
     init() {
         this.bindEvents();
         this.updateExpiryDisplay();
+        this.loadScripts();
+    }
+
+    async loadScripts() {
+        const scriptSelect = document.getElementById('scriptSelect');
+        if (!scriptSelect) return;
+
+        try {
+            const response = await fetch('api/scripts');
+            if (!response.ok) {
+                throw new Error(`HTTP ${response.status}`);
+            }
+
+            const scripts = await response.json();
+            scriptSelect.innerHTML = '';
+            scriptSelect.appendChild(new Option(
+                scripts.length ? 'Choose a script...' : 'No scripts found', ''
+            ));
+            scripts.forEach((script) => {
+                const label = script.backend ? `${script.name} (${script.backend})` : script.name;
+                scriptSelect.appendChild(new Option(label, script.entity_id));
+            });
+            scriptSelect.disabled = false;
+
+        } catch (error) {
+            console.error('Error loading scripts:', error);
+            scriptSelect.innerHTML = '';
+            scriptSelect.appendChild(new Option('Failed to load scripts', ''));
+            this.showError('Failed to load scripts from Home Assistant');
+        }
     }
 
     bindEvents() {
@@ -25,6 +56,8 @@ class ScriptUrlGenerator {
         
         const formData = new FormData(e.target);
         const scriptId = formData.get('script_id');
+        const maxUses = parseInt(formData.get('max_uses'), 10) || 1;
+        const minInterval = parseFloat(formData.get('min_interval_seconds')) || 0;
         
         if (!scriptId) {
             this.showError('Please select a script');
@@ -34,12 +67,17 @@ class ScriptUrlGenerator {
         this.showLoading(true);
         
         try {
-            const response = await fetch('/api/generate', {
+            const response = await fetch('api/generate', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
                 },
-                body: JSON.stringify({ script_id: scriptId })
+                body: JSON.stringify({
+                    script_id: scriptId,
+                    max_uses: maxUses,
+                    min_interval_seconds: minInterval,
+                    qr: 'svg'
+                })
             });
 
             if (!response.ok) {
@@ -49,6 +87,7 @@ class ScriptUrlGenerator {
 
             const data = await response.json();
             this.displayGeneratedUrl(data);
+            this.watchToken(scriptId, data.token_id);
             
         } catch (error) {
             console.error('Error generating URL:', error);
@@ -64,6 +103,11 @@ class ScriptUrlGenerator {
         
         // Update UI
         document.getElementById('generatedUrl').value = data.url;
+        document.getElementById('qrCode').src = data.qr || '';
+        document.getElementById('tokenStatus').textContent = 'Active';
+        document.getElementById('usesInfo').textContent = data.max_uses > 1
+            ? `Up to ${data.max_uses} uses`
+            : 'Single use only';
         document.getElementById('resultCard').style.display = 'block';
         
         // Start countdown
@@ -76,6 +120,56 @@ class ScriptUrlGenerator {
         });
     }
 
+    watchToken(scriptId, tokenId) {
+        // Listen for server-side lifecycle events of the generated token
+        this.stopWatching();
+        if (!window.EventSource) return;
+
+        const labels = { consumed: 'Used', expired: 'Expired', revoked: 'Revoked', evicted: 'Evicted' };
+        
+        this.eventSource = new EventSource(
+            `api/tokens/events?script_id=${encodeURIComponent(scriptId)}`
+        );
+        this.eventSource.onmessage = (message) => {
+            const event = JSON.parse(message.data);
+            const tokenIds = event.token_ids || [event.token_id];
+            if (!tokenIds.includes(tokenId)) return;
+            
+            if (event.type === 'run') {
+                const runLabels = { started: 'Running', finished: 'Finished', failed: 'Failed' };
+                if (runLabels[event.status]) {
+                    document.getElementById('tokenStatus').textContent = runLabels[event.status];
+                }
+                return;
+            }
+            if (event.type === 'extended') {
+                if (this.expiryTime) {
+                    this.expiryTime = new Date(
+                        this.expiryTime.getTime() + event.extended_by_seconds * 1000
+                    );
+                }
+                return;
+            }
+            if (!labels[event.type]) return;
+            
+            let label = labels[event.type];
+            if (event.type === 'consumed' && event.remaining_uses > 0) {
+                label = `${label} (${event.remaining_uses} left)`;
+            }
+            document.getElementById('tokenStatus').textContent = label;
+            if (event.type !== 'consumed') {
+                this.stopWatching();
+            }
+        };
+    }
+
+    stopWatching() {
+        if (this.eventSource) {
+            this.eventSource.close();
+            this.eventSource = null;
+        }
+    }
+
     startCountdown() {
         this.updateExpiryDisplay();
         
@@ -192,6 +286,7 @@ function generateNew() {
         clearInterval(app.countdownInterval);
         app.countdownInterval = null;
     }
+    app.stopWatching();
     
     // Scroll to top
     window.scrollTo({ top: 0, behavior: 'smooth' });
@@ -193,12 +193,831 @@ def test_token_generation():
     cleanup_expired_tokens()
     print("✓ Token cleanup works")
 
+def test_static_asset_pipeline():
+    """Test static asset fingerprinting and precompression"""
+    print("Testing static asset pipeline...")
+    
+    import gzip
+    from main import asset_manifest, static_assets, select_asset_body
+    
+    hashed_path = asset_manifest["css/style.css"]
+    assert hashed_path.startswith("css/style.") and hashed_path.endswith(".css")
+    assert static_assets[hashed_path] is static_assets["css/style.css"]
+    
+    asset = static_assets[hashed_path]
+    body, encoding = select_asset_body(asset, "gzip, deflate")
+    assert encoding == "gzip"
+    assert gzip.decompress(body) == asset.body
+    
+    # Refused encodings fall back to the identity body
+    body, encoding = select_asset_body(asset, "gzip;q=0, br;q=0")
+    assert encoding is None
+    assert body == asset.body
+    
+    # Conditional requests match any listed tag, weakly, or "*"
+    from main import etag_matches
+    assert etag_matches(f'"other", {asset.etag}', asset.etag)
+    assert etag_matches(asset.etag.removeprefix("W/"), asset.etag)
+    assert etag_matches("*", asset.etag)
+    assert not etag_matches('"other"', asset.etag) and not etag_matches("", asset.etag)
+    
+    # HEAD is answered like GET, without a body
+    import httpx
+    import main
+    
+    async def head():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://addon") as client:
+            return await client.head(f"/static/{hashed_path}")
+    
+    response = asyncio.run(head())
+    assert response.status_code == 200 and not response.content
+    assert response.headers["etag"] == asset.etag
+    
+    print("✓ Static asset pipeline works")
+
+def test_index_page_shell():
+    """Test that the index page renders without waiting on Home Assistant"""
+    print("Testing index page shell...")
+    
+    import httpx
+    import main
+    
+    async def hang():
+        await asyncio.Event().wait()
+    
+    async def scenario():
+        main.index_cache.clear()
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://addon") as client:
+            response = await asyncio.wait_for(client.get("/"), timeout=2)
+            assert response.status_code == 200
+            assert f'src="/static/{main.asset_manifest["js/app.js"]}"' in response.text
+            
+            # Behind ingress the browser only reaches assets below X-Ingress-Path
+            ingress = {"X-Ingress-Path": "/api/hassio_ingress/abc_DEF-123"}
+            response = await client.get("/", headers=ingress)
+            assert f'href="/api/hassio_ingress/abc_DEF-123/static/{main.asset_manifest["css/style.css"]}"' in response.text
+            assert f'src="/api/hassio_ingress/abc_DEF-123/static/{main.asset_manifest["js/app.js"]}"' in response.text
+            assert "http://addon" not in response.text
+            
+            response = await client.get("/", headers={"X-Ingress-Path": '"><script>'})
+            assert f'src="/static/{main.asset_manifest["js/app.js"]}"' in response.text
+    
+    original_get_scripts = main.get_scripts
+    main.get_scripts = hang
+    try:
+        asyncio.run(scenario())
+    finally:
+        main.get_scripts = original_get_scripts
+        main.index_cache.clear()
+    
+    # Under ingress the page lives below /api/hassio_ingress/<token>/, so its API calls must be relative
+    script = main.static_assets["js/app.js"].body.decode()
+    assert "api/scripts" in script and "'/api/" not in script and "`/api/" not in script
+    
+    print("✓ Index page shell works")
+
+def test_token_events():
+    """Test token lifecycle event fan-out"""
+    print("Testing token events...")
+    
+    from main import create_token, event_broadcaster, hash_token, token_id
+    
+    async def scenario():
+        queue = event_broadcaster.subscribe("script.events")
+        other = event_broadcaster.subscribe("script.other")
+        try:
+            token, _ = create_token("script.events")
+            frame = queue.get_nowait()
+            assert frame.startswith("data: ")
+            event = json.loads(frame[len("data: "):])
+            assert event["type"] == "created"
+            assert event["token_id"] == token_id(hash_token(token)[0])
+            assert other.empty()  # filtered by script_id
+        finally:
+            event_broadcaster.unsubscribe(queue)
+            event_broadcaster.unsubscribe(other)
+    
+    asyncio.run(scenario())
+    print("✓ Token events work")
+
+def test_multi_use_tokens():
+    """Test use counting and the minimum interval between uses"""
+    print("Testing multi-use tokens...")
+    
+    from main import create_token, claim_token_use, find_token
+    
+    token, token_data = create_token("script.test", max_uses=2, min_interval_seconds=60)
+    assert token_data.remaining_uses == 2
+    
+    claimed, error = claim_token_use(token)
+    assert error is None
+    assert claimed.remaining_uses == 1
+    
+    # Second use inside the interval is refused without consuming a use
+    claimed, error = claim_token_use(token)
+    assert claimed is None
+    assert "too recently" in error
+    
+    _, record = find_token(token)
+    record.last_used_at -= 60
+    claimed, error = claim_token_use(token)
+    assert claimed.used and claimed.remaining_uses == 0
+    
+    claimed, error = claim_token_use(token)
+    assert "already been used" in error
+    
+    print("✓ Multi-use tokens work")
+
+def test_idempotency_cache():
+    """Test that retries with the same Idempotency-Key reuse one response"""
+    print("Testing idempotency cache...")
+    
+    from fastapi import HTTPException
+    import main
+    from main import IdempotencyCache
+    
+    calls = []
+    
+    async def generate():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"token": f"token-{len(calls)}"}
+    
+    async def scenario():
+        cache = IdempotencyCache(max_entries=2)
+        payload = {"script_id": "script.test"}
+        
+        # Concurrent retries share the in-flight request
+        first, second = await asyncio.gather(
+            cache.run("key-1", payload, generate),
+            cache.run("key-1", payload, generate)
+        )
+        assert first == second == {"token": "token-1"}
+        assert len(calls) == 1
+        
+        # Reusing a key for a different request is rejected
+        try:
+            await cache.run("key-1", {"script_id": "script.other"}, generate)
+            assert False, "expected HTTPException"
+        except HTTPException as e:
+            assert e.status_code == 422
+        
+        # The cache stays bounded
+        await cache.run("key-2", payload, generate)
+        await cache.run("key-3", payload, generate)
+        assert list(cache.entries) == ["key-2", "key-3"]
+        
+        # Responses are dropped once a token they minted is used or removed
+        async def minted():
+            return {"token": "secret", "token_id": "ab" * 16}
+        
+        await cache.run("key-4", payload, minted)
+        assert "key-4" in cache.entries
+        cache.forget_token("ab" * 16)
+        assert "key-4" not in cache.entries and not cache.keys_by_token
+        
+        # ... and only kept for a short retry window
+        await cache.run("key-5", payload, minted)
+        assert cache.entries["key-5"].expires_at <= time.time() + main.IDEMPOTENCY_RETRY_SECONDS
+    
+    async def redeemed():
+        token, _ = main.create_token("script.test")
+        response = {"token": token, "token_id": main.token_id(main.hash_token(token)[0])}
+        
+        async def generate_once():
+            return response
+        
+        await main.idempotency_cache.run("key-6", {}, generate_once)
+        assert "key-6" in main.idempotency_cache.entries
+        main.claim_token_use(token)
+        assert "key-6" not in main.idempotency_cache.entries
+        main.remove_token(main.hash_token(token)[0])
+    
+    asyncio.run(scenario())
+    asyncio.run(redeemed())
+    print("✓ Idempotency cache works")
+
+def test_hashed_token_store():
+    """Test that the store keeps only token digests"""
+    print("Testing hashed token store...")
+    
+    from main import create_token, get_token_data, hash_token, tokens
+    
+    token, _ = create_token("script.test")
+    selector, verifier = hash_token(token)
+    assert len(selector) == 16 and len(verifier) == 16
+    assert token not in tokens
+    assert tokens[selector].verifier == verifier
+    assert get_token_data(token) is not None
+    
+    # A token with the same selector but a different verifier is rejected
+    tokens[selector].verifier = bytes(16)
+    assert get_token_data(token) is None
+    
+    print("✓ Hashed token store works")
+
+def test_revocation_and_extension():
+    """Test bulk revocation and expiry extension through the script index"""
+    print("Testing revocation and extension...")
+    
+    from main import (create_token, extend_tokens, get_token_data, revoke_tokens,
+                      script_index, select_tokens)
+    
+    kept, _ = create_token("script.keep")
+    revoked = [create_token("script.revoke")[0] for _ in range(3)]
+    
+    selectors = select_tokens(script_id="script.keep")
+    assert len(selectors) == 1
+    before = get_token_data(kept).expires_at
+    assert extend_tokens(selectors, 300) == 1
+    assert get_token_data(kept).expires_at == before + 300
+    
+    # Repeated extensions stop at the lifetime cap
+    import main
+    record = main.tokens[selectors[0]]
+    latest = record.created_at + (main.TOKEN_EXPIRY_MINUTES + main.MAX_EXTEND_MINUTES) * 60
+    assert extend_tokens(selectors, main.MAX_EXTEND_MINUTES * 60) == 1
+    assert record.expires_at == latest
+    assert extend_tokens(selectors, 60) == 0
+    assert record.expires_at == latest
+    
+    assert revoke_tokens(select_tokens(script_id="script.revoke")) == 3
+    assert "script.revoke" not in script_index
+    assert all(get_token_data(token) is None for token in revoked)
+    assert get_token_data(kept) is not None
+    
+    # Malformed selections are client errors, not crashes
+    from fastapi import HTTPException
+    from main import parse_token_selection
+    for body in ([1], {"script_id": ["x"]}, {"created_before": float("nan")}, {"created_before": True},
+                 {"token_ids": "abc"}):
+        try:
+            parse_token_selection(body)
+        except HTTPException as e:
+            assert e.status_code == 400, body
+        else:
+            raise AssertionError(f"accepted {body}")
+    
+    # Revoking and extending are admin operations
+    import httpx
+    
+    async def endpoints():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://addon") as client:
+            body = {"script_id": "script.keep", "minutes": 5}
+            for method, path in (("POST", "/api/tokens/revoke"), ("POST", "/api/tokens/extend"),
+                                 ("DELETE", f"/api/tokens/{'00' * 16}")):
+                response = await client.request(method, path, json=body if method == "POST" else None)
+                assert response.status_code == 403, path
+            response = await client.post("/api/tokens/revoke", json=body, headers=admin)
+            assert response.json() == {"revoked": 1}
+    
+    admin = {"Authorization": "Bearer revoke-admin"}
+    saved = main.ADMIN_TOKEN
+    main.ADMIN_TOKEN = "revoke-admin"
+    try:
+        asyncio.run(endpoints())
+    finally:
+        main.ADMIN_TOKEN = saved
+    assert get_token_data(kept) is None
+    
+    print("✓ Revocation and extension work")
+
+def test_trigger_scheduler():
+    """Test that scheduled runs fire from the single dispatcher"""
+    print("Testing trigger scheduler...")
+    
+    import main
+    
+    triggered = []
+    
+    async def fake_trigger(script_id):
+        triggered.append(script_id)
+        return True
+    
+    async def scenario():
+        scheduler = main.TriggerScheduler()
+        dispatcher = asyncio.create_task(scheduler.run_forever())
+        await asyncio.sleep(0)
+        
+        now = time.time()
+        scheduler.schedule("script.later", now + 0.1)
+        scheduler.schedule("script.sooner", now + 0.05)
+        cancelled = scheduler.schedule("script.cancelled", now + 0.05)
+        assert scheduler.cancel(cancelled.run_id)
+        
+        await asyncio.sleep(0.2)
+        dispatcher.cancel()
+        assert triggered == ["script.sooner", "script.later"]
+        assert not scheduler.runs
+    
+    original_trigger = main.trigger_script
+    main.trigger_script = fake_trigger
+    try:
+        asyncio.run(scenario())
+    finally:
+        main.trigger_script = original_trigger
+    
+    # Scheduling, listing and cancelling runs are admin operations
+    import httpx
+    
+    async def endpoints():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://addon") as client:
+            for method, path in (("POST", "/api/schedule"), ("GET", "/api/schedule"), ("DELETE", "/api/schedule/abc")):
+                response = await client.request(method, path, json={"script_id": "script.x"} if method == "POST" else None)
+                assert response.status_code == 403, path
+    
+    asyncio.run(endpoints())
+    
+    print("✓ Trigger scheduler works")
+
+def test_upstream_limiter():
+    """Test global and per-script concurrency limits and AIMD backoff"""
+    print("Testing upstream limiter...")
+    
+    from main import UpstreamLimiter
+    
+    async def scenario():
+        limiter = UpstreamLimiter(max_limit=3, per_script_limit=1)
+        running = {"total": 0, "peak": 0, "script.a": 0, "peak_a": 0}
+        
+        def make_call(script_id):
+            async def call():
+                running["total"] += 1
+                running["peak"] = max(running["peak"], running["total"])
+                if script_id == "script.a":
+                    running["script.a"] += 1
+                    running["peak_a"] = max(running["peak_a"], running["script.a"])
+                await asyncio.sleep(0.01)
+                running["total"] -= 1
+                if script_id == "script.a":
+                    running["script.a"] -= 1
+                return True
+            return call
+        
+        script_ids = ["script.a"] * 4 + [f"script.{i}" for i in range(6)]
+        results = await asyncio.gather(*(limiter.run(sid, make_call(sid)) for sid in script_ids))
+        assert all(results)
+        assert running["peak"] == 3
+        assert running["peak_a"] == 1
+        assert not limiter.script_limiters  # idle per-script limiters are dropped
+        assert limiter.metrics()["calls"] == 10
+        
+        # Adaptive mode halves the limit on failure
+        adaptive = UpstreamLimiter(max_limit=8, per_script_limit=8, adaptive=True)
+        assert adaptive.global_limiter.limit == 4
+        adaptive.record_result(0.05, False)
+        assert adaptive.global_limiter.limit == 2
+    
+    asyncio.run(scenario())
+    print("✓ Upstream limiter works")
+
+def test_audit_log():
+    """Test batched audit writes, rotation and streaming queries"""
+    print("Testing audit log...")
+    import tempfile
+    from main import AuditLog
+    
+    async def query(audit, **filters):
+        return b"".join([chunk async for chunk in audit.query(**filters)]).splitlines(keepends=True)
+    
+    async def scenario(directory):
+        audit = AuditLog(os.path.join(directory, "audit.ndjson"), max_bytes=400, backups=2)
+        for i in range(20):
+            audit.record("token_created", script_id=f"script.s{i % 2}", token_id=f"{i:032x}")
+        audit.record("token_rejected", token_id="ff" * 16, reason="expired")
+        await audit.flush()
+        assert not audit.queue
+        
+        # Records are compact one-line JSON
+        first, = await query(audit, limit=1)
+        assert b'", "' not in first and json.loads(first)["event"] == "token_created"
+        
+        # Oversized batches rotate the previous file and older backups are dropped
+        for _ in range(10):
+            audit.record("trigger_result", script_id="script.s0", success=True)
+            await audit.flush()
+        assert [p.name for p in audit.files()] == ["audit.ndjson.2", "audit.ndjson.1", "audit.ndjson"]
+        
+        results = [json.loads(line) for line in await query(audit, event="trigger_result", script_id="script.s0")]
+        assert results and all(r["event"] == "trigger_result" for r in results)
+        assert len(await query(audit, event="trigger_result", limit=3)) == 3
+        assert not await query(audit, since=time.time() + 60)
+        
+        # Concurrent flushes (writer, /api/audit, shutdown) take turns on the file
+        audit = AuditLog(os.path.join(directory, "busy.ndjson"), max_bytes=20000, backups=100)
+        
+        async def busy_flush(i):
+            for _ in range(10):
+                for _ in range(25):
+                    audit.record("trigger_result", script_id=f"script.s{i}", success=True)
+                await audit.flush()
+        
+        await asyncio.gather(*(busy_flush(i) for i in range(8)))
+        assert all(path.stat().st_size <= 20000 for path in audit.files())
+        assert sum(len(path.read_bytes().splitlines()) for path in audit.files()) == audit.written == 2000
+        
+        # Records hold client addresses and token history, so the endpoint is admin only
+        import httpx
+        import main
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://addon") as client:
+            assert (await client.get("/api/audit")).status_code == 403
+    
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(scenario(directory))
+    print("✓ Audit log works")
+
+def test_profiling_and_loop_lag():
+    """Test sampled request profiling and event loop stall reports"""
+    print("Testing profiling and loop lag monitor...")
+    
+    import main
+    from main import LoopLagMonitor, RequestProbe, loop_monitor, request_profiler
+    
+    async def slow_app(scope, receive, send):
+        time.sleep(0.05)  # deliberately block the loop
+    
+    async def scenario():
+        probe = RequestProbe(slow_app)
+        scope = {"type": "http", "method": "GET", "path": "/trigger/secret-token", "endpoint": main.trigger_script_url}
+        
+        # Disabled profiling records nothing
+        await probe(scope, None, None)
+        assert not request_profiler.samples
+        
+        request_profiler.configure(enabled=True, sample_rate=1.0)
+        try:
+            await probe(scope, None, None)
+            await probe(dict(scope, path="/api/scripts", endpoint=main.api_scripts), None, None)
+        finally:
+            request_profiler.configure(enabled=False)
+        report = request_profiler.report()
+        assert report["samples"] == {"/trigger/{token}": 1}
+        assert any(f["function"] == "slow_app" for f in report["functions"])
+        request_profiler.reset()
+        
+        # A stall is attributed to the request that finished while the loop was blocked
+        expected = time.monotonic() - 0.2
+        monitor = LoopLagMonitor(threshold_ms=100)
+        monitor.finished = loop_monitor.finished
+        monitor.check(expected, time.monotonic())
+        stall = monitor.report()["stalls"][0]
+        assert stall["lag_ms"] >= 200
+        assert "/trigger/{token}" in stall["routes"]
+        assert "secret-token" not in json.dumps(stall)
+        
+        monitor.check(time.monotonic(), time.monotonic() + 0.01)
+        assert len(monitor.stalls) == 1
+        
+        # Open event streams are never blamed for stalls
+        events = {"type": "http", "method": "GET", "path": "/api/tokens/events", "endpoint": main.api_token_events}
+        
+        async def open_stream(scope, receive, send):
+            assert not any(running is events for running in loop_monitor.running.values())
+        
+        await RequestProbe(open_stream)(events, None, None)
+        assert not any(scope is events for _, scope in loop_monitor.finished)
+    
+    asyncio.run(scenario())
+    
+    # Profiling settings must be a JSON object
+    import httpx
+    
+    async def configure():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://addon") as client:
+            for body in ("[]", "1", "not json"):
+                response = await client.post("/health/profile", content=body, headers=admin)
+                assert response.status_code == 400, body
+    
+    admin = {"Authorization": "Bearer profile-admin"}
+    saved = main.ADMIN_TOKEN
+    main.ADMIN_TOKEN = "profile-admin"
+    try:
+        asyncio.run(configure())
+    finally:
+        main.ADMIN_TOKEN = saved
+    print("✓ Profiling and loop lag monitor work")
+
+def test_token_store_cap():
+    """Test global token caps, byte accounting and eviction order"""
+    print("Testing token store cap...")
+    
+    import main
+    from main import create_token, hash_token, make_room_for_token, remove_token, tokens
+    
+    for selector in list(tokens):
+        remove_token(selector)
+    assert main.token_store_bytes == 0
+    
+    saved = main.MAX_TOKENS_TOTAL
+    main.MAX_TOKENS_TOTAL = 3
+    try:
+        used, _ = create_token("script.cap")
+        expiring, _ = create_token("script.cap")
+        fresh, _ = create_token("script.cap")
+        assert main.token_store_bytes == 3 * main.NEW_TOKEN_BYTES
+        
+        main.claim_token_use(used)
+        assert list(main.used_tokens) == [hash_token(used)[0]]
+        # Re-storing a record re-indexes it under its new expiry
+        tokens[hash_token(expiring)[0]].expires_at = time.time() + 30
+        main.store_token(hash_token(expiring)[0], tokens[hash_token(expiring)[0]])
+        
+        # Used tokens are evicted first
+        assert make_room_for_token()
+        assert hash_token(used)[0] not in tokens and len(tokens) == 2
+        create_token("script.cap")
+        
+        # Then tokens close to expiry
+        assert make_room_for_token()
+        assert hash_token(expiring)[0] not in tokens
+        assert hash_token(fresh)[0] in tokens
+        create_token("script.cap")
+        
+        # Tokens with time left are never evicted
+        assert not make_room_for_token()
+        assert len(tokens) == 3
+        
+        # The byte cap applies as well
+        main.MAX_TOKENS_TOTAL = 100
+        saved_kb = main.MAX_TOKEN_STORE_KB
+        main.MAX_TOKEN_STORE_KB = (3 * main.NEW_TOKEN_BYTES) // 1024
+        try:
+            assert not make_room_for_token()
+        finally:
+            main.MAX_TOKEN_STORE_KB = saved_kb
+    finally:
+        main.MAX_TOKENS_TOTAL = saved
+        for selector in list(tokens):
+            remove_token(selector)
+    assert main.token_store_bytes == 0 and not main.used_tokens
+    
+    # Inserts don't sweep the store; the sweeper expires tokens through the expiry index
+    stale, _ = create_token("script.cap")
+    selector = hash_token(stale)[0]
+    tokens[selector].expires_at = time.time() - 1
+    main.store_token(selector, tokens[selector])
+    extended, _ = create_token("script.cap")
+    main.extend_tokens([hash_token(extended)[0]], 60)
+    assert selector in tokens
+    main.cleanup_expired_tokens()
+    assert selector not in tokens and hash_token(extended)[0] in tokens
+    assert main.next_expiring(time.time() + main.TOKEN_EXPIRY_MINUTES * 60 + 60) == hash_token(extended)[0]
+    remove_token(hash_token(extended)[0])
+    assert main.next_expiring(float("inf")) is None and not main.expiry_heap
+    print("✓ Token store cap works")
+
+def test_shutdown_snapshot():
+    """Test draining upstream calls and the token/schedule snapshot round trip"""
+    print("Testing shutdown snapshot...")
+    import gzip
+    import tempfile
+    import main
+    from main import claim_token_use, create_token, hash_token, remove_token, scheduler, tokens
+    
+    async def slow_call():
+        await asyncio.sleep(0.1)
+        return True
+    
+    async def drain():
+        call = asyncio.create_task(main.upstream_limiter.run("script.slow", slow_call))
+        await asyncio.sleep(0)
+        assert await main.drain_upstream_calls(time.monotonic() + 1) == 0
+        assert call.done() and call.result()
+        
+        call = asyncio.create_task(main.upstream_limiter.run("script.slow", slow_call))
+        await asyncio.sleep(0)
+        assert await main.drain_upstream_calls(time.monotonic() + 0.01) == 1
+        await call
+        
+        # Calls still queued behind the per-script limit count as cut off too
+        calls = [asyncio.create_task(main.upstream_limiter.run("script.slow", slow_call))
+                 for _ in range(main.upstream_limiter.per_script_limit + 1)]
+        await asyncio.sleep(0)
+        assert await main.drain_upstream_calls(time.monotonic() + 0.01) == len(calls)
+        await asyncio.gather(*calls)
+    
+    asyncio.run(drain())
+    
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "tokens.ndjson.gz")
+        token, _ = create_token("script.snapshot", max_uses=2)
+        expired, _ = create_token("script.snapshot")
+        tokens[hash_token(expired)[0]].expires_at = time.time() - 1
+        claim_token_use(token)
+        run = scheduler.schedule("script.snapshot", time.time() + 3600)
+        try:
+            assert main.write_snapshot(path) == 2
+            for selector in list(tokens):
+                remove_token(selector)
+            scheduler.cancel(run.run_id)
+            
+            # Corrupt lines are skipped rather than failing the whole load
+            with gzip.open(path, "at") as f:
+                f.write("not json\n")
+            assert main.load_snapshot(path) == (1, 1)
+            assert not os.path.exists(path)
+            assert scheduler.runs[run.run_id].run_at == run.run_at
+            
+            token_data, error = claim_token_use(token)
+            assert error is None and token_data.uses == 2
+            assert main.load_snapshot(path) == (0, 0)
+            
+            # Runs long overdue after downtime are dropped rather than fired late
+            importer = main.TokenImporter()
+            for run_at in (time.time() - main.MAX_RUN_LATENESS_SECONDS - 60, time.time() - 60):
+                importer.add(json.dumps({"type": "run", "run_id": f"late{int(run_at)}", "script_id": "script.snapshot",
+                                         "run_at": run_at, "created_at": run_at - 60}))
+            assert (importer.counts["runs"], importer.counts["stale_runs"]) == (1, 1)
+            for run_id in list(scheduler.runs):
+                if run_id.startswith("late"):
+                    scheduler.cancel(run_id)
+        finally:
+            scheduler.cancel(run.run_id)
+            for selector in list(tokens):
+                remove_token(selector)
+    print("✓ Shutdown snapshot works")
+
+def test_qr_codes():
+    """Test the QR encoder and image output"""
+    print("Testing QR codes...")
+    import struct
+    import zlib
+    import main
+    import qr_encoder
+    
+    # Reed-Solomon check against the published version 1-M "HELLO WORLD" example
+    data = [32, 91, 11, 120, 209, 114, 220, 77, 67, 64, 236, 17, 236, 17, 236, 17]
+    ecc = qr_encoder.reed_solomon_remainder(data, qr_encoder.reed_solomon_divisor(10))
+    assert ecc == [196, 35, 39, 119, 235, 215, 231, 226, 93, 23]
+    
+    url = "https://example.ui.nabu.casa/trigger/" + "x" * 43
+    matrix = qr_encoder.encode(url)
+    assert len(matrix) == 4 * 5 + 17  # 80 bytes at level M need version 5
+    for x, y in ((0, 0), (len(matrix) - 7, 0), (0, len(matrix) - 7)):
+        assert all(matrix[y][x + i] and matrix[y + 6][x + i] for i in range(7))  # finder edges
+    
+    png = qr_encoder.to_png(matrix, scale=2)
+    assert png.startswith(b"\x89PNG\r\n\x1a\n")
+    width, height = struct.unpack(">II", png[16:24])
+    assert width == height == (len(matrix) + 8) * 2
+    assert zlib.crc32(png[12:29]) == struct.unpack(">I", png[29:33])[0]
+    svg = qr_encoder.to_svg(matrix, scale=4)
+    assert svg.startswith("<svg") and f'width="{(len(matrix) + 8) * 4}"' in svg
+    
+    try:
+        qr_encoder.encode("x" * 3000)
+        assert False, "oversized data should be rejected"
+    except ValueError:
+        pass
+    
+    async def scenario():
+        # Images of trigger URLs are never kept around
+        first = await main.render_qr(url, "svg", 4)
+        assert first == main.build_qr(url, "svg", 4)
+        assert await main.render_qr(url, "svg", 4) is not first
+    
+    asyncio.run(scenario())
+    print("✓ QR codes work")
+
+def test_tracing():
+    """Test sampled spans, nesting through contextvars and Zipkin export"""
+    print("Testing tracing...")
+    import tempfile
+    from main import Tracer
+    
+    async def scenario(directory):
+        off = Tracer(sample_rate=0)
+        assert off.start_trace("request") is None
+        with off.span("store.lookup") as span:
+            assert span is None
+        
+        tracer = Tracer(sample_rate=1, export_path=os.path.join(directory, "traces.ndjson"), buffer_size=10)
+        
+        async def upstream():
+            with tracer.span("upstream.trigger", script_id="script.a"):
+                await asyncio.sleep(0.01)
+        
+        with tracer.start_trace("GET /trigger/{token}") as root:
+            with tracer.span("store.lookup"):
+                pass
+            await asyncio.create_task(upstream())  # tasks inherit the current span
+        
+        [trace] = tracer.traces()
+        spans = {span["name"]: span for span in trace["spans"]}
+        assert set(spans) == {"GET /trigger/{token}", "store.lookup", "upstream.trigger"}
+        assert spans["store.lookup"]["parentId"] == root.span_id
+        assert spans["upstream.trigger"]["parentId"] == root.span_id
+        assert spans["upstream.trigger"]["duration"] >= 10000  # microseconds
+        assert spans["upstream.trigger"]["tags"] == {"script_id": "script.a"}
+        assert "parentId" not in spans["GET /trigger/{token}"]
+        
+        await tracer.exporter.flush()
+        with open(tracer.exporter.path) as f:
+            exported = [json.loads(line) for line in f]
+        assert len(exported) == 3 and {span["traceId"] for span in exported} == {root.trace_id}
+        
+        # The ring buffer keeps only the newest spans
+        for _ in range(20):
+            with tracer.start_trace("request"):
+                pass
+        assert len(tracer.spans) == 10 and len(tracer.traces(limit=3)) == 3
+    
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(scenario(directory))
+    print("✓ Tracing works")
+
+def test_token_export_import():
+    """Test streaming the token store out and back in as gzip NDJSON"""
+    print("Testing token export/import...")
+    import gzip
+    import httpx
+    import main
+    from main import claim_token_use, create_token, hash_token, remove_token, scheduler, tokens
+    
+    admin = {"Authorization": "Bearer export-admin"}
+    saved = main.ADMIN_TOKEN, main.MAX_TOKENS_TOTAL
+    main.ADMIN_TOKEN = "export-admin"
+    
+    async def scenario():
+        live = [create_token("script.export", max_uses=3)[0] for _ in range(2500)]
+        expired, _ = create_token("script.export")
+        tokens[hash_token(expired)[0]].expires_at = time.time() - 1
+        claim_token_use(live[0])
+        run = scheduler.schedule("script.export", time.time() + 3600, token_id="ab" * 16)
+        
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://addon") as client:
+            assert (await client.get("/api/tokens/export")).status_code == 403
+            exported = await client.get("/api/tokens/export", headers=admin)
+            assert exported.headers["content-type"] == "application/gzip"
+            lines = gzip.decompress(exported.content).decode().splitlines()
+            assert json.loads(lines[0])["type"] == "snapshot"
+            assert len(lines) == 1 + 2500 + 1  # header, live tokens, scheduled run
+            
+            for selector in list(tokens):
+                remove_token(selector)
+            scheduler.cancel(run.run_id)
+            
+            # Expired and malformed entries are dropped as the stream is read
+            stale = main.serialize_token(hash_token(expired)[0], main.TokenRecord(
+                bytes(16), "script.export", time.time() - 60, time.time() - 1
+            ))
+            upload = exported.content + gzip.compress(f"{json.dumps(stale)}\nnot json\n".encode())
+            imported = await client.post("/api/tokens/import", content=upload, headers=admin)
+            assert imported.status_code == 200
+            counts = imported.json()
+            assert (counts["tokens"], counts["runs"], counts["expired"], counts["invalid"]) == (2500, 1, 1, 1)
+            
+            token_data, error = claim_token_use(live[0])
+            assert error is None and token_data.uses == 2
+            assert scheduler.runs[run.run_id].token_id == "ab" * 16
+            
+            # Re-importing skips what is already there; the caps still apply
+            main.MAX_TOKENS_TOTAL = 2700
+            remove_token(hash_token(live[1])[0])
+            plain = gzip.decompress(exported.content)
+            counts = (await client.post("/api/tokens/import", content=plain, headers=admin)).json()
+            assert (counts["tokens"], counts["duplicates"]) == (1, 2500)
+            
+            for selector in list(tokens)[:500]:
+                remove_token(selector)
+            main.MAX_TOKENS_TOTAL = 2100
+            counts = (await client.post("/api/tokens/import", content=exported.content, headers=admin)).json()
+            assert counts["tokens"] == 100 and counts["store_full"] == 400 and len(tokens) == 2100
+            
+            bad = await client.post("/api/tokens/import", content=b'{"type": "token"}\n', headers=admin)
+            assert bad.status_code == 400
+        scheduler.cancel(run.run_id)
+    
+    try:
+        asyncio.run(scenario())
+    finally:
+        main.ADMIN_TOKEN, main.MAX_TOKENS_TOTAL = saved
+        for selector in list(tokens):
+            remove_token(selector)
+    print("✓ Token export/import works")
+
 if __name__ == "__main__":
     print("Starting tests...")
     
     # Test token generation first
     try:
         test_token_generation()
+        test_static_asset_pipeline()
+        test_index_page_shell()
+        test_token_events()
+        test_multi_use_tokens()
+        test_idempotency_cache()
+        test_hashed_token_store()
+        test_revocation_and_extension()
+        test_trigger_scheduler()
+        test_upstream_limiter()
+        test_audit_log()
+        test_profiling_and_loop_lag()
+        test_token_store_cap()
+        test_shutdown_snapshot()
+        test_qr_codes()
+        test_tracing()
+        test_token_export_import()
     except Exception as e:
         print(f"Token generation test failed: {e}")
         sys.exit(1)
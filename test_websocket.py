@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+"""
+Home Assistant transport tests for Script URL Generator
+Runs trigger_script() and get_scripts() against local fake Home Assistant instances
+"""
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# Add the current directory to Python path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import httpx
+from aiohttp import WSMsgType, web
+from aiohttp.test_utils import TestServer
+
+import main
+
+FAKE_TOKEN = "fake-supervisor-token"
+
+class FakeHomeAssistant:
+    """Minimal Home Assistant speaking the WebSocket and REST APIs"""
+
+    def __init__(self, accept_auth=True, scripts=(), delay=0):
+        self.accept_auth = accept_auth
+        self.scripts = scripts
+        self.delay = delay
+        self.active = 0
+        self.peak = 0
+        self.ws_calls = []
+        self.rest_calls = []
+        self.connections = 0
+        self.sockets = []
+        self.subscriptions = []
+        self.script_states = {entity_id: "off" for entity_id in scripts}
+        self.app = web.Application()
+        self.app.router.add_get("/api/websocket", self.websocket)
+        self.app.router.add_get("/api/states", self.states)
+        self.app.router.add_post("/api/services/script/turn_on", self.turn_on)
+        self.server = TestServer(self.app)
+
+    async def websocket(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.connections += 1
+        self.sockets.append(ws)
+
+        await ws.send_json({"type": "auth_required"})
+        auth = await ws.receive_json()
+        if not self.accept_auth or auth.get("access_token") != FAKE_TOKEN:
+            await ws.send_json({"type": "auth_invalid"})
+            await ws.close()
+            return ws
+        await ws.send_json({"type": "auth_ok"})
+
+        pending = []
+        async for message in ws:
+            if message.type != WSMsgType.TEXT:
+                continue
+            command = json.loads(message.data)
+            self.ws_calls.append(command)
+            if command["type"] == "subscribe_trigger":
+                self.subscriptions.append((ws, command["id"], command["trigger"]["entity_id"]))
+                await ws.send_json({"id": command["id"], "type": "result", "success": True, "result": None})
+                continue
+            if command["type"] == "unsubscribe_events":
+                self.subscriptions = [s for s in self.subscriptions if (s[0], s[1]) != (ws, command["subscription"])]
+                await ws.send_json({"id": command["id"], "type": "result", "success": True, "result": None})
+                continue
+            if command["type"] == "get_states":
+                await ws.send_json({"id": command["id"], "type": "result", "success": True, "result": [
+                    {"entity_id": entity_id, "state": state} for entity_id, state in self.script_states.items()
+                ]})
+                continue
+            if command["service_data"]["entity_id"] == "script.rejected":
+                await ws.send_json({"id": command["id"], "type": "result", "success": False,
+                                    "error": {"code": "not_found", "message": "Service not found"}})
+                continue
+            pending.append(command)
+            # Answer in pairs, newest first, to prove results are matched by id
+            if len(pending) == 2 or command["service_data"]["entity_id"] == "script.single":
+                await ws.send_json([
+                    {"id": item["id"], "type": "result", "success": True, "result": None}
+                    for item in reversed(pending)
+                ])
+                pending = []
+        return ws
+
+    async def states(self, request):
+        return web.json_response([
+            {"entity_id": entity_id, "attributes": {"friendly_name": entity_id.title()}}
+            for entity_id in self.scripts
+        ])
+
+    async def turn_on(self, request):
+        self.rest_calls.append(await request.json())
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.active -= 1
+        return web.json_response([])
+
+    async def set_state(self, entity_id, state):
+        """Change a script's state and fire the state triggers watching it"""
+        old_state, self.script_states[entity_id] = self.script_states.get(entity_id), state
+        last_updated = datetime.now().isoformat()
+        for ws, subscription_id, entity_ids in self.subscriptions:
+            if entity_id not in entity_ids or ws.closed:
+                continue
+            await ws.send_json({"id": subscription_id, "type": "event", "event": {"variables": {"trigger": {
+                "platform": "state",
+                "entity_id": entity_id,
+                "from_state": {"entity_id": entity_id, "state": old_state},
+                "to_state": {"entity_id": entity_id, "state": state, "last_updated": last_updated},
+            }}}})
+
+    @property
+    def url(self):
+        return str(self.server.make_url("")).rstrip("/")
+
+    async def __aenter__(self):
+        await self.server.start_server()
+        self.saved = (main.USE_WEBSOCKET, main.backends)
+        main.USE_WEBSOCKET = True
+        main.backends = {"": main.HassBackend("", self.url, FAKE_TOKEN)}
+        return self
+
+    async def __aexit__(self, *exc):
+        for backend in main.backends.values():
+            await backend.close()
+        main.USE_WEBSOCKET, main.backends = self.saved
+        await self.server.close()
+
+def test_websocket_multiplexing():
+    """Test that concurrent triggers share one connection"""
+    print("Testing WebSocket multiplexing...")
+
+    async def scenario():
+        async with FakeHomeAssistant() as hass:
+            results = await asyncio.gather(
+                main.trigger_script("script.one"),
+                main.trigger_script("script.two")
+            )
+            assert results == [True, True]
+            assert hass.connections == 1
+            assert sorted(c["service_data"]["entity_id"] for c in hass.ws_calls) == ["script.one", "script.two"]
+            assert all(c["type"] == "call_service" and c["service"] == "turn_on" for c in hass.ws_calls)
+            assert not hass.rest_calls
+
+    asyncio.run(scenario())
+    print("✓ WebSocket multiplexing works")
+
+def test_websocket_reconnect():
+    """Test that a dropped connection is re-established on the next trigger"""
+    print("Testing WebSocket reconnect...")
+
+    async def scenario():
+        async with FakeHomeAssistant() as hass:
+            assert await main.trigger_script("script.single")
+            await hass.sockets[0].close()
+            await asyncio.sleep(0.05)
+
+            assert await main.trigger_script("script.single")
+            assert hass.connections == 2
+            assert not hass.rest_calls
+
+    asyncio.run(scenario())
+    print("✓ WebSocket reconnect works")
+
+def test_websocket_bad_messages():
+    """Test that bad messages and failing handlers don't take the channel down"""
+    print("Testing WebSocket bad messages...")
+
+    async def scenario():
+        async with FakeHomeAssistant(scripts=["script.boom"]) as hass:
+            backend = main.backends[""]
+
+            def explode(event):
+                raise RuntimeError("handler bug")
+
+            await backend.websocket.subscribe_trigger({"platform": "state", "entity_id": ["script.boom"]}, explode)
+            await hass.set_state("script.boom", "on")
+            await hass.sockets[0].send_str("not json")
+            await hass.sockets[0].send_str("[1]")
+            assert await asyncio.wait_for(main.trigger_script("script.single"), timeout=2)
+            assert hass.connections == 1 and backend.websocket.connected
+
+            # A call Home Assistant rejects is not a sign of health
+            backend.last_success_at = None
+            assert not await main.trigger_script("script.rejected")
+            assert backend.last_success_at is None
+
+            # A connection that fails for good is closed, and the next call reconnects
+            reader, ws = backend.websocket.reader, backend.websocket.ws
+            reader.cancel()
+            await asyncio.wait({reader})
+            assert ws.closed and not backend.websocket.connected
+            assert await asyncio.wait_for(main.trigger_script("script.single"), timeout=2)
+            assert hass.connections == 2
+
+    asyncio.run(scenario())
+    print("✓ WebSocket bad messages are contained")
+
+def test_websocket_rest_fallback():
+    """Test that triggers fall back to REST when the WebSocket is unavailable"""
+    print("Testing REST fallback...")
+
+    async def scenario():
+        async with FakeHomeAssistant(accept_auth=False) as hass:
+            assert await main.trigger_script("script.single")
+            assert hass.rest_calls == [{"entity_id": "script.single"}]
+            assert not hass.ws_calls
+
+    asyncio.run(scenario())
+    print("✓ REST fallback works")
+
+def test_multiple_backends():
+    """Test that namespaced script ids are listed and routed per backend"""
+    print("Testing multiple backends...")
+
+    async def scenario():
+        async with FakeHomeAssistant(scripts=["script.home"]) as home:
+            async with FakeHomeAssistant(scripts=["script.office"]) as office:
+                main.backends = {
+                    "": main.HassBackend("", home.url, FAKE_TOKEN),
+                    "office": main.HassBackend("office", office.url, FAKE_TOKEN),
+                }
+                main.USE_WEBSOCKET = False
+
+                scripts = await main.get_scripts()
+                assert [s.entity_id for s in scripts] == ["script.home", "office:script.office"]
+                assert await main.find_script("office:script.office") is not None
+                assert await main.find_script("office:script.home") is None
+
+                assert await main.trigger_script("office:script.office")
+                assert await main.trigger_script("script.home")
+                assert office.rest_calls == [{"entity_id": "script.office"}]
+                assert home.rest_calls == [{"entity_id": "script.home"}]
+                assert main.backends["office"].health()["healthy"]
+
+    asyncio.run(scenario())
+    print("✓ Multiple backends work")
+
+def test_options_hot_reload_under_load():
+    """Test that saved option changes apply mid-run without dropping tokens or requests"""
+    print("Testing options hot reload under load...")
+
+    saved = {setting: getattr(main, setting) for setting, _ in main.RELOADABLE_OPTIONS.values()}
+    saved_export_path = main.TRACE_EXPORT_PATH
+    options = {
+        "token_expiry_minutes": 10,
+        "max_tokens_per_script": 1000,
+        "max_concurrent_triggers": 8,
+        "max_concurrent_per_script": 8,
+        "use_websocket": False,
+        "enable_logging": True,
+    }
+
+    async def scenario(directory):
+        for selector in list(main.tokens):
+            main.remove_token(selector)
+        path = os.path.join(directory, "options.json")
+        watcher = main.OptionsWatcher(path)
+
+        def save_options(**changes):
+            options.update(changes)
+            with open(path, "w") as f:
+                json.dump(options, f)
+            os.utime(path, ns=(time.time_ns(), time.time_ns()))
+
+        save_options()
+        watcher.check()
+
+        async with FakeHomeAssistant(scripts=["script.load"], delay=0.02) as hass:
+            main.USE_WEBSOCKET = False
+            results = []
+            reloaded = asyncio.Event()
+
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://addon") as client:
+                async def worker():
+                    for _ in range(12):
+                        generated = await client.post("/api/generate", json={"script_id": "script.load"})
+                        token = generated.json().get("token")
+                        triggered = await client.get(f"/trigger/{token}")
+                        results.append((generated.status_code, triggered.status_code, "Script Triggered" in triggered.text))
+
+                async def reload_midway():
+                    while len(results) < 16:
+                        await asyncio.sleep(0.005)
+                    save_options(token_expiry_minutes=1, max_concurrent_triggers=1,
+                                 max_concurrent_per_script=1, enable_logging=False)
+                    assert watcher.check() == [
+                        "enable_logging", "max_concurrent_per_script",
+                        "max_concurrent_triggers", "token_expiry_minutes"
+                    ]
+                    await asyncio.sleep(0.1)  # calls admitted under the old limit finish
+                    hass.peak = 0
+                    reloaded.set()
+
+                await asyncio.gather(*(worker() for _ in range(4)), reload_midway())
+
+            assert reloaded.is_set()
+            assert len(results) == 48
+            assert all(result == (200, 200, True) for result in results), results
+            assert hass.peak == 1
+            assert main.upstream_limiter.max_limit == 1
+            assert main.ENABLE_LOGGING is False
+
+            # No token was dropped; old ones kept their TTL, new ones got the new one
+            lifetimes = {round(record.expires_at - record.created_at) for record in main.tokens.values()}
+            assert len(main.tokens) == 48
+            assert lifetimes == {600, 60}
+
+            # A broken file is rejected as a whole and the running options stay in place
+            with open(path, "w") as f:
+                json.dump({**options, "max_concurrent_triggers": 4, "enable_logging": "yes"}, f)
+            os.utime(path, ns=(time.time_ns() + 1000, time.time_ns() + 1000))
+            assert watcher.check() == []
+            assert watcher.last_error and main.upstream_limiter.max_limit == 1
+
+            # Restart-only options are read from the file at startup and left alone afterwards
+            export_path = os.path.join(directory, "traces.ndjson")
+            assert main.apply_options({"trace_export_path": export_path}) == []
+            assert main.TRACE_EXPORT_PATH == saved_export_path
+            assert main.apply_options({"trace_export_path": export_path}, startup=True) == ["trace_export_path"]
+            assert main.TRACE_EXPORT_PATH == export_path
+
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            asyncio.run(scenario(directory))
+    finally:
+        for setting, value in saved.items():
+            setattr(main, setting, value)
+        main.TRACE_EXPORT_PATH = saved_export_path
+        main.upstream_limiter.configure(main.MAX_CONCURRENT_TRIGGERS, main.MAX_CONCURRENT_PER_SCRIPT,
+                                        main.ADAPTIVE_CONCURRENCY)
+        for selector in list(main.tokens):
+            main.remove_token(selector)
+    print("✓ Options hot reload works under load")
+
+def test_script_run_tracking():
+    """Test that waiting clients share one script trigger subscription and see runs start and finish"""
+    print("Testing script run tracking...")
+
+    async def scenario():
+        async with FakeHomeAssistant(scripts=["script.gate", "script.stuck"]) as hass:
+            main.USE_WEBSOCKET = False
+
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://addon") as client:
+                generated = (await client.post("/api/generate", json={"script_id": "script.gate"})).json()
+                run_url = f"/api/tokens/{generated['token_id']}/run"
+                assert (await client.get(run_url)).status_code == 404
+
+                triggered = await client.get(f"/trigger/{generated['token']}")
+                assert "Script Triggered" in triggered.text
+                assert (await client.get(run_url)).json()["status"] == "triggered"
+
+                # Many long-polling clients, one upstream subscription
+                started_waiters = [client.get(run_url, params={"wait": 5, "status": "triggered"}) for _ in range(3)]
+                done_waiters = [client.get(run_url, params={"wait": 5}) for _ in range(3)]
+                waiting = asyncio.gather(*started_waiters, *done_waiters)
+                await asyncio.sleep(0.05)
+                await hass.set_state("script.gate", "on")
+                await asyncio.sleep(0.05)
+                await hass.set_state("script.gate", "off")
+                responses = [response.json() for response in await waiting]
+
+                assert [r["status"] for r in responses] == ["started"] * 3 + ["finished"] * 3
+                assert responses[-1]["started_at"] and responses[-1]["finished_at"]
+                # The subscription only covers scripts triggered through a URL
+                assert [(c["type"], c["trigger"]["entity_id"]) for c in hass.ws_calls] == [
+                    ("subscribe_trigger", ["script.gate"])
+                ]
+                assert hass.rest_calls == [{"entity_id": "script.gate"}]
+
+                # A run Home Assistant never starts fails once the start timeout has passed
+                generated = (await client.post("/api/generate", json={"script_id": "script.stuck"})).json()
+                await client.get(f"/trigger/{generated['token']}")
+                main.run_tracker.expire_stale(time.time() + main.RUN_START_TIMEOUT_SECONDS + 1)
+                run = (await client.get(f"/api/tokens/{generated['token_id']}/run")).json()
+                assert run["status"] == "failed" and run["error"] == "Script did not start"
+                assert [c["type"] for c in hass.ws_calls[1:]] == ["subscribe_trigger", "unsubscribe_events"]
+                assert [entity_ids for _, _, entity_ids in hass.subscriptions] == [["script.gate", "script.stuck"]]
+
+            # A run that ended while the subscription was down is finished on reconnect
+            run = main.run_tracker.triggered("0" * 32, "script.gate")
+            await hass.set_state("script.gate", "on")
+            await asyncio.sleep(0.05)
+            assert run.status == "started"
+            await hass.sockets[0].close()
+            hass.script_states["script.gate"] = "off"
+            await main.run_tracker.wait(run, "started", 2)
+            assert run.status == "finished"
+            assert hass.connections == 2
+            assert hass.ws_calls[-1]["type"] == "get_states"
+            main.run_tracker.close()
+
+    saved = main.RUN_TRACKER_RETRY_SECONDS, main.TRACK_SCRIPT_RUNS
+    main.RUN_TRACKER_RETRY_SECONDS, main.TRACK_SCRIPT_RUNS = 0.1, True
+    try:
+        asyncio.run(scenario())
+    finally:
+        main.RUN_TRACKER_RETRY_SECONDS, main.TRACK_SCRIPT_RUNS = saved
+        main.run_tracker = main.ScriptRunTracker()
+        for selector in list(main.tokens):
+            main.remove_token(selector)
+    print("✓ Script run tracking works")
+
+def test_script_run_watch_coalescing():
+    """Test that first triggers share one subscription refresh and renewal survives cancellation"""
+    print("Testing script run watch coalescing...")
+
+    async def scenario():
+        async with FakeHomeAssistant(scripts=["script.a", "script.b", "script.c"]) as hass:
+            tracker = main.run_tracker = main.ScriptRunTracker()
+
+            # A burst of first triggers ends up in a single subscribe call
+            assert await asyncio.gather(*(tracker.watch(f"script.{name}") for name in "abc")) == [True] * 3
+            assert [(c["type"], c["trigger"]["entity_id"]) for c in hass.ws_calls] == [
+                ("subscribe_trigger", ["script.a", "script.b", "script.c"])
+            ]
+
+            # A refresh cancelled under the keeper is retried rather than ending renewal
+            run = tracker.triggered("1" * 32, "script.a")
+            original_subscribe = tracker.subscribe
+            cancelled = []
+
+            async def subscribe_once_cancelled(backend, watch, entity_ids):
+                if not cancelled:
+                    cancelled.append(True)
+                    raise asyncio.CancelledError()
+                await original_subscribe(backend, watch, entity_ids)
+
+            tracker.subscribe = subscribe_once_cancelled
+            await hass.sockets[0].close()
+            for _ in range(50):
+                await asyncio.sleep(0.05)
+                if "" in tracker.subscribed:
+                    break
+            assert cancelled and "" in tracker.subscribed
+            assert not tracker.watches[""].keeper.done()
+            await hass.set_state("script.a", "on")
+            await tracker.wait(run, "triggered", 2)
+            assert run.status == "started"
+            tracker.close()
+
+    saved = main.RUN_TRACKER_RETRY_SECONDS, main.TRACK_SCRIPT_RUNS
+    main.RUN_TRACKER_RETRY_SECONDS, main.TRACK_SCRIPT_RUNS = 0.1, True
+    try:
+        asyncio.run(scenario())
+    finally:
+        main.RUN_TRACKER_RETRY_SECONDS, main.TRACK_SCRIPT_RUNS = saved
+        main.run_tracker = main.ScriptRunTracker()
+    print("✓ Script run watch coalescing works")
+
+if __name__ == "__main__":
+    test_websocket_multiplexing()
+    test_websocket_reconnect()
+    test_websocket_bad_messages()
+    test_websocket_rest_fallback()
+    test_multiple_backends()
+    test_options_hot_reload_under_load()
+    test_script_run_tracking()
+    test_script_run_watch_coalescing()
+    print("\n🎉 All transport tests passed!")